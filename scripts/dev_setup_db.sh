@@ -1,5 +1,7 @@
 #!/bin/bash
 cd '../src-backend'
 python manage.py makemigrations
+python manage.py compact_recalc_requests
 python manage.py migrate
-python manage.py add_dummy_data
\ No newline at end of file
+python manage.py add_dummy_data
+python manage.py rebuild_daily_points
\ No newline at end of file
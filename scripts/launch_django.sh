@@ -7,9 +7,15 @@ export DJANGO_SETTINGS_MODULE="workout_challenge.settings"
 echo "Run make migrations"
 python manage.py makemigrations
 
+echo "Compact recalc requests"
+python manage.py compact_recalc_requests
+
 echo "Run migrate"
 python manage.py migrate
 
+echo "Build missing daily points rollups"
+python manage.py rebuild_daily_points --if-empty
+
 if [ $DEBUG == "true" ] || [ $DEBUG == "True" ]; then
 	echo "Run Django Server";
 	python ./manage.py runserver 0.0.0.0:8000;
@@ -0,0 +1,225 @@
+"""Competition feed - the workouts of all members with their points, paginated or as delta since a change token"""
+
+import datetime, base64, binascii
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Q, Sum, Exists, OuterRef, Min
+from django.utils import timezone
+
+from workout_challenge.celery import app
+from workout_challenge.single_flight import get_or_compute_single_flight
+from competition.stats import get_competition_stats_version, STATS_CACHE_TIMEOUT
+from competition.push import has_competition_subscribers, publish_competition_event
+from competition.rollup import get_competition_points
+
+FEED_TOKEN_LAG_SECONDS = 5  # changes logged just before the token was read are sent again - not lost
+FEED_CHANGE_RETENTION_DAYS = 7  # older tokens get a reset - the client has to load the whole feed again
+
+
+def get_competition_feed(competition):
+    """ workouts of all members with their points per goal/award - newest first """
+    all_points = get_competition_points(competition).order_by('-workout__start_datetime', '-workout__steps', '-workout__duration', '-workout', '-workout__user')
+
+    grouped_points = {i['workout']: i for i in all_points.values('workout__user', 'workout__user__username', 'workout__user__strava_allow_follow', 'workout', 'workout__sport_type', 'workout__start_datetime', 'workout__duration', 'workout__steps', 'workout__strava_id', 'award').annotate(points_capped=Sum('points_capped'), points_raw=Sum('points_raw')).order_by('-workout__start_datetime', '-workout__duration', '-workout', '-workout__user')}
+
+    for i in all_points.values('workout', 'id', 'goal', 'goal__name', 'award', 'award__name', 'points_capped', 'points_raw'):
+        if 'details' not in grouped_points[i['workout']]:
+            grouped_points[i['workout']]['details'] = []
+        grouped_points[i['workout']]['details'].append(i)
+
+    return list(grouped_points.values())
+
+
+FEED_PAGE_SIZE = 50
+FEED_MAX_PAGE_SIZE = 200
+
+
+def encode_feed_cursor(start_datetime, workout_id):
+    """ opaque cursor pointing behind the given workout """
+    return base64.urlsafe_b64encode(f'{start_datetime.isoformat()}|{workout_id}'.encode()).decode()
+
+
+def decode_feed_cursor(cursor):
+    """ (start_datetime, workout id) of the cursor - raises ValueError if it is invalid """
+    try:
+        start_datetime, workout_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.datetime.fromisoformat(start_datetime), int(workout_id)
+    except (TypeError, UnicodeDecodeError, binascii.Error) as e:
+        raise ValueError(f'Invalid cursor {cursor}') from e
+
+
+def get_feed_entries(competition_points, workout_ids):
+    """ feed entries (like get_competition_feed) of the given workouts in the given order - workouts without points are left out """
+    grouped_points = {workout_id: None for workout_id in workout_ids}
+    point_lst = competition_points.filter(workout__in=grouped_points.keys()).values(
+        'workout__user', 'workout__user__username', 'workout__user__strava_allow_follow', 'workout', 'workout__sport_type', 'workout__start_datetime', 'workout__duration', 'workout__steps', 'workout__strava_id',
+        'id', 'goal', 'goal__name', 'award', 'award__name', 'points_capped', 'points_raw',
+    ).order_by('id')
+    for i in point_lst:
+        entry = grouped_points[i['workout']]
+        if entry is None:
+            entry = grouped_points[i['workout']] = {key: value for key, value in i.items() if key.startswith('workout')}
+            entry.update({'award': None, 'points_capped': 0, 'points_raw': 0, 'details': []})
+        entry['award'] = entry['award'] or i['award']
+        entry['points_capped'] += i['points_capped'] or 0
+        entry['points_raw'] += i['points_raw'] or 0
+        entry['details'].append({key: i[key] for key in ['workout', 'id', 'goal', 'goal__name', 'award', 'award__name', 'points_capped', 'points_raw']})
+
+    return [i for i in grouped_points.values() if i is not None]
+
+
+def get_competition_feed_page(competition, cursor=None, page_size=FEED_PAGE_SIZE):
+    """ One page of the feed - keyset pagination on (workout start_datetime, workout id), newest first.
+
+    Only the workouts of the page and their points are read, so every page costs the same however long the
+    competition has been running.
+
+    Args:
+        competition: competition id
+        cursor: next_cursor of the previous page - None for the first page
+        page_size: number of workouts on the page
+    Returns: dict with the results (entries like get_competition_feed) and the next_cursor (None on the last page)
+    """
+    Workout = apps.get_model('workouts', 'Workout')
+    CustomUser = apps.get_model('custom_user', 'CustomUser')
+
+    competition_points = get_competition_points(competition)
+    # only the members' workouts - walked along their (user, start_datetime) index instead of the workouts of every competition
+    member_ids = CustomUser.objects.filter(my_competitions=getattr(competition, 'pk', competition)).values('pk')
+    workout_lst = Workout.objects.filter(user_id__in=member_ids).filter(Exists(competition_points.filter(workout=OuterRef('pk'))))
+    if cursor is not None:
+        start_datetime, workout_id = decode_feed_cursor(cursor)
+        workout_lst = workout_lst.filter(Q(start_datetime__lt=start_datetime) | Q(start_datetime=start_datetime, pk__lt=workout_id))
+    page = list(workout_lst.order_by('-start_datetime', '-pk').values_list('pk', 'start_datetime')[:page_size + 1])
+    next_cursor = encode_feed_cursor(*page[page_size - 1][::-1]) if len(page) > page_size else None
+    page = page[:page_size]
+
+    return {'results': get_feed_entries(competition_points, [workout_id for workout_id, _ in page]), 'next_cursor': next_cursor}
+
+
+def get_cached_competition_feed(competition):
+    """ get_competition_feed shared by all members - cached per competition and stats version, computed once at a time
+
+    Returns: dict with the results, the change token they are up to date with and stale (True if it is the previous
+        version, returned while another worker computes the new one)
+    """
+    version = get_competition_stats_version(competition)
+    feed = get_or_compute_single_flight(
+        cache_key=f"competition_feed_{competition}_{version}",
+        compute=lambda: {'version': version, 'token': get_feed_token(), 'results': get_competition_feed(competition)},
+        timeout=STATS_CACHE_TIMEOUT,
+        stale_key=f"competition_feed_stale_{competition}",
+    )
+    return {**feed, 'stale': feed['version'] != version}
+
+
+def get_cached_competition_feed_page(competition, cursor=None, page_size=FEED_PAGE_SIZE):
+    """ get_competition_feed_page shared by all members - cached per competition, stats version, cursor and page size """
+    return get_or_compute_single_flight(
+        cache_key=f"competition_feed_page_{competition}_{get_competition_stats_version(competition)}_{cursor}_{page_size}",
+        compute=lambda: {'token': get_feed_token(), **get_competition_feed_page(competition, cursor=cursor, page_size=page_size)},
+        timeout=STATS_CACHE_TIMEOUT,
+    )
+
+
+def record_feed_changes(changes, deleted=False):
+    """ log changed (or with deleted=True removed) workouts once the transaction is committed - changes is a list of (competition id, workout id)
+
+    Logging after the commit keeps the ids in the order the changes became visible - a client holding a token has seen
+    all changes up to it.
+    """
+    FeedChange = apps.get_model('competition', 'FeedChange')
+    change_lst = [FeedChange(competition_id=competition_id, workout_id=workout_id, deleted=deleted) for competition_id, workout_id in set(changes)]
+    if len(change_lst) > 0:
+        transaction.on_commit(lambda: _insert_feed_changes(change_lst))
+
+
+def _insert_feed_changes(change_lst):
+    """ insert and publish the changes of a committed transaction - stamped now, the token lag counts from the insert """
+    FeedChange = apps.get_model('competition', 'FeedChange')
+    created_datetime = timezone.now()
+    for change in change_lst:
+        change.created_datetime = created_datetime
+    FeedChange.objects.bulk_create(change_lst, batch_size=1_000)
+    publish_feed_changes(change_lst)
+
+
+def publish_feed_changes(change_lst):
+    """ push the logged changes to the subscribed clients - same shape as get_feed_delta, only for competitions someone listens to """
+    competition_changes = {}
+    for change in change_lst:
+        competition_changes.setdefault(change.competition_id, []).append(change)
+
+    for competition, changes in competition_changes.items():
+        if not has_competition_subscribers(competition):
+            continue
+        if any(i.workout_id is None for i in changes):
+            publish_competition_event(competition, 'feed', {'reset': True, 'changed': [], 'deleted': []})
+            continue
+        competition_points = get_competition_points(competition)
+        changed = get_feed_entries(competition_points, sorted({i.workout_id for i in changes if not i.deleted}))
+        changed = sorted(changed, key=lambda i: (i['workout__start_datetime'], i['workout']), reverse=True)
+        changed_ids = {i['workout'] for i in changed}
+        deleted = sorted({i.workout_id for i in changes} - changed_ids)
+        publish_competition_event(competition, 'feed', {'reset': False, 'changed': changed, 'deleted': deleted})
+
+
+def record_feed_reset(competition_ids):
+    """ log that the whole feed of the competition(s) changed - e.g. goals or members changed """
+    competition_ids = competition_ids if isinstance(competition_ids, (list, tuple, set)) else [competition_ids]
+    record_feed_changes([(getattr(i, 'pk', i), None) for i in competition_ids])
+
+
+def get_feed_token():
+    """ change token clients send back as ?since=... - all changes up to it are included in what they got with it
+
+    The token lags FEED_TOKEN_LAG_SECONDS behind the newest change: ids are handed out at insert but become visible at
+    commit, so of two concurrent inserts the newer id can be visible first. Changes within the lag are sent again.
+    """
+    FeedChange = apps.get_model('competition', 'FeedChange')
+    lagged = timezone.now() - datetime.timedelta(seconds=FEED_TOKEN_LAG_SECONDS)
+    return FeedChange.objects.filter(created_datetime__lte=lagged).order_by('-id').values_list('id', flat=True).first() or 0
+
+
+def get_feed_delta(competition, since):
+    """ Feed entries changed since the token - new and edited workouts plus tombstones of the removed ones.
+
+    Args:
+        competition: competition id
+        since: token of the previous response
+    Returns: dict with the new token, reset (True if the client has to load the whole feed again), the changed entries
+        (newest first) and the ids of the deleted workouts
+    """
+    FeedChange = apps.get_model('competition', 'FeedChange')
+
+    token = get_feed_token()
+    oldest = FeedChange.objects.aggregate(oldest=Min('id'))['oldest']
+    if since < 0 or (oldest is not None and since < oldest - 1):
+        # older changes are pruned already
+        return {'token': token, 'reset': True, 'changed': [], 'deleted': []}
+
+    deleted = {}
+    for workout_id, is_deleted in FeedChange.objects.filter(competition=competition, id__gt=since).order_by('id').values_list('workout_id', 'deleted'):
+        if workout_id is None:
+            return {'token': token, 'reset': True, 'changed': [], 'deleted': []}
+        deleted[workout_id] = is_deleted  # the last change of the workout counts
+
+    competition_points = get_competition_points(competition)
+    changed = get_feed_entries(competition_points, [i for i, is_deleted in deleted.items() if not is_deleted])
+    changed = sorted(changed, key=lambda i: (i['workout__start_datetime'], i['workout']), reverse=True)
+    # a workout without points left the feed as well
+    changed_ids = {i['workout'] for i in changed}
+    return {'token': token, 'reset': False, 'changed': changed, 'deleted': sorted(i for i in deleted if i not in changed_ids)}
+
+
+@app.task()
+def prune_feed_changes():
+    """ delete the feed changes older than FEED_CHANGE_RETENTION_DAYS - the newest row is kept as the watermark """
+    FeedChange = apps.get_model('competition', 'FeedChange')
+    newest = FeedChange.objects.order_by('-id').values_list('id', flat=True).first()
+    if newest is None:
+        return 0
+    deleted, _ = FeedChange.objects.filter(created_datetime__lt=timezone.now() - datetime.timedelta(days=FEED_CHANGE_RETENTION_DAYS), id__lt=newest).delete()
+    print(f"Pruned {deleted} feed changes")
+    return deleted
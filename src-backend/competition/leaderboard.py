@@ -0,0 +1,282 @@
+"""Leaderboards kept in sorted sets - rank lookups, top N and "around me" windows without building the full stats"""
+
+import datetime, threading
+
+from django.apps import apps
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+
+from competition.push import has_competition_subscribers, publish_competition_event
+
+LEADERBOARD_BOARDS = ['all', '7d', 'team']
+LEADERBOARD_WEEK_TIMEOUT = 60 * 60 * 24 * 8  # seconds - the 7d board of a week is only read during the following week
+
+
+class RedisLeaderboardStore:
+    """Sorted sets in the Redis of the django-redis cache - rank lookups are O(log n)"""
+
+    def __init__(self):
+        from django_redis import get_redis_connection
+        self.redis = get_redis_connection('default')
+
+    def replace(self, key, scores, timeout=None):
+        """ atomically replace the whole board - marks it as built even if it is empty """
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(key)
+        if len(scores) > 0:
+            pipe.zadd(key, {str(member): float(score) for member, score in scores.items()})
+        pipe.set(f'{key}:built', 1, ex=timeout)
+        if timeout is not None and len(scores) > 0:
+            pipe.expire(key, timeout)
+        pipe.execute()
+
+    def update(self, key, scores, remove=()):
+        """ set the score of the given members and drop the removed ones """
+        pipe = self.redis.pipeline(transaction=True)
+        if len(scores) > 0:
+            pipe.zadd(key, {str(member): float(score) for member, score in scores.items()})
+        if len(remove) > 0:
+            pipe.zrem(key, *[str(i) for i in remove])
+        pipe.execute()
+
+    def is_built(self, key):
+        return bool(self.redis.exists(f'{key}:built'))
+
+    def size(self, key):
+        return self.redis.zcard(key)
+
+    def score(self, key, member):
+        return self.redis.zscore(key, str(member))
+
+    def position(self, key, member):
+        """ 0-based index in the descending order - None if not on the board """
+        return self.redis.zrevrank(key, str(member))
+
+    def count_above(self, key, score):
+        """ number of members with a strictly higher score """
+        return self.redis.zcount(key, f'({score}', '+inf')
+
+    def range(self, key, start, stop):
+        """ [(member, score)] from index start to stop (inclusive) in descending order """
+        return [(int(member), score) for member, score in self.redis.zrevrange(key, start, stop, withscores=True)]
+
+
+class MemoryLeaderboardStore:
+    """In-process stand-in for RedisLeaderboardStore - for tests and DEBUG runs with the local memory cache.
+
+    Boards are not shared between processes, i.e. a celery worker and the web server each have their own.
+    """
+
+    def __init__(self):
+        self.boards = {}
+        self.built = set()
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.boards = {}
+            self.built = set()
+
+    def replace(self, key, scores, timeout=None):
+        with self.lock:
+            self.boards[key] = {int(member): float(score) for member, score in scores.items()}
+            self.built.add(key)
+
+    def update(self, key, scores, remove=()):
+        with self.lock:
+            board = self.boards.setdefault(key, {})
+            board.update({int(member): float(score) for member, score in scores.items()})
+            for member in remove:
+                board.pop(int(member), None)
+
+    def is_built(self, key):
+        return key in self.built
+
+    def size(self, key):
+        return len(self.boards.get(key, {}))
+
+    def score(self, key, member):
+        return self.boards.get(key, {}).get(int(member))
+
+    def _sorted(self, key):
+        # same order as ZREVRANGE - score descending, equal scores by member descending
+        return sorted(self.boards.get(key, {}).items(), key=lambda i: (i[1], str(i[0])), reverse=True)
+
+    def position(self, key, member):
+        for idx, (i, _) in enumerate(self._sorted(key)):
+            if i == int(member):
+                return idx
+        return None
+
+    def count_above(self, key, score):
+        return sum(1 for i in self.boards.get(key, {}).values() if i > score)
+
+    def range(self, key, start, stop):
+        return self._sorted(key)[max(0, start):stop + 1]
+
+
+_memory_store = MemoryLeaderboardStore()
+
+
+def get_leaderboard_store():
+    """ Redis sorted sets if the cache is django-redis, the in-process stand-in otherwise """
+    if settings.CACHES['default']['BACKEND'].startswith('django_redis'):
+        return RedisLeaderboardStore()
+    return _memory_store
+
+
+def _last_week():
+    """ monday and sunday of the last completed week - the 7d period of the competition stats """
+    today = timezone.localdate()
+    last_sunday = today - datetime.timedelta(days=today.weekday() + 1) if today.weekday() != 6 else today
+    return last_sunday - datetime.timedelta(days=6), last_sunday
+
+
+def leaderboard_key(competition_id, board):
+    if board == '7d':
+        return f'leaderboard:{competition_id}:7d:{_last_week()[0].isoformat()}'
+    return f'leaderboard:{competition_id}:{board}'
+
+
+def _user_totals(competition_id, user_ids=None, last_seven_days=False):
+    DailyPoints = apps.get_model('competition', 'DailyPoints')
+    daily_points = DailyPoints.objects.filter(competition_id=competition_id)
+    if user_ids is not None:
+        daily_points = daily_points.filter(user__in=user_ids)
+    if last_seven_days:
+        monday, sunday = _last_week()
+        daily_points = daily_points.filter(local_date__gte=monday, local_date__lte=sunday)
+    # rounded to the cent of the rollup - float noise of the database sum must not break ties
+    return {i['user']: round(float(i['total']), 2) for i in daily_points.values('user').annotate(total=Sum('points_capped_sum')).order_by()}
+
+
+def _team_totals(competition_id):
+    """ team score like in the stats - total of the members divided by the number of active members """
+    Team = apps.get_model('competition', 'Team')
+    total_user = _user_totals(competition_id)
+    total_team = {}
+    for user_id, team_id in Team.user.through.objects.filter(team__competition=competition_id).values_list('customuser', 'team'):
+        if user_id in total_user:
+            total, active = total_team.get(team_id, (0, 0))
+            total_team[team_id] = (total + total_user[user_id], active + (1 if total_user[user_id] > 0 else 0))
+    return {team_id: round(total / max(1, active), 2) for team_id, (total, active) in total_team.items()}
+
+
+def rebuild_leaderboards(competition_id, boards=None):
+    """ rebuild the boards of the competition from the DailyPoints rollup """
+    store = get_leaderboard_store()
+    for board in boards or LEADERBOARD_BOARDS:
+        if board == 'team':
+            scores = _team_totals(competition_id)
+        else:
+            scores = _user_totals(competition_id, last_seven_days=board == '7d')
+        store.replace(leaderboard_key(competition_id, board), scores, timeout=LEADERBOARD_WEEK_TIMEOUT if board == '7d' else None)
+
+
+def _member_ranks(store, key, members):
+    """ {member: (points, rank)} of the given members - (None, None) if not on the board """
+    result = {}
+    for member in members:
+        score = store.score(key, member)
+        result[member] = (None, None) if score is None else (round(score, 2), store.count_above(key, score) + 1)
+    return result
+
+
+def _publish_rank_changes(competition_id, board, before, after):
+    """ push the members whose points or rank changed - the members they passed move down by one without an entry of their own """
+    changes = [
+        {'id': member, 'points': after[member][0], 'rank': after[member][1], 'previous_points': before.get(member, (None, None))[0], 'previous_rank': before.get(member, (None, None))[1]}
+        for member in sorted(after, key=lambda i: (after[i][1] is None, after[i][1] or 0))
+        if after[member] != before.get(member, (None, None))
+    ]
+    if len(changes) > 0:
+        publish_competition_event(competition_id, 'leaderboard', {'board': board, 'reset': False, 'changes': changes})
+
+
+def update_user_leaderboards(competition_id, user_ids=None):
+    """ update the scores of the given users (and so of their teams) after their DailyPoints changed - None for all users
+
+    Clients subscribed to the competition get the rank changes of the users pushed.
+    """
+    store = get_leaderboard_store()
+    if user_ids is None:
+        rebuild_leaderboards(competition_id)
+        if has_competition_subscribers(competition_id):
+            for board in LEADERBOARD_BOARDS:
+                publish_competition_event(competition_id, 'leaderboard', {'board': board, 'reset': True, 'changes': []})
+        return
+
+    user_ids = [getattr(i, 'pk', i) for i in user_ids]
+    publish = has_competition_subscribers(competition_id)
+    for board in ['all', '7d']:
+        key = leaderboard_key(competition_id, board)
+        if not store.is_built(key):
+            rebuild_leaderboards(competition_id, boards=[board])
+            if publish:
+                publish_competition_event(competition_id, 'leaderboard', {'board': board, 'reset': True, 'changes': []})
+            continue
+        before = _member_ranks(store, key, user_ids) if publish else None
+        scores = _user_totals(competition_id, user_ids=user_ids, last_seven_days=board == '7d')
+        store.update(key, scores, remove=[i for i in user_ids if i not in scores])
+        if publish:
+            _publish_rank_changes(competition_id, board, before, _member_ranks(store, key, user_ids))
+    update_team_leaderboard(competition_id)
+
+
+def update_team_leaderboard(competition_id):
+    """ recompute the team board - after team memberships or member scores changed """
+    store = get_leaderboard_store()
+    key = leaderboard_key(competition_id, 'team')
+    publish = has_competition_subscribers(competition_id)
+    built = store.is_built(key)
+    before = {member: score for member, score in store.range(key, 0, store.size(key) - 1)} if publish and built else {}
+    rebuild_leaderboards(competition_id, boards=['team'])
+    if publish and not built:
+        publish_competition_event(competition_id, 'leaderboard', {'board': 'team', 'reset': True, 'changes': []})
+    elif publish:
+        members = set(before) | {member for member, _ in store.range(key, 0, store.size(key) - 1)}
+        before = {member: (round(score, 2), sum(1 for i in before.values() if i > score) + 1) for member, score in before.items()}
+        _publish_rank_changes(competition_id, 'team', before, _member_ranks(store, key, members))
+
+
+def _ranked(store, key, start, stop):
+    """ entries from index start to stop with tie-aware ranks - equal points share the rank of the first of them """
+    entries = store.range(key, start, stop)
+    result = []
+    for idx, (member, score) in enumerate(entries, start=max(0, start)):
+        if len(result) == 0:
+            rank = store.count_above(key, score) + 1
+        elif score != result[-1]['points']:
+            rank = idx + 1
+        else:
+            rank = result[-1]['rank']
+        result.append({'id': member, 'points': score, 'rank': rank})
+    return result
+
+
+def get_leaderboard(competition_id, board='all', member=None, top=10, around=2):
+    """ Top of the leaderboard plus the rank of one member and the entries around them.
+
+    Args:
+        competition_id: competition of the board
+        board: 'all' (all-time), '7d' (last completed week) or 'team'
+        member: user id (team id for the team board) to return the rank and window of - None to skip
+        top: number of leading entries
+        around: number of entries above and below the member
+    Returns: dict with size, top, me and around - entries are {'id', 'points', 'rank'}
+    """
+    store = get_leaderboard_store()
+    key = leaderboard_key(competition_id, board)
+    if not store.is_built(key):
+        rebuild_leaderboards(competition_id, boards=[board])
+
+    result = {'board': board, 'size': store.size(key), 'top': _ranked(store, key, 0, top - 1) if top > 0 else [], 'me': None, 'around': []}
+    if member is not None:
+        position = store.position(key, member)
+        if position is None:
+            result['me'] = {'id': member, 'points': None, 'rank': None}
+        else:
+            result['around'] = _ranked(store, key, max(0, position - around), position + around)
+            result['me'] = next(i for i in result['around'] if i['id'] == int(member))
+    return result
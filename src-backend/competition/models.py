@@ -1,7 +1,8 @@
 import time, re, random
 from decimal import Decimal
 
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.core.validators import MinLengthValidator, RegexValidator
@@ -9,7 +10,9 @@ from django.core.exceptions import ValidationError
 
 from workouts.models import Workout, SPORT_TYPE_GROUPS, SPORT_TYPES
 from custom_user.models import CustomUser
-from .scorer import trigger_goal_change, trigger_competition_change
+from .scorer import trigger_goal_change, trigger_goal_delete, trigger_competition_change
+from .stats import bump_competition_stats_version
+from .leaderboard import update_team_leaderboard
 
 # Create your models here.
 COMPETITION_METRCIS = [
@@ -133,6 +136,19 @@ class Team(models.Model):
         """str print-out of model entry"""
         return f"{self.competition} - Team: {self.name}"
 
+    def save(self, *args, **kwargs):
+        """ teams are part of the competition stats """
+        super().save(*args, **kwargs)
+        bump_competition_stats_version(self.competition_id)
+
+    def delete(self, *args, **kwargs):
+        """ teams are part of the competition stats """
+        competition_id = self.competition_id
+        result = super().delete(*args, **kwargs)
+        bump_competition_stats_version(competition_id)
+        transaction.on_commit(lambda: update_team_leaderboard(competition_id))
+        return result
+
 
 class ActivityGoal(models.Model):
     """Activity goals in Competition - user will earn points for each rule/category"""
@@ -189,6 +205,12 @@ class ActivityGoal(models.Model):
         )
         self._original = self._dict()  # reset
 
+    def delete(self, *args, **kwargs):
+        """ remove the points of the deleted goal from the daily rollup """
+        result = super().delete(*args, **kwargs)
+        trigger_goal_delete(instance=self)
+        return result
+
 
 
 
@@ -225,7 +247,56 @@ class Points(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['goal', 'award', 'workout'], name='unique_goal_award_workout')
         ]
+        indexes = [
+            models.Index(fields=['workout', '-id'], name='points_workout_id_idx'),  # the points list - by workout start, then per workout
+        ]
+
+    def __str__(self):
+        """str print-out of model entry"""
+        return f"{self.award if self.goal is None else self.goal} - {self.points_raw}"
+
+
+class DailyPoints(models.Model):
+    """Daily rollup of the Points per competition and user - refreshed by the point recalc, read by the competition stats"""
+
+    competition = models.ForeignKey(Competition, on_delete=models.CASCADE, null=False, blank=False)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=False, blank=False)
+    local_date = models.DateField(null=False)  # workout day in the configured TIME_ZONE
+
+    points_capped_sum = models.DecimalField(null=False, default=0, max_digits=12, decimal_places=2)
+    points_raw_sum = models.DecimalField(null=False, default=0, max_digits=12, decimal_places=2)
+    workout_count = models.IntegerField(null=False, default=0)
+
+    class Meta:
+        verbose_name = "Daily Points"
+        verbose_name_plural = "Daily Points"
+        constraints = [
+            models.UniqueConstraint(fields=['competition', 'user', 'local_date'], name='unique_competition_user_local_date')
+        ]
+        indexes = [
+            models.Index(fields=['competition', 'local_date', 'user'], name='daily_points_comp_day_user_idx'),  # the stats read them in this order
+        ]
+
+    def __str__(self):
+        """str print-out of model entry"""
+        return f"{self.competition} - {self.user} - {self.local_date}: {self.points_capped_sum}"
+
+
+class FeedChange(models.Model):
+    """Change log of the competition feeds - the id is the change token clients ask for the delta since"""
+
+    id = models.BigAutoField(primary_key=True)
+    competition = models.ForeignKey(Competition, on_delete=models.CASCADE, null=False, blank=False)
+    workout_id = models.IntegerField(null=True, blank=True)  # no foreign key - tombstones outlive the workout / None means the whole feed changed
+    deleted = models.BooleanField(default=False, null=False)  # tombstone - the workout left the feed
+    created_datetime = models.DateTimeField(default=timezone.now, null=False)  # set at the insert after the commit - not when the change was recorded
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['competition', 'id'], name='feed_change_comp_id_idx'),
+            models.Index(fields=['created_datetime'], name='feed_change_created_idx'),
+        ]
 
     def __str__(self):
         """str print-out of model entry"""
-        return f"{self.award if self.goal is None else self.goal} - {self.points_raw}"
\ No newline at end of file
+        return f"{self.competition} - {'RESET' if self.workout_id is None else self.workout_id}{' (deleted)' if self.deleted else ''}"
@@ -0,0 +1,123 @@
+"""Server-push of competition events - small diffs of the leaderboards and the feed sent to subscribed clients (SSE)"""
+
+import json, queue, threading, time
+
+from django.conf import settings
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class RedisEventChannel:
+    """Redis pub/sub of the django-redis cache - events reach the subscribers of all web workers"""
+
+    def __init__(self):
+        from django_redis import get_redis_connection
+        self.redis = get_redis_connection('default')
+
+    def publish(self, channel, message):
+        self.redis.publish(channel, message)
+
+    def has_subscribers(self, channel):
+        return self.redis.pubsub_numsub(channel)[0][1] > 0
+
+    def subscribe(self, channel):
+        return RedisSubscription(self.redis, channel)
+
+
+class RedisSubscription:
+    def __init__(self, redis, channel):
+        self.pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(channel)
+
+    def get(self, timeout):
+        """ next message - None if there was none within timeout seconds """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            message = self.pubsub.get_message(timeout=max(0, deadline - time.monotonic()))
+            if message is not None and message['type'] == 'message':
+                return message['data'].decode() if isinstance(message['data'], bytes) else message['data']
+        return None
+
+    def close(self):
+        self.pubsub.close()
+
+
+class MemoryEventChannel:
+    """In-process stand-in for RedisEventChannel - for tests and DEBUG runs with the local memory cache.
+
+    Events only reach subscribers of the same process, i.e. changes made by a celery worker are not pushed.
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscriber_lst = list(self.subscribers.get(channel, []))
+        for subscriber in subscriber_lst:
+            subscriber.put(message)
+
+    def has_subscribers(self, channel):
+        return len(self.subscribers.get(channel, [])) > 0
+
+    def subscribe(self, channel):
+        return MemorySubscription(self, channel)
+
+
+class MemorySubscription:
+    def __init__(self, event_channel, channel):
+        self.event_channel = event_channel
+        self.channel = channel
+        self.queue = queue.Queue()
+        with event_channel.lock:
+            event_channel.subscribers.setdefault(channel, []).append(self.queue)
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        with self.event_channel.lock:
+            subscriber_lst = self.event_channel.subscribers.get(self.channel, [])
+            if self.queue in subscriber_lst:
+                subscriber_lst.remove(self.queue)
+            if len(subscriber_lst) == 0:
+                self.event_channel.subscribers.pop(self.channel, None)
+
+
+_memory_channel = MemoryEventChannel()
+
+
+def get_event_channel():
+    """ Redis pub/sub if the cache is django-redis, the in-process stand-in otherwise """
+    if settings.CACHES['default']['BACKEND'].startswith('django_redis'):
+        return RedisEventChannel()
+    return _memory_channel
+
+
+def competition_channel(competition_id):
+    return f'competition_events:{competition_id}'
+
+
+def format_event(event_type, data):
+    """ server-sent event frame - data is serialized like the REST responses """
+    return f'event: {event_type}\ndata: {json.dumps(data, cls=JSONEncoder)}\n\n'
+
+
+def has_competition_subscribers(competition_id):
+    """ True if a client listens to the events of the competition - to skip building events nobody receives """
+    try:
+        return get_event_channel().has_subscribers(competition_channel(competition_id))
+    except Exception as e:
+        print(f"Could not check the event subscribers of competition {competition_id}: {e}")
+        return False
+
+
+def publish_competition_event(competition_id, event_type, data):
+    """ push an event to all clients subscribed to the competition - lost events are never fatal, clients resync on reconnect """
+    try:
+        get_event_channel().publish(competition_channel(competition_id), format_event(event_type, data))
+    except Exception as e:
+        print(f"Could not publish {event_type} event of competition {competition_id}: {e}")
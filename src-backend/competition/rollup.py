@@ -0,0 +1,88 @@
+"""Daily points rollup - per competition, user and local day totals the competition stats are read from"""
+
+import datetime
+from decimal import Decimal
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Sum, Count, Q
+from django.db.models.functions import TruncDate, Round
+from django.utils import timezone
+
+from competition.stats import bump_competition_stats_version
+from competition.leaderboard import update_user_leaderboards
+
+CENT = Decimal('0.01')
+
+
+def _local_midnight(date):
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+
+
+def local_date(dt):
+    """ day of the workout in the configured TIME_ZONE - the day the stats show it on """
+    return timezone.localtime(dt).date()
+
+
+def get_competition_points(competition):
+    """ Points of the competition's goals and awards - filtered by their (few) ids, so the lookup uses the goal / award
+    indexes of the points instead of joining every point to its goal and award """
+    Points = apps.get_model('competition', 'Points')
+    ActivityGoal = apps.get_model('competition', 'ActivityGoal')
+    Award = apps.get_model('competition', 'Award')
+    competition_id = getattr(competition, 'pk', competition)
+    goal_ids = list(ActivityGoal.objects.filter(competition_id=competition_id).values_list('pk', flat=True))
+    award_ids = list(Award.objects.filter(competition_id=competition_id).values_list('pk', flat=True))
+    return Points.objects.filter(Q(goal__in=goal_ids) | Q(award__in=award_ids))
+
+
+def refresh_daily_points(competition, users=None, start_date=None, end_date=None):
+    """ Rebuild the DailyPoints rows of the competition from its Points.
+
+    Args:
+        competition: competition (or id) to refresh
+        users: user ids (or users) to refresh - None for all
+        start_date: first local day to refresh - None from the beginning
+        end_date: last local day to refresh - None until the end
+    Returns: number of rollup rows written
+    """
+    DailyPoints = apps.get_model('competition', 'DailyPoints')
+    competition_id = getattr(competition, 'pk', competition)
+    user_ids = None if users is None else [getattr(i, 'pk', i) for i in users]
+
+    points_lst = get_competition_points(competition_id)
+    rollup_lst = DailyPoints.objects.filter(competition_id=competition_id)
+    if user_ids is not None:
+        points_lst = points_lst.filter(workout__user__in=user_ids)
+        rollup_lst = rollup_lst.filter(user__in=user_ids)
+    if start_date is not None:
+        points_lst = points_lst.filter(workout__start_datetime__gte=_local_midnight(start_date))
+        rollup_lst = rollup_lst.filter(local_date__gte=start_date)
+    if end_date is not None:
+        points_lst = points_lst.filter(workout__start_datetime__lt=_local_midnight(end_date + datetime.timedelta(days=1)))
+        rollup_lst = rollup_lst.filter(local_date__lte=end_date)
+
+    # the points are written with 2 decimal places - rounded again per point for rows of older versions that SQLite
+    # stored unrounded, so the daily sum is the sum of the points as they are read
+    daily_lst = (
+        points_lst
+        .annotate(local_date=TruncDate('workout__start_datetime'))
+        .values('workout__user', 'local_date')
+        .annotate(points_capped_sum=Sum(Round('points_capped', 2)), points_raw_sum=Sum(Round('points_raw', 2)), workout_count=Count('workout', distinct=True))
+        .order_by()
+    )
+    with transaction.atomic():
+        rollup_lst.delete()
+        DailyPoints.objects.bulk_create([
+            DailyPoints(
+                competition_id=competition_id,
+                user_id=i['workout__user'],
+                local_date=i['local_date'],
+                points_capped_sum=Decimal(i['points_capped_sum'] or 0).quantize(CENT),
+                points_raw_sum=Decimal(i['points_raw_sum'] or 0).quantize(CENT),
+                workout_count=i['workout_count'],
+            )
+            for i in daily_lst
+        ], batch_size=1_000)
+        transaction.on_commit(lambda: (update_user_leaderboards(competition_id, user_ids), bump_competition_stats_version(competition_id)))
+    return len(daily_lst)
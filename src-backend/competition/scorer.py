@@ -1,10 +1,21 @@
-import datetime
+import datetime, math
+from decimal import Decimal
 from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Value, FloatField, DecimalField, Subquery, OuterRef, Min, Max
+from django.db.models.functions import Cast, Coalesce, Extract, Round, Floor
 
-from custom_user.point_recalc import trigger_recalc_points
+from custom_user.point_recalc import trigger_recalc_points, enqueue_recalc, enqueue_recalc_many
+from competition.rollup import refresh_daily_points
+from competition.leaderboard import update_user_leaderboards
+from competition.stats import bump_competition_stats_version
+from competition.feed import record_feed_changes, record_feed_reset
+from workout_challenge.conditional import bump_data_versions
 
 
 def _calculate_points_raw(goal, workout, user):
+    """ points_raw of the workout for the goal - rounded to 2 decimal places the same way _points_raw_expression does it """
     goal_metric = goal.metric
     goal_target = float(goal.goal)
 
@@ -30,22 +41,132 @@ def _calculate_points_raw(goal, workout, user):
             points = 0
         else:
             points = float(workout.kcal) * 4.18 / (goal_target * float(user.scaling_kcal))
-    return points * 100
+    # round half up in float arithmetic - the database does exactly the same operations on the same doubles
+    return Decimal(math.floor(points * 100 * 100 + 0.5)).scaleb(-2)
+
+
+def _points_raw_expression(goal, scaling_kcal=None, scaling_distance=None):
+    """ _calculate_points_raw as a database expression on the Workout fields - no scaling given uses the workout user's factors """
+    goal_metric = goal.metric
+    goal_target = float(goal.goal)
+    scaling_kcal = Cast('user__scaling_kcal', FloatField()) if scaling_kcal is None else Value(float(scaling_kcal))
+    scaling_distance = Cast('user__scaling_distance', FloatField()) if scaling_distance is None else Value(float(scaling_distance))
+
+    if goal_metric == 'min':
+        # SQLite stores durations as microseconds, PostgreSQL as interval
+        if settings.DATABASES.get('default', {}).get('ENGINE') == 'django.db.backends.sqlite3':
+            duration_seconds = Cast('duration', FloatField()) / Value(1_000_000.0)
+        else:
+            duration_seconds = Cast(Extract('duration', 'epoch'), FloatField())
+        points = duration_seconds / Value(60.0) / Value(goal_target)
+    elif goal_metric == 'num':
+        points = Value(1 / goal_target)
+    elif goal_metric == 'kcal':
+        points = Coalesce(Cast('kcal', FloatField()), Value(0.0)) / (Value(goal_target) * scaling_kcal)
+    elif goal_metric == 'km':
+        points = Coalesce(Cast('distance', FloatField()), Value(0.0)) / (Value(goal_target) * scaling_distance)
+    elif goal_metric == 'kj':
+        points = Coalesce(Cast('kcal', FloatField()), Value(0.0)) * Value(4.18) / (Value(goal_target) * scaling_kcal)
+    points = points * Value(100.0)
+
+    # stored with 2 decimal places like the Points.points_raw field - rounded half up like _calculate_points_raw
+    points = Floor(points * Value(100.0) + Value(0.5)) / Value(100.0)
+    if settings.DATABASES.get('default', {}).get('ENGINE') == 'django.db.backends.sqlite3':
+        return Round(points, 2, output_field=DecimalField(max_digits=10, decimal_places=2))
+    return Cast(points, DecimalField(max_digits=10, decimal_places=2))
+
+
+def _update_points_raw(points_lst, goal, scaling_kcal=None, scaling_distance=None):
+    """ recompute points_raw (and reset points_capped) of the goal's points in a single UPDATE - returns the affected time range """
+    Workout = apps.get_model('workouts', 'Workout')
+    points_lst = points_lst.filter(goal=goal)
+    affected = points_lst.aggregate(start_datetime=Min('workout__start_datetime'), end_datetime=Max('workout__start_datetime'))
+
+    # UPDATE can't reference joined fields - compute the workout based value in a correlated subquery
+    points_raw = Subquery(
+        Workout.objects
+        .filter(pk=OuterRef('workout'))
+        .values(points_raw=_points_raw_expression(goal, scaling_kcal=scaling_kcal, scaling_distance=scaling_distance))[:1]
+    )
+    points_lst.update(points_raw=points_raw, points_capped=points_raw)
+    return affected['start_datetime'], affected['end_datetime']
+
+
+POINTS_BULK_CREATE_BATCH_SIZE = 1_000
+
+
+def _create_points_bulk(goal_lst, workout_lst):
+    """ Create the points entries of every (goal, workout) pair in bulk and queue one recalc per (user, goal).
+
+    Steps workouts only count for goals with count_steps_as_walks. Pairs that already have points are skipped.
+
+    Returns: number of created points entries
+    """
+    Points = apps.get_model('competition', 'Points')
+    goal_lst = list(goal_lst)
+    if len(goal_lst) == 0:
+        return 0
+    workout_lst = workout_lst.select_related('user').order_by('pk')
+
+    # unique_goal_award_workout doesn't catch duplicates with a NULL award - filter the existing pairs up front
+    existing = set(
+        Points.objects
+        .filter(goal__in=goal_lst, workout__in=workout_lst.values('pk'), award__isnull=True)
+        .values_list('goal_id', 'workout_id')
+    )
+
+    created = 0
+    points_lst = []
+    recalc_lst = []
+    for workout in workout_lst.iterator(chunk_size=POINTS_BULK_CREATE_BATCH_SIZE):
+        for goal in goal_lst:
+            if (goal.pk, workout.pk) in existing or (workout.sport_type == 'Steps' and not goal.count_steps_as_walks):
+                continue
+            points = _calculate_points_raw(goal=goal, workout=workout, user=workout.user)
+            points_lst.append(Points(goal=goal, workout=workout, points_raw=points, points_capped=points))
+            recalc_lst.append((workout.user_id, goal.pk, workout.start_datetime, workout.start_datetime))
+        if len(points_lst) >= POINTS_BULK_CREATE_BATCH_SIZE:
+            Points.objects.bulk_create(points_lst, batch_size=POINTS_BULK_CREATE_BATCH_SIZE, ignore_conflicts=True)
+            created += len(points_lst)
+            points_lst = []
+    Points.objects.bulk_create(points_lst, batch_size=POINTS_BULK_CREATE_BATCH_SIZE, ignore_conflicts=True)
+    created += len(points_lst)
+
+    enqueue_recalc_many(recalc_lst)
+    return created
+
+
+def workouts_version_key(user_id):
+    """ data version of the workouts of the user - for ETag / Last-Modified of the workout list """
+    return f'workouts_version_{user_id}'
+
+
+def _bump_workout_versions(instance):
+    """ the workout is shown in the workout list of its user and the feed of all their competitions - invalidate them once the change is committed """
+    competition_ids = list(instance.user.my_competitions.values_list('pk', flat=True))
+    user_id = instance.user_id
+    transaction.on_commit(lambda: (bump_competition_stats_version(competition_ids), bump_data_versions([workouts_version_key(user_id)])))
+
+
+def _record_workout_feed_change(instance, deleted=False):
+    """ log the workout as changed (or removed) in the feed of every competition it has points in """
+    Points = apps.get_model('competition', 'Points')
+    competition_ids = {j for i in Points.objects.filter(workout=instance).values_list('goal__competition', 'award__competition') for j in i if j is not None}
+    record_feed_changes([(i, instance.pk) for i in competition_ids], deleted=deleted)
 
 
 def trigger_workout_delete(instance):
-    RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
-    for points in instance.points_set.all():
-        RecalcRequest(user=instance.user, goal=points.goal, start_datetime=instance.start_datetime).save()
+    for points in instance.points_set.filter(goal__isnull=False):
+        enqueue_recalc(user=instance.user, goal=points.goal, start_datetime=instance.start_datetime, end_datetime=instance.start_datetime)
     print(f"Workout ({instance.pk}) deletion triggered point cap recalc - after {instance.start_datetime.isoformat()}")
 
+    _record_workout_feed_change(instance, deleted=True)
+    _bump_workout_versions(instance)
     trigger_recalc_points()
 
 
 def trigger_workout_change(instance, new, changes):
 
-    RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
-
     if new:
         # newly created workout - add point entries
         Points = apps.get_model('competition', 'Points')
@@ -55,7 +176,7 @@ def trigger_workout_change(instance, new, changes):
                 if goal.count_steps_as_walks or instance.sport_type != 'Steps':
                     points = _calculate_points_raw(goal=goal, workout=instance, user=instance.user)
                     Points(goal=goal, workout=instance, points_raw=points, points_capped=points).save()
-                    RecalcRequest(user=instance.user, goal=goal, start_datetime=start_datetime).save()
+                    enqueue_recalc(user=instance.user, goal=goal, start_datetime=start_datetime, end_datetime=start_datetime)
     else:
         # updated existing workout
         # check if relevant field was changed
@@ -69,106 +190,138 @@ def trigger_workout_change(instance, new, changes):
         if 'distance' in changes:
             metric_change_lst.extend(['km'])
 
-        recalc_start_datetime = changes.get('start_datetime', [instance.start_datetime])[0]
+        # a moved workout affects the weeks of its old and its new start_datetime
+        recalc_start_datetime = min(changes.get('start_datetime', [instance.start_datetime]))
+        recalc_end_datetime = max(changes.get('start_datetime', [instance.start_datetime]))
         for recalc_points, recalc_goal in [(i, i.goal) for i in instance.points_set.all() if i.goal.metric in metric_change_lst]:
             points = _calculate_points_raw(goal=recalc_goal, workout=instance, user=instance.user)
             setattr(recalc_points, 'points_raw', points)
             setattr(recalc_points, 'points_capped', points)
             recalc_points.save()
-            RecalcRequest(user=instance.user, goal=recalc_goal, start_datetime=recalc_start_datetime).save()
+            enqueue_recalc(user=instance.user, goal=recalc_goal, start_datetime=recalc_start_datetime, end_datetime=recalc_end_datetime)
 
     print(f"Workout ({instance.pk}) update triggered point cap recalc - {'NEW ENTRY' if new else 'EXISTING CHANGED'}" + ("" if new else f" - {changes}"))
 
+    _record_workout_feed_change(instance)
+    _bump_workout_versions(instance)
     trigger_recalc_points()
 
 
-def trigger_goal_change(instance, new, changes):
-    RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
+def trigger_workouts_bulk_create(user, workout_lst):
+    """ trigger_workout_change of many new workouts of the user at once - points in bulk and one recalc request per goal """
+    if len(workout_lst) == 0:
+        return
     Points = apps.get_model('competition', 'Points')
     Workout = apps.get_model('workouts', 'Workout')
+    workout_ids = [i.pk for i in workout_lst]
+    start_datetime = min(i.start_datetime for i in workout_lst)
+    end_datetime = max(i.start_datetime for i in workout_lst)
+
+    # _create_points_bulk merges the recalc requests of all the workouts into one per (user, goal)
+    for competition in user.my_competitions.filter(start_date__lte=end_datetime, end_date__gte=start_datetime - datetime.timedelta(days=1)):
+        workout_qs = Workout.objects.filter(pk__in=workout_ids, start_datetime__gte=competition.start_date, start_datetime__lte=competition.end_date + datetime.timedelta(days=1))
+        _create_points_bulk(competition.activitygoal_set.all(), workout_qs)
+
+    print(f"User ({user.pk}) bulk created {len(workout_lst)} workouts triggering point cap recalc")
+
+    record_feed_changes(list(Points.objects.filter(workout__in=workout_ids, goal__isnull=False).values_list('goal__competition', 'workout').distinct()))
+    _bump_workout_versions(workout_lst[0])
+    trigger_recalc_points()
+
+
+def trigger_goal_change(instance, new, changes):
+    Workout = apps.get_model('workouts', 'Workout')
+    bump_competition_stats_version(instance.competition_id)  # goals are part of the stats
+    record_feed_reset(instance.competition_id)  # points of all workouts can change
     if new:
         # newly created goal - add point entries
         workout_lst = Workout.objects.filter(start_datetime__gte=instance.competition.start_date, start_datetime__lte=instance.competition.end_date + datetime.timedelta(days=1), user__in=instance.competition.user.all())
-        if instance.count_steps_as_walks is False:
-            workout_lst = workout_lst.exclude(sport_type='Steps')
-        for workout in workout_lst:
-            points = _calculate_points_raw(goal=instance, workout=workout, user=workout.user)
-            Points(goal=instance, workout=workout, points_raw=points, points_capped=points).save()
-            RecalcRequest(user=workout.user, goal=instance, start_datetime=workout.start_datetime).save()
+        _create_points_bulk([instance], workout_lst)
     else:
         # updated existing workout
         # check if relevant field was changed
         _ = changes.pop('name', None)
         if len(changes) > 0:
+            if 'goal' in changes or 'metric' in changes:
+                _update_points_raw(instance.points_set.all(), instance)
             if 'count_steps_as_walks' in changes:
                 # add steps
                 if changes['count_steps_as_walks'][1]:
-                    for workout in Workout.objects.filter(start_datetime__gte=instance.competition.start_date, start_datetime__lte=instance.competition.end_date + datetime.timedelta(days=1), user__in=instance.competition.user.all(), sport_type='Steps'):
-                        points = _calculate_points_raw(goal=instance, workout=workout, user=workout.user)
-                        Points(goal=instance, workout=workout, points_raw=points, points_capped=points).save()
+                    _create_points_bulk([instance], Workout.objects.filter(start_datetime__gte=instance.competition.start_date, start_datetime__lte=instance.competition.end_date + datetime.timedelta(days=1), user__in=instance.competition.user.all(), sport_type='Steps'))
                 # remove steps
                 else:
-                    for point in instance.points_set.filter(workout__sport_type='Steps'):
-                        point.delete()
-            for user in instance.competition.user.all():
-                RecalcRequest(user=user, goal=instance, start_datetime=instance.competition.start_date).save()
+                    instance.points_set.filter(workout__sport_type='Steps').delete()
+            enqueue_recalc_many([(user, instance, instance.competition.start_date, None) for user in instance.competition.user.all()])
 
     trigger_recalc_points()
 
 
+def trigger_goal_delete(instance):
+    # the points of the goal are gone with it - rebuild the competition's daily rollup without them
+    refresh_daily_points(instance.competition_id)
+    record_feed_reset(instance.competition_id)
+    print(f"Goal ({instance.pk}) deletion refreshed the daily points of competition {instance.competition_id}")
+
+
 def trigger_competition_change(instance, new, changes):
     Points = apps.get_model('competition', 'Points')
-    RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
     Workout = apps.get_model('workouts', 'Workout')
 
+    bump_competition_stats_version(instance.pk)  # name, dates etc. are part of the stats
+
     # newly created competitions are ignored as only relevant if new goals are created
     # only catching changes of the start_date and end_date below
 
+    if 'start_date' in changes or 'end_date' in changes:
+        record_feed_reset(instance.pk)  # workouts enter or leave the feed
+
     if 'start_date' in changes:
         if changes['start_date'][1] < changes['start_date'][0]:
             # add point entries before changes['start_date'][0] till [1]
-            for goal in instance.activitygoal_set.all():
-                for workout in Workout.objects.filter(start_datetime__gte=changes['start_date'][1], start_datetime__lte=changes['start_date'][0], user__in=instance.user.all()):
-                    points = _calculate_points_raw(goal=goal, workout=workout, user=workout.user)
-                    Points(goal=goal, workout=workout, points_raw=points, points_capped=points).save()
-                    RecalcRequest(user=workout.user, goal=goal, start_datetime=workout.start_datetime).save()
+            _create_points_bulk(instance.activitygoal_set.all(), Workout.objects.filter(start_datetime__gte=changes['start_date'][1], start_datetime__lte=changes['start_date'][0], user__in=instance.user.all()))
             print(f"Competition ({instance.pk}) start_date was extended from {changes['start_date'][0]} to {changes['start_date'][1]} triggering point cap recalc")
         else:
             # remove point entries before changes['start_date'][1]
             points_to_delete = Points.objects.filter(goal__competition=instance, workout__start_datetime__lt=changes['start_date'][1])
-            CustomUser = apps.get_model('custom_user', 'CustomUser')
-            ActivityGoal = apps.get_model('competition', 'ActivityGoal')
-            for user in [CustomUser.objects.get(pk=i) for i in set(points_to_delete.values_list('workout__user', flat=True))]:
-                for goal in [ActivityGoal.objects.get(pk=i) for i in set(points_to_delete.values_list('goal', flat=True))]:
-                    RecalcRequest(user=user, goal=goal, start_datetime=changes['start_date'][1]).save()
+            enqueue_recalc_many([
+                (user, goal, changes['start_date'][1], None)
+                for user in set(points_to_delete.values_list('workout__user', flat=True))
+                for goal in set(points_to_delete.values_list('goal', flat=True))
+            ])
             points_to_delete.delete()
+            refresh_daily_points(instance, end_date=changes['start_date'][1])
             print(f"Competition ({instance.pk}) start_date was shortened from {changes['start_date'][0]} to {changes['start_date'][1]} triggering point cap recalc")
 
-        trigger_recalc_points
+        trigger_recalc_points()
 
     if 'end_date' in changes:
         if changes['end_date'][1] > changes['end_date'][0]:
             # add point entries after changes['end_date'][0] till [1]
-            for goal in instance.activitygoal_set.all():
-                for workout in Workout.objects.filter(start_datetime__gte=changes['end_date'][0] + datetime.timedelta(days=1), start_datetime__lte=changes['end_date'][1] + datetime.timedelta(days=1), user__in=instance.user.all()):
-                    points = _calculate_points_raw(goal=goal, workout=workout, user=workout.user)
-                    Points(goal=goal, workout=workout, points_raw=points, points_capped=points).save()
-                    RecalcRequest(user=workout.user, goal=goal, start_datetime=workout.start_datetime).save()
+            _create_points_bulk(instance.activitygoal_set.all(), Workout.objects.filter(start_datetime__gte=changes['end_date'][0] + datetime.timedelta(days=1), start_datetime__lte=changes['end_date'][1] + datetime.timedelta(days=1), user__in=instance.user.all()))
             print(f"Competition ({instance.pk}) end_date was extended from {changes['end_date'][0]} to {changes['end_date'][1]} triggering point cap recalc")
         else:
             # remove point entries after changes['end_date'][1]
             Points.objects.filter(goal__competition=instance, workout__start_datetime__gt=changes['end_date'][1]).delete()
+            refresh_daily_points(instance, start_date=changes['end_date'][1])
             print(f"Competition ({instance.pk}) end_date was shortened from {changes['end_date'][0]} to {changes['end_date'][1]} NOT triggering point cap recalc")
 
         trigger_recalc_points()
 
 
+STATS_USER_FIELDS = ['username', 'strava_allow_follow', 'strava_athlete_id']  # user fields shown in the competition stats
+
+
 def trigger_user_change(instance, new, changes):
     Points = apps.get_model('competition', 'Points')
-    RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
+
+    if not new and any(i in changes for i in STATS_USER_FIELDS):
+        bump_competition_stats_version(set(instance.my_competitions.values_list('pk', flat=True)))
+        record_feed_reset(set(instance.my_competitions.values_list('pk', flat=True)))  # the feed shows them as well
 
     # check if user leaves or joins a competition
     if 'my_competitions' in changes:
+        bump_competition_stats_version(set(changes['my_competitions'][0] or []) | set(changes['my_competitions'][1] or []))
+        record_feed_reset(set(changes['my_competitions'][0] or []) | set(changes['my_competitions'][1] or []))
         # instance user obj / changes = pk_set comp id to add/remove
         if changes['my_competitions'][0] is None:
             # add/join competition
@@ -176,15 +329,15 @@ def trigger_user_change(instance, new, changes):
             Competition = apps.get_model('competition', 'Competition')
             for competition in Competition.objects.filter(pk__in=changes['my_competitions'][1]):
                 workout_lst = Workout.objects.filter(user=instance, start_datetime__gte=competition.start_date, start_datetime__lte=competition.end_date + datetime.timedelta(days=1))
-                for goal in competition.activitygoal_set.all():
-                    for workout in workout_lst:
-                        points = _calculate_points_raw(goal=goal, workout=workout, user=instance)
-                        Points(goal=goal, workout=workout, points_raw=points, points_capped=points).save()
-                    RecalcRequest(user=instance, goal=goal, start_datetime=competition.start_date).save()
+                _create_points_bulk(competition.activitygoal_set.all(), workout_lst)
             print(f"User ({instance.pk}) join competitions {changes['my_competitions'][1]} triggering point cap recalc")
         else:
             # remove/leave competition
             Points.objects.filter(goal__competition__in=changes['my_competitions'][0], workout__user=instance).delete()
+            DailyPoints = apps.get_model('competition', 'DailyPoints')
+            DailyPoints.objects.filter(competition__in=changes['my_competitions'][0], user=instance).delete()
+            left_competition_ids = list(changes['my_competitions'][0])
+            transaction.on_commit(lambda: [update_user_leaderboards(i, [instance.pk]) for i in left_competition_ids])
             print(f"User ({instance.pk}) left competitions {changes['my_competitions'][0]} NOT triggering point cap recalc")
 
         trigger_recalc_points()
@@ -192,13 +345,16 @@ def trigger_user_change(instance, new, changes):
     # check if equalizing / scaling factors were changed
     if 'scaling_distance' in changes or 'scaling_kcal' in changes:
         goal_metrics = (['km'] if 'scaling_distance' in changes else []) + (['kcal', 'kj'] if 'scaling_kcal' in changes else [])
-        recalc_points = Points.objects.filter(goal__metric__in=goal_metrics, workout__user=instance)
+        ActivityGoal = apps.get_model('competition', 'ActivityGoal')
+        recalc_points = Points.objects.filter(workout__user=instance)
 
-        for recalc_point in recalc_points:
-            points = _calculate_points_raw(goal=recalc_point.goal, workout=recalc_point.workout, user=instance)
-            setattr(recalc_point, 'points_raw', points)
-            setattr(recalc_point, 'points_capped', points)
-            recalc_point.save()
-            RecalcRequest(user=instance, goal=recalc_point.goal, start_datetime=recalc_point.workout.start_datetime).save()
+        # one UPDATE per affected goal instead of one per points entry
+        for goal in ActivityGoal.objects.filter(metric__in=goal_metrics, points__workout__user=instance).distinct():
+            start_datetime, end_datetime = _update_points_raw(recalc_points, goal, scaling_kcal=instance.scaling_kcal, scaling_distance=instance.scaling_distance)
+            if start_datetime is not None:
+                enqueue_recalc(user=instance, goal=goal, start_datetime=start_datetime, end_datetime=end_datetime)
 
+        bump_competition_stats_version(set(instance.my_competitions.values_list('pk', flat=True)))  # points_raw changed right away
+        record_feed_reset(set(instance.my_competitions.values_list('pk', flat=True)))
         print(f"User ({instance.pk}) scaling factors {goal_metrics} changed triggering point cap recalc")
+        trigger_recalc_points()
@@ -16,9 +16,16 @@ class CompetitionSerializer(serializers.ModelSerializer):
         read_only_fields = ['join_code', 'user', 'user_info']
 
     def get_user_info(self, obj):
-        # Assuming `obj.user` is a ManyToMany or related manager
-        users = obj.user.all().order_by('username') if hasattr(obj.user, 'all') else [obj.user]
-        return [{'id': u.id, 'username': u.username} for u in users]
+        return _user_info(obj)
+
+
+def _user_info(obj):
+    """ members ordered by username - from the members the viewset prefetched in that order, else queried """
+    if 'user' in getattr(obj, '_prefetched_objects_cache', {}):
+        users = obj.user.all()
+    else:
+        users = obj.user.all().order_by('username')
+    return [{'id': u.id, 'username': u.username} for u in users]
 
 
 class TeamSerializer(serializers.ModelSerializer):
@@ -31,12 +38,12 @@ class TeamSerializer(serializers.ModelSerializer):
         read_only_fields = ['user', 'user_info', 'my']
 
     def get_user_info(self, obj):
-        # Assuming `obj.user` is a ManyToMany or related manager
-        users = obj.user.all().order_by('username') if hasattr(obj.user, 'all') else [obj.user]
-        return [{'id': u.id, 'username': u.username} for u in users]
+        return _user_info(obj)
 
     def get_my(self, obj):
-        # if it is the user's team
+        # if it is the user's team - annotated by the viewset
+        if hasattr(obj, 'is_my_team'):
+            return obj.is_my_team
         request = self.context.get('request')
         if request and hasattr(request, "user"):
             return obj.user.filter(id=request.user.id).exists()
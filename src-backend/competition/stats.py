@@ -1,12 +1,12 @@
 import datetime
 
-from django.conf import settings
 from django.apps import apps
+from django.utils import timezone
 from rest_framework.response import Response
 from rest_framework import status
 
-from django.db.models import Sum, Count, ExpressionWrapper, DurationField, F, Q, IntegerField
-from django.db.models.functions import TruncDay, Now, ExtractDay
+from workout_challenge.single_flight import get_or_compute_single_flight
+from workout_challenge.conditional import get_data_versions, bump_data_versions
 
 
 def _add_rank(data, key, enhance_dict, id_field, rank_field='rank', reverse=True):
@@ -32,7 +32,7 @@ def _add_rank(data, key, enhance_dict, id_field, rank_field='rank', reverse=True
 def get_competition_stats(competition, last_seven_days=False):
     CustomUser = apps.get_model('custom_user', 'CustomUser')
     Competition = apps.get_model('competition', 'Competition')
-    Points = apps.get_model('competition', 'Points')
+    DailyPoints = apps.get_model('competition', 'DailyPoints')
     Team = apps.get_model('competition', 'Team')
 
     # Custom query logic
@@ -40,70 +40,33 @@ def get_competition_stats(competition, last_seven_days=False):
         competition_obj = Competition.objects.get(id=competition)
     except Competition.DoesNotExist:
         return Response({"detail": "Competition not found."}, status=status.HTTP_404_NOT_FOUND)
-    all_points = Points.objects.filter(Q(award__competition__id=competition) | Q(goal__competition_id=competition))
 
+    # read the per user and day rollup - the cost depends on members x days, not on the number of workouts
+    daily_points = DailyPoints.objects.filter(competition_id=competition)
     if last_seven_days:
         today = datetime.date.today()
         last_sunday = today - datetime.timedelta(days=today.weekday() + 1) if today.weekday() != 6 else today
         monday_before = last_sunday - datetime.timedelta(days=6)
-        all_points = all_points.filter(workout__start_datetime__gte=monday_before, workout__start_datetime__lt=last_sunday + datetime.timedelta(days=1))
-
-    # For SQLite
-    if settings.DATABASES.get('default', {}).get('ENGINE') == 'django.db.backends.sqlite3':
-        all_points_date = (
-            all_points
-            .annotate(date=TruncDay('workout__start_datetime'))
-            .annotate(tmp_today=TruncDay(Now()))
-            .annotate(tmp_start_date=TruncDay(F('workout__start_datetime')))
-            .annotate(days_ago=ExpressionWrapper((F('tmp_today') - F('tmp_start_date')) / 86_400_000_000, output_field=IntegerField()))
-        )
-    # For Postgres
-    else:
-        all_points_date = (
-            all_points
-            .annotate(date=TruncDay('workout__start_datetime'))
-            .annotate(days_ago_duration=ExpressionWrapper(TruncDay(Now()) - TruncDay(F('workout__start_datetime')), output_field=DurationField()))
-            .annotate(days_ago=ExtractDay(F('days_ago_duration')))
-        )
-    tmp_all = (
-        all_points_date
-        .values('days_ago')
-        .annotate(total=Sum('points_capped'))
-        .values('days_ago', 'total')
-        .order_by('-days_ago')
-    )
+        daily_points = daily_points.filter(local_date__gte=monday_before, local_date__lte=last_sunday)
+    daily_points = list(daily_points.values_list('user', 'local_date', 'points_capped_sum').order_by('local_date', 'user'))
+
+    # teams of this competition each member belongs to - members without a team are counted under None
+    user_team_dict = {}
+    for user_id, team_id in Team.user.through.objects.filter(team__competition=competition).values_list('customuser', 'team'):
+        user_team_dict.setdefault(user_id, []).append(team_id)
+
+    today = timezone.localdate()
     timeseries_all = {}
-    for i in tmp_all:
-        days_ago = i.pop('days_ago')
-        timeseries_all[days_ago] = i
-
-    tmp_user = (
-        all_points_date
-        .values('days_ago', 'workout__user__id')
-        .annotate(total=Sum('points_capped'))
-        .order_by('-days_ago')
-    )
     timeseries_user = {}
-    for i in tmp_user:
-        user_id = i.pop('workout__user__id')
-        days_ago = i.pop('days_ago')
-        if user_id not in timeseries_user:
-            timeseries_user[user_id] = {}
-        timeseries_user[user_id][days_ago] = i
-
-    tmp_team = (
-        all_points_date
-        .values('days_ago', 'workout__user__my_teams')
-        .annotate(total=Sum('points_capped'))
-        .order_by('-days_ago')
-    )
     timeseries_team = {}
-    for i in tmp_team:
-        team_id = i.pop('workout__user__my_teams')
-        days_ago = i.pop('days_ago')
-        if team_id not in timeseries_team:
-            timeseries_team[team_id] = {}
-        timeseries_team[team_id][days_ago] = i
+    total_user = {}
+    for user_id, day, total in daily_points:
+        days_ago = (today - day).days
+        timeseries_all.setdefault(days_ago, {'total': 0})['total'] += total
+        timeseries_user.setdefault(user_id, {}).setdefault(days_ago, {'total': 0})['total'] += total
+        for team_id in user_team_dict.get(user_id, [None]):
+            timeseries_team.setdefault(team_id, {}).setdefault(days_ago, {'total': 0})['total'] += total
+        total_user[user_id] = total_user.get(user_id, 0) + total
 
     # Get user data
     user_dict = {i['id']: i for i in CustomUser.objects.filter(my_competitions=competition).values('id', 'username', 'strava_allow_follow', 'strava_athlete_id').order_by('username', 'id')}
@@ -112,12 +75,7 @@ def get_competition_stats(competition, last_seven_days=False):
             value['strava_athlete_id'] = None
 
     # Get user rankings
-    leaderboard_user = (
-        all_points
-        .values('workout__user__id')
-        .annotate(total_capped=Sum('points_capped'))
-        .order_by('-total_capped')
-    )
+    leaderboard_user = [{'workout__user__id': user_id, 'total_capped': total} for user_id, total in total_user.items()]
     leaderboard_user = _add_rank(leaderboard_user, key="total_capped", enhance_dict=user_dict, id_field='workout__user__id')
     leaderboard_user_dict = {i['id']: i for i in leaderboard_user}
 
@@ -128,12 +86,11 @@ def get_competition_stats(competition, last_seven_days=False):
         value['member_count'] = len(value.get('members', []))
 
     # Get team rankings
-    leaderboard_team = (
-        all_points
-        .values('workout__user__my_teams__id')
-        .annotate(total_capped=Sum('points_capped'))
-        .order_by('-total_capped')
-    )
+    total_team = {}
+    for user_id, total in total_user.items():
+        for team_id in user_team_dict.get(user_id, []):
+            total_team[team_id] = total_team.get(team_id, 0) + total
+    leaderboard_team = [{'workout__user__my_teams__id': team_id, 'total_capped': total} for team_id, total in total_team.items()]
     leaderboard_team = [{**i, 'total_capped': i['total_capped'] / max(1, team_dict[i['workout__user__my_teams__id']]['active_member_count'])} for i in leaderboard_team if i['workout__user__my_teams__id'] in team_dict]
     leaderboard_team = _add_rank(leaderboard_team, key="total_capped", enhance_dict=team_dict, id_field='workout__user__my_teams__id')
     team_dict = {i['id']: i for i in leaderboard_team}
@@ -167,3 +124,57 @@ def get_competition_stats(competition, last_seven_days=False):
         }
     }
     return response_obj
+
+
+STATS_CACHE_TIMEOUT = 60 * 60 * 24  # seconds - entries are never stale, the version in the key changes instead
+
+
+def _stats_version_key(competition_id):
+    return f'competition_stats_version_{competition_id}'
+
+
+def get_competition_stats_version(competition_id):
+    """ generation counter of the competition stats - changes whenever data shown in the stats or the feed changes """
+    return get_data_versions([_stats_version_key(competition_id)])[_stats_version_key(competition_id)][0]
+
+
+def get_competitions_data_version(competition_ids):
+    """ (version, last modified timestamp) covering all given competitions - for ETag / Last-Modified """
+    competition_ids = sorted(set(competition_ids))
+    versions = get_data_versions([_stats_version_key(i) for i in competition_ids])
+    version = '-'.join(f'{i}.{versions[_stats_version_key(i)][0]}' for i in competition_ids)
+    last_modified = max([versions[_stats_version_key(i)][1] for i in competition_ids], default=0)
+    return version, last_modified
+
+
+def bump_competition_stats_version(competition_ids):
+    """ invalidate the cached stats and feed of the competition(s) """
+    competition_ids = competition_ids if isinstance(competition_ids, (list, tuple, set)) else [competition_ids]
+    bump_data_versions([_stats_version_key(getattr(i, 'pk', i)) for i in competition_ids])
+
+
+def get_cached_competition_stats(competition, last_seven_days=False, with_stale=False):
+    """ get_competition_stats shared by all members - cached per competition, stats version and day, computed once at a time
+
+    While another worker computes the new version the previous one is returned - with_stale=True returns a tuple of the
+    stats and whether they are such an older version.
+    """
+    variant = '7d' if last_seven_days else 'all'
+    version = f"{get_competition_stats_version(competition)}_{timezone.localdate().isoformat()}"
+
+    def compute():
+        response_obj = get_competition_stats(competition, last_seven_days=last_seven_days)
+        if isinstance(response_obj, dict):
+            response_obj['competition']['goals'] = list(response_obj['competition']['goals'])
+        return {'version': version, 'stats': response_obj}
+
+    entry = get_or_compute_single_flight(
+        cache_key=f"competition_stats_{competition}_{version}_{variant}",
+        compute=compute,
+        timeout=STATS_CACHE_TIMEOUT,
+        stale_key=f"competition_stats_stale_{competition}_{variant}",
+        cacheable=lambda i: isinstance(i['stats'], dict),
+    )
+    if with_stale:
+        return entry['stats'], entry['version'] != version
+    return entry['stats']
@@ -1,3 +1,503 @@
+import datetime, random, json
+from io import StringIO
+from decimal import Decimal
+
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Q, F, Sum
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from custom_user.models import CustomUser
+from competition.models import Competition, ActivityGoal, Award, Team, Points, DailyPoints, FeedChange
+from workouts.models import Workout
+from custom_user.point_recalc import _recalc_group
+from workout_challenge.synthetic_data import GOAL_TEMPLATES, synthetic_workouts, bulk_create_lazily, materialize_points
+from .scorer import _calculate_points_raw, _points_raw_expression
+from .rollup import refresh_daily_points, local_date, get_competition_points
+from .stats import bump_competition_stats_version
+from . import feed
+from .feed import get_competition_feed_page, get_feed_delta, get_feed_token, record_feed_changes, record_feed_reset, FEED_TOKEN_LAG_SECONDS
+from .leaderboard import get_leaderboard, get_leaderboard_store, update_user_leaderboards
+from competition.views import CompetitionEventsToken
+from competition.push import get_event_channel, competition_channel  # the channel instance the views and signals use
+
+
+class PointsRawExpressionTests(TestCase):
+    """ the database expression has to give exactly the same points_raw as the python reference _calculate_points_raw """
+
+    @classmethod
+    def setUpTestData(cls):
+        rnd = random.Random(7)
+        # bulk_create - no welcome emails / MET estimation needed here
+        CustomUser.objects.bulk_create([
+            CustomUser(email=f'user{idx}@example.com', username=f'user{idx}', first_name='User', last_name=str(idx), scaling_kcal=Decimal(rnd.randint(5_000, 15_000)) / 10_000, scaling_distance=Decimal(rnd.randint(5_000, 15_000)) / 10_000)
+            for idx in range(5)
+        ])
+        workout_lst = []
+        for user in CustomUser.objects.all():
+            for _ in range(40):
+                workout_lst.append(Workout(
+                    user=user,
+                    sport_type='Run',
+                    start_datetime=timezone.make_aware(datetime.datetime(2025, 1, 1) + datetime.timedelta(minutes=rnd.randint(0, 60 * 24 * 30))),
+                    duration=datetime.timedelta(seconds=rnd.randint(60, 4 * 60 * 60)),
+                    kcal=None if rnd.random() < 0.1 else Decimal(rnd.randint(0, 200_000)) / 100,
+                    distance=None if rnd.random() < 0.1 else Decimal(rnd.randint(0, 10_000)) / 100,
+                ))
+        Workout.objects.bulk_create(workout_lst)
+
+    def test_points_raw_expression(self):
+        for metric in ['min', 'num', 'kcal', 'km', 'kj']:
+            for goal_target in [Decimal('1'), Decimal('7.5'), Decimal('8'), Decimal('150'), Decimal('800'), Decimal('3333.33')]:
+                goal = ActivityGoal(metric=metric, goal=goal_target)
+                workout_lst = Workout.objects.select_related('user').annotate(points_raw=_points_raw_expression(goal))
+                for workout in workout_lst:
+                    expected = _calculate_points_raw(goal=goal, workout=workout, user=workout.user)
+                    self.assertEqual(expected, expected.quantize(Decimal('0.01')))
+                    self.assertEqual(workout.points_raw, expected, f'{metric} / {goal_target}: {workout.points_raw} != {expected}')
+
+    def test_points_raw_expression_fixed_scaling(self):
+        user = CustomUser.objects.first()
+        for metric in ['kcal', 'km', 'kj']:
+            goal = ActivityGoal(metric=metric, goal=Decimal('250'))
+            workout_lst = Workout.objects.filter(user=user).annotate(points_raw=_points_raw_expression(goal, scaling_kcal=user.scaling_kcal, scaling_distance=user.scaling_distance))
+            for workout in workout_lst:
+                self.assertEqual(workout.points_raw, _calculate_points_raw(goal=goal, workout=workout, user=user))
+
+
+class DailyPointsTests(TestCase):
+    """ the daily rollup has to add up to the points it was built from """
+
+    def test_refresh_daily_points(self):
+        CustomUser.objects.bulk_create([CustomUser(email=f'rollup{idx}@example.com', username=f'rollup{idx}') for idx in range(3)])
+        user_lst = list(CustomUser.objects.filter(email__startswith='rollup').order_by('pk'))
+        Competition.objects.bulk_create([Competition(owner=user_lst[0], name='Rollup', join_code='ROLLUPXXXX', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 31))])
+        competition = Competition.objects.get(name='Rollup')
+        # a third of the goal per workout - the capped points are repeating decimals, two on one day don't add up to a rounded cent
+        ActivityGoal.objects.bulk_create([ActivityGoal(competition=competition, name='Thirds', metric='min', goal=3, max_per_workout=1)] + [ActivityGoal(competition=competition, **goal) for goal in GOAL_TEMPLATES])
+        CustomUser.my_competitions.through.objects.bulk_create([CustomUser.my_competitions.through(customuser_id=user.pk, competition_id=competition.pk) for user in user_lst])
+        bulk_create_lazily(Workout, synthetic_workouts(random.Random(3), user_lst, 40, datetime.date(2025, 1, 1), datetime.date(2025, 1, 31)))
+        materialize_points([competition])  # real scorer output - refreshes the rollup
+
+        def expected_rollup():
+            expected = {}
+            for points in get_competition_points(competition).select_related('workout'):
+                key = (points.workout.user_id, local_date(points.workout.start_datetime))
+                capped, raw, workouts = expected.get(key, (0, 0, set()))
+                expected[key] = (capped + points.points_capped, raw + points.points_raw, workouts | {points.workout_id})
+            return {key: (capped, raw, len(workouts)) for key, (capped, raw, workouts) in expected.items()}
+
+        def rollup():
+            return {(i.user_id, i.local_date): (i.points_capped_sum, i.points_raw_sum, i.workout_count) for i in DailyPoints.objects.filter(competition=competition)}
+
+        expected = expected_rollup()
+        self.assertTrue(any(count > 1 for _, _, count in expected.values()))
+        self.assertEqual(rollup(), expected)
+
+        # the recalc writes and refreshes the same way
+        goal = competition.activitygoal_set.get(name='Thirds')
+        for user in user_lst:
+            Points.objects.filter(goal=goal, workout__user=user).update(points_capped=F('points_raw'))
+            task_group = {'user': user.pk, 'goal': goal.pk, 'start_datetime': '2025-01-01T00:00:00+00:00', 'end_datetime': None}
+            self.assertGreater(_recalc_group(task_group, goal)[1], 0)
+        self.assertEqual(rollup(), expected_rollup())
+        self.assertEqual(rollup(), expected)
+
+        # partial refresh after deleting the points of one day only touches that day
+        user_id, day = next(iter(expected))
+        Points.objects.filter(workout__user=user_id, workout__start_datetime__gte=timezone.make_aware(datetime.datetime.combine(day, datetime.time.min)), workout__start_datetime__lt=timezone.make_aware(datetime.datetime.combine(day, datetime.time.max))).delete()
+        refresh_daily_points(competition, users=[user_id], start_date=day, end_date=day)
+        self.assertFalse(DailyPoints.objects.filter(competition=competition, user=user_id, local_date=day).exists())
+        self.assertEqual(DailyPoints.objects.filter(competition=competition).count(), len(expected) - 1)
+
+
+class CompetitionPointsTests(TestCase):
+    """ the points of a competition looked up by goal / award ids are the ones the join to the goals and awards finds """
+
+    def test_get_competition_points(self):
+        CustomUser.objects.bulk_create([CustomUser(email='points@example.com', username='points')])
+        user = CustomUser.objects.get(email='points@example.com')
+        competition_lst = [Competition(owner=user, name=f'Points {idx}', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 31)) for idx in range(2)]
+        for competition in competition_lst:
+            competition.save()
+        Award.objects.bulk_create([Award(competition=competition, name='Award', threshold=1, reward_points=5) for competition in competition_lst])
+        Workout.objects.bulk_create([Workout(user=user, sport_type='Run', start_datetime=timezone.make_aware(datetime.datetime(2025, 1, day, 8)), duration=datetime.timedelta(minutes=30)) for day in range(2, 5)])
+        Points.objects.bulk_create([
+            Points(goal=goal, workout=workout, points_raw=1, points_capped=1)
+            for workout in Workout.objects.filter(user=user) for goal in ActivityGoal.objects.filter(competition__in=competition_lst)
+        ] + [Points(award=award, workout=Workout.objects.filter(user=user).first(), points_raw=5, points_capped=5) for award in Award.objects.filter(competition__in=competition_lst)])
+
+        for competition in competition_lst:
+            expected = set(Points.objects.filter(Q(goal__competition=competition) | Q(award__competition=competition)).values_list('pk', flat=True))
+            self.assertEqual(set(get_competition_points(competition).values_list('pk', flat=True)), expected)
+            self.assertEqual(len(expected), 3 * competition.activitygoal_set.count() + 1)
+
+
+class ConditionalGetTests(TestCase):
+    """ unchanged competition data is answered with a 304 """
+
+    def test_stats_etag(self):
+        CustomUser.objects.bulk_create([CustomUser(email='etag@example.com', username='etag')])
+        user = CustomUser.objects.get(email='etag@example.com')
+        competition = Competition(owner=user, name='ETag', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 31))
+        competition.save()
+        client = APIClient()
+        client.force_authenticate(user)
+
+        for url in [f'/api/stats/{competition.pk}/', f'/api/feed/{competition.pk}/', '/api/competition/']:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            self.assertEqual(client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+            bump_competition_stats_version(competition.pk)
+            changed = client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(changed.status_code, 200)
+            self.assertNotEqual(changed['ETag'], response['ETag'])
+
+    def test_stale_response(self):
+        CustomUser.objects.bulk_create([CustomUser(email='stale@example.com', username='stale')])
+        user = CustomUser.objects.get(email='stale@example.com')
+        competition = Competition(owner=user, name='Stale', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 31))
+        competition.save()
+        client = APIClient()
+        client.force_authenticate(user)
+
+        for url in [f'/api/stats/{competition.pk}/', f'/api/feed/{competition.pk}/']:
+            response = client.get(url)
+            bump_competition_stats_version(competition.pk)
+
+            # another worker is computing the new version - the previous one is served without validators
+            with mock.patch('workout_challenge.single_flight.SingleFlightLock.acquire', return_value=False):
+                stale = client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(stale.status_code, 200)
+            self.assertEqual(stale.json(), response.json())
+            self.assertNotIn('ETag', stale)
+            self.assertNotIn('Last-Modified', stale)
+            self.assertIn('no-store', stale['Cache-Control'])
+
+            # once computed, the current version comes with its ETag again
+            current = client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(current.status_code, 200)
+            self.assertNotEqual(current['ETag'], response['ETag'])
+            self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=current['ETag']).status_code, 304)
+
+
+class LeaderboardTests(TestCase):
+    """ sorted set leaderboards rank like _add_rank - equal points share a rank """
+
+    def test_leaderboard(self):
+        get_leaderboard_store().clear()
+        CustomUser.objects.bulk_create([CustomUser(email=f'board{idx}@example.com', username=f'board{idx}') for idx in range(6)])
+        user_lst = list(CustomUser.objects.filter(email__startswith='board').order_by('pk'))
+        competition = Competition(owner=user_lst[0], name='Board', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 31))
+        competition.save()
+        DailyPoints.objects.bulk_create([
+            DailyPoints(competition=competition, user=user, local_date=datetime.date(2025, 1, 2), points_capped_sum=points, points_raw_sum=points, workout_count=1)
+            for user, points in zip(user_lst, [Decimal('5'), Decimal('9'), Decimal('7'), Decimal('7'), Decimal('3'), Decimal('1')])
+        ])
+
+        leaderboard = get_leaderboard(competition.pk, top=3, member=user_lst[4].pk, around=1)
+        self.assertEqual(leaderboard['size'], 6)
+        self.assertEqual([(i['points'], i['rank']) for i in leaderboard['top']], [(9, 1), (7, 2), (7, 2)])
+        self.assertEqual(leaderboard['me'], {'id': user_lst[4].pk, 'points': 3, 'rank': 5})
+        self.assertEqual([i['id'] for i in leaderboard['around']], [user_lst[0].pk, user_lst[4].pk, user_lst[5].pk])
+
+        # incremental update of one user
+        DailyPoints.objects.filter(user=user_lst[5]).update(points_capped_sum=Decimal('20'))
+        DailyPoints.objects.filter(user=user_lst[1]).delete()
+        update_user_leaderboards(competition.pk, [user_lst[5], user_lst[1]])
+        leaderboard = get_leaderboard(competition.pk, top=1, member=user_lst[1].pk)
+        self.assertEqual(leaderboard['top'], [{'id': user_lst[5].pk, 'points': 20, 'rank': 1}])
+        self.assertEqual(leaderboard['me'], {'id': user_lst[1].pk, 'points': None, 'rank': None})
+        self.assertEqual(leaderboard['size'], 5)
+
+    def test_team_delete(self):
+        CustomUser.objects.bulk_create([CustomUser(email='board_team@example.com', username='board_team')])
+        competition = Competition(owner=CustomUser.objects.get(email='board_team@example.com'), name='Board Teams', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 31))
+        competition.save()
+        team = Team(competition=competition, name='Team')
+        team.save()
+        # the team board is only rewritten once the delete is committed
+        with mock.patch('competition.models.update_team_leaderboard') as update_team_leaderboard:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                team.delete()
+                update_team_leaderboard.assert_not_called()
+            self.assertEqual(len(callbacks), 1)
+        update_team_leaderboard.assert_called_once_with(competition.pk)
+
+
+class FeedPaginationTests(TestCase):
+    """ the keyset pages add up to the whole feed - newest first, ties broken by the workout id """
+
+    def test_feed_pages(self):
+        CustomUser.objects.bulk_create([CustomUser(email='feed@example.com', username='feed')])
+        user = CustomUser.objects.get(email='feed@example.com')
+        competition = Competition(owner=user, name='Feed', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 31))
+        competition.save()
+        goal_lst = list(competition.activitygoal_set.all())
+
+        # every start_datetime three times to test the tie breaker
+        Workout.objects.bulk_create([
+            Workout(user=user, sport_type='Run', start_datetime=timezone.make_aware(datetime.datetime(2025, 1, 1 + idx // 3, 8)), duration=datetime.timedelta(minutes=30))
+            for idx in range(30)
+        ])
+        Points.objects.bulk_create([Points(goal=goal, workout=workout, points_raw=1, points_capped=1) for workout in Workout.objects.filter(user=user) for goal in goal_lst])
+
+        results, cursor = [], None
+        while True:
+            page = get_competition_feed_page(competition.pk, cursor=cursor, page_size=7)
+            results.extend(page['results'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                break
+        expected = list(Workout.objects.filter(user=user).order_by('-start_datetime', '-pk').values_list('pk', flat=True))
+        self.assertEqual([i['workout'] for i in results], expected)
+        self.assertTrue(all(len(i['details']) == len(goal_lst) and i['points_capped'] == len(goal_lst) for i in results))
+
+
+@mock.patch.object(feed, 'FEED_TOKEN_LAG_SECONDS', 0)
+class FeedDeltaTests(TestCase):
+    """ the delta since a token has the changed workouts and tombstones of the removed ones """
+
+    def test_feed_delta(self):
+        CustomUser.objects.bulk_create([CustomUser(email='delta@example.com', username='delta')])
+        user = CustomUser.objects.get(email='delta@example.com')
+        competition = Competition(owner=user, name='Delta', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 31))
+        competition.save()
+        goal = competition.activitygoal_set.first()
+        Workout.objects.bulk_create([Workout(user=user, sport_type='Run', start_datetime=timezone.make_aware(datetime.datetime(2025, 1, 2 + idx, 8)), duration=datetime.timedelta(minutes=30)) for idx in range(3)])
+        workout_lst = list(Workout.objects.filter(user=user).order_by('start_datetime'))
+        Points.objects.bulk_create([Points(goal=goal, workout=workout, points_raw=1, points_capped=1) for workout in workout_lst])
+
+        token = get_feed_delta(competition.pk, 0)['token']
+        self.assertEqual(get_feed_delta(competition.pk, token), {'token': token, 'reset': False, 'changed': [], 'deleted': []})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            record_feed_changes([(competition.pk, workout_lst[0].pk), (competition.pk, workout_lst[2].pk)])
+            record_feed_changes([(competition.pk, workout_lst[1].pk)], deleted=True)
+        delta = get_feed_delta(competition.pk, token)
+        self.assertFalse(delta['reset'])
+        self.assertEqual([i['workout'] for i in delta['changed']], [workout_lst[2].pk, workout_lst[0].pk])
+        self.assertEqual(delta['deleted'], [workout_lst[1].pk])
+        self.assertEqual(get_feed_delta(competition.pk, delta['token'])['changed'], [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            record_feed_reset(competition.pk)
+        self.assertTrue(get_feed_delta(competition.pk, delta['token'])['reset'])
+
+
+class FeedChangeStampTests(TestCase):
+    """ the changes are stamped when they are inserted after the commit - the token lag counts from there """
+
+    def test_stamped_at_commit(self):
+        CustomUser.objects.bulk_create([CustomUser(email='commit@example.com', username='commit')])
+        competition = Competition(owner=CustomUser.objects.get(email='commit@example.com'), name='Commit', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 31))
+        competition.save()
+        with self.captureOnCommitCallbacks() as callbacks:
+            record_feed_changes([(competition.pk, 1)])
+
+        # a long transaction - the change is only inserted and visible once it is committed a minute later
+        committed = timezone.now() + datetime.timedelta(minutes=1)
+        with mock.patch('django.utils.timezone.now', return_value=committed):
+            for callback in callbacks:
+                callback()
+        change = FeedChange.objects.get(competition=competition, workout_id=1)
+        self.assertEqual(change.created_datetime, committed)
+
+        # the token only moves past it after the lag counted from the commit
+        with mock.patch('django.utils.timezone.now', return_value=committed + datetime.timedelta(seconds=FEED_TOKEN_LAG_SECONDS - 1)):
+            self.assertLess(get_feed_token(), change.pk)
+        with mock.patch('django.utils.timezone.now', return_value=committed + datetime.timedelta(seconds=FEED_TOKEN_LAG_SECONDS)):
+            self.assertEqual(get_feed_token(), change.pk)
+
+
+class CompetitionEventsTests(TestCase):
+    """ subscribed clients get feed changes and rank changes pushed - through the in-memory event channel """
+
+    def _next_event(self, stream):
+        for chunk in stream:
+            chunk = chunk.decode()
+            if not chunk.startswith(('retry:', ':')):
+                event_type, data = chunk.strip().split('\n')
+                return event_type.removeprefix('event: '), json.loads(data.removeprefix('data: '))
+
+    def test_competition_events(self):
+        CustomUser.objects.bulk_create([CustomUser(email=f'events{idx}@example.com', username=f'events{idx}') for idx in range(3)])
+        user, other, stranger = CustomUser.objects.filter(email__startswith='events').order_by('email')
+        competition = Competition(owner=user, name='Events', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 31), has_teams=False)
+        competition.save()
+        competition.user.add(user, other)
+        goal = competition.activitygoal_set.first()
+        Workout.objects.bulk_create([Workout(user=i, sport_type='Run', start_datetime=timezone.make_aware(datetime.datetime(2025, 1, 2, 8)), duration=datetime.timedelta(minutes=30)) for i in [user, other]])
+        workout, other_workout = Workout.objects.filter(user__in=[user, other]).order_by('user__email')
+        Points.objects.bulk_create([Points(goal=goal, workout=workout, points_raw=5, points_capped=5), Points(goal=goal, workout=other_workout, points_raw=3, points_capped=3)])
+        with self.captureOnCommitCallbacks(execute=True):
+            refresh_daily_points(competition.pk)
+
+        self.assertEqual(APIClient().get(f'/api/events/{competition.pk}/', HTTP_ACCEPT='text/event-stream').status_code, 401)
+        # only a short-lived token of this competition is accepted in the query - not the access token
+        self.assertEqual(APIClient().get(f'/api/events/{competition.pk}/?token={AccessToken.for_user(other)}', HTTP_ACCEPT='text/event-stream').status_code, 401)
+        self.assertEqual(APIClient().get(f'/api/events/{competition.pk}/?token={CompetitionEventsToken.for_competition(other, competition.pk + 1)}', HTTP_ACCEPT='text/event-stream').status_code, 401)
+        expired = CompetitionEventsToken.for_competition(other, competition.pk)
+        expired.set_exp(lifetime=-datetime.timedelta(seconds=1))
+        self.assertEqual(APIClient().get(f'/api/events/{competition.pk}/?token={expired}', HTTP_ACCEPT='text/event-stream').status_code, 401)
+        self.assertEqual(APIClient().get(f'/api/feed/{competition.pk}/?token={CompetitionEventsToken.for_competition(other, competition.pk)}').status_code, 401)
+
+        self.assertEqual(APIClient(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(stranger)}').post(f'/api/events/{competition.pk}/token/').status_code, 403)
+        token_response = APIClient(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(other)}').post(f'/api/events/{competition.pk}/token/')
+        self.assertEqual(token_response.status_code, 200)
+        response = APIClient().get(f'/api/events/{competition.pk}/?token={token_response.data["token"]}', HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = iter(response.streaming_content)
+        self.assertEqual(self._next_event(stream)[0], 'ready')
+        self.assertTrue(get_event_channel().has_subscribers(competition_channel(competition.pk)))
+
+        # a workout lands in the feed
+        with self.captureOnCommitCallbacks(execute=True):
+            record_feed_changes([(competition.pk, workout.pk)])
+        event_type, data = self._next_event(stream)
+        self.assertEqual(event_type, 'feed')
+        self.assertEqual([i['workout'] for i in data['changed']], [workout.pk])
+        self.assertEqual(data['changed'][0]['points_capped'], 5)
+
+        # the other user moves to the top - only their entry is sent
+        Points.objects.filter(workout=other_workout).update(points_raw=8, points_capped=8)
+        with self.captureOnCommitCallbacks(execute=True):
+            refresh_daily_points(competition.pk, users=[other.pk])
+        event_type, data = self._next_event(stream)
+        self.assertEqual(event_type, 'leaderboard')
+        self.assertEqual(data, {'board': 'all', 'reset': False, 'changes': [{'id': other.pk, 'points': 8.0, 'rank': 1, 'previous_points': 3.0, 'previous_rank': 2}]})
+
+        response.close()
+        self.assertFalse(get_event_channel().has_subscribers(competition_channel(competition.pk)))
+
+
+class PointsVisibilityTests(TestCase):
+    """ the points list shows the points of the competitions of the user and of his/her own workouts - like the old OR-join """
+
+    def test_points_visibility(self):
+        CustomUser.objects.bulk_create([CustomUser(email=f'visible{idx}@example.com', username=f'visible{idx}') for idx in range(3)])
+        owner, member, outsider = CustomUser.objects.filter(email__startswith='visible').order_by('email')
+        competition = Competition(owner=owner, name='Visible', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 31))
+        competition.save()
+        other_competition = Competition(owner=outsider, name='Other', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 31))
+        other_competition.save()
+        competition.user.add(member)
+        other_competition.user.add(member, outsider)
+        goal, other_goal = competition.activitygoal_set.first(), other_competition.activitygoal_set.first()
+        Workout.objects.bulk_create([Workout(user=i, sport_type='Run', start_datetime=timezone.make_aware(datetime.datetime(2025, 1, 2, 8)), duration=datetime.timedelta(minutes=30)) for i in [owner, member, outsider]])
+        owner_workout, member_workout, outsider_workout = Workout.objects.filter(user__in=[owner, member, outsider]).order_by('user__email')
+        Points.objects.bulk_create([Points(goal=i, workout=workout, points_raw=1, points_capped=1) for i, workout in [(goal, member_workout), (other_goal, member_workout), (other_goal, outsider_workout), (goal, owner_workout)]])
+
+        for user, count in [(owner, 2), (member, 4), (outsider, 2)]:
+            expected = set(Points.objects.filter(Q(goal__competition__owner=user) | Q(goal__competition__user=user) | Q(workout__user=user)).values_list('pk', flat=True))
+            client = APIClient()
+            client.force_authenticate(user)
+            response = client.get('/api/point/?page_size=200')
+            self.assertEqual({i['id'] for i in response.json()['results']}, expected)
+            self.assertEqual(len(expected), count)
+
+    def test_points_order(self):
+        CustomUser.objects.bulk_create([CustomUser(email='ordered@example.com', username='ordered')])
+        user = CustomUser.objects.get(email='ordered@example.com')
+        competition = Competition(owner=user, name='Ordered', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 31))
+        competition.save()
+        goal = competition.activitygoal_set.first()
+        start_datetime = timezone.make_aware(datetime.datetime(2025, 1, 10, 8))
+        # some workouts at the same time and a backfilled old one inserted last - the list follows the start, not the id
+        Workout.objects.bulk_create([Workout(user=user, sport_type='Run', start_datetime=start_datetime + datetime.timedelta(days=idx // 2), duration=datetime.timedelta(minutes=30)) for idx in range(6)])
+        Workout.objects.bulk_create([Workout(user=user, sport_type='Run', start_datetime=start_datetime - datetime.timedelta(days=5), duration=datetime.timedelta(minutes=30))])
+        Points.objects.bulk_create([Points(goal=goal, workout=i, points_raw=1, points_capped=1) for i in Workout.objects.filter(user=user)])
+        expected = list(Points.objects.filter(goal=goal).order_by('-workout__start_datetime', '-workout_id', '-id').values_list('pk', flat=True))
+        self.assertNotEqual(expected, list(Points.objects.filter(goal=goal).order_by('-workout_id', '-id').values_list('pk', flat=True)))
+        client = APIClient()
+        client.force_authenticate(user)
+
+        ids = []
+        url = '/api/point/?page_size=2'
+        while url is not None:
+            page = client.get(url).json()
+            ids += [i['id'] for i in page['results']]
+            url = page['next']
+        self.assertEqual(ids, expected)
+
+
+class QueryBudgetTests(TestCase):
+    """ the lists cost a fixed number of queries - members and "is mine" come prefetched / annotated, not per row """
+
+    BUDGETS = {
+        '/api/competition/': 3,
+        '/api/team/': 3,
+        '/api/goal/': 2,
+        '/api/point/': 3,
+        '/api/workout/': 1,
+        '/api/user/': 3,
+    }
+
+    def _create(self, size):
+        """ a user in `size` competitions with `size` members, 2 teams and a workout per member each """
+        CustomUser.objects.bulk_create([CustomUser(email=f'budget{size}_{idx}@example.com', username=f'budget{size}_{idx}') for idx in range(size)])
+        user_lst = list(CustomUser.objects.filter(email__startswith=f'budget{size}_').order_by('pk'))
+        for idx in range(size):
+            competition = Competition(owner=user_lst[idx], name=f'Budget {idx}', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 31), has_teams=True)
+            competition.save()
+            competition.user.add(*user_lst)
+            team_lst = [Team(competition=competition, name=f'Team {team_idx}') for team_idx in range(2)]
+            for team in team_lst:
+                team.save()
+            for user_idx, user in enumerate(user_lst):
+                user.my_teams.add(team_lst[user_idx % 2])
+            goal = competition.activitygoal_set.first()
+            Workout.objects.bulk_create([Workout(user=user, sport_type='Run', start_datetime=timezone.make_aware(datetime.datetime(2025, 1, 2 + idx, 8)), duration=datetime.timedelta(minutes=30)) for user in user_lst])
+            Points.objects.bulk_create([Points(goal=goal, workout=workout, points_raw=1, points_capped=1) for workout in Workout.objects.filter(user__in=user_lst, start_datetime__day=2 + idx)])
+        return user_lst[0]
+
+    def test_query_budgets(self):
+        counts = {}
+        for size in [2, 6]:
+            client = APIClient()
+            client.force_authenticate(self._create(size))
+            for url, budget in self.BUDGETS.items():
+                with CaptureQueriesContext(connection) as queries:
+                    response = client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertLessEqual(len(queries), budget, f'{url} with {size} rows: {[i["sql"] for i in queries]}')
+                counts.setdefault(url, set()).add(len(queries))
+        for url, count in counts.items():
+            self.assertEqual(len(count), 1, f'{url} query count depends on the number of rows: {count}')
+
+
+class EndpointBenchmarkTests(TestCase):
+    """ the query counts of every route on the small synthetic dataset match the committed baseline """
+
+    def test_query_baseline(self):
+        call_command('benchmark_endpoints', sizes=['small'], metrics=['queries'], repeat=1, stdout=StringIO())
+
+
+class MaterializePointsTests(TestCase):
+    """ the bulk seed inserts the points capped exactly like the recalc would cap them """
+
+    def test_matches_recalc(self):
+        CustomUser.objects.bulk_create([CustomUser(email=f'seed{idx}@example.com', username=f'seed{idx}') for idx in range(3)])
+        user_lst = list(CustomUser.objects.filter(email__startswith='seed').order_by('pk'))
+        Competition.objects.bulk_create([Competition(owner=user_lst[0], name='Seed', join_code='SEEDXXXXXX', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 3, 31))])
+        competition = Competition.objects.get(name='Seed')
+        ActivityGoal.objects.bulk_create([ActivityGoal(competition=competition, **goal) for goal in GOAL_TEMPLATES])
+        CustomUser.my_competitions.through.objects.bulk_create([CustomUser.my_competitions.through(customuser_id=user.pk, competition_id=competition.pk) for user in user_lst])
+        workout_count = bulk_create_lazily(Workout, synthetic_workouts(random.Random(5), user_lst, 60, datetime.date(2025, 1, 1), datetime.date(2025, 3, 31)))
 
-# Create your tests here.
+        self.assertEqual(materialize_points([competition]), workout_count * len(GOAL_TEMPLATES))
+        self.assertTrue(Points.objects.filter(points_capped__lt=F('points_raw')).exists())  # the daily caps kicked in
+        self.assertEqual(DailyPoints.objects.filter(competition=competition).aggregate(Sum('workout_count'))['workout_count__sum'], workout_count)
+        for user in user_lst:
+            for goal in competition.activitygoal_set.all():
+                task_group = {'user': user.pk, 'goal': goal.pk, 'start_datetime': '2025-01-01T00:00:00+00:00', 'end_datetime': None}
+                self.assertEqual(_recalc_group(task_group, goal)[1], 0, f'{user} / {goal.name}')
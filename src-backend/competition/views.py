@@ -1,54 +1,84 @@
 from django.conf import settings
-from django.db.models import Q
+from django.db import connection
+from django.db.models import Q, F, Prefetch, Exists, OuterRef
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 from django.core.exceptions import PermissionDenied
 from rest_framework import viewsets
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework import status
-from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
 from rest_framework.permissions import BasePermission
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.renderers import JSONRenderer
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.tokens import Token
+from rest_framework_simplejwt.exceptions import TokenError, InvalidToken
 
-from django.db.models import Sum
 
 from custom_user.views import IsOwnerOrReadOnly
 from custom_user.models import CustomUser
 from custom_user.strava import sync_strava
 from custom_user.point_recalc import recalc_points
 from .models import Competition, Team, ActivityGoal, Points
+from workouts.models import Workout
 from .serializers import CompetitionSerializer, TeamSerializer, ActivityGoalSerializer, PointsSerializer
-from .stats import get_competition_stats
+from .leaderboard import get_leaderboard, LEADERBOARD_BOARDS
+from .stats import get_cached_competition_stats, get_competitions_data_version
+from .push import get_event_channel, competition_channel, format_event
+from .feed import get_cached_competition_feed, get_cached_competition_feed_page, get_feed_delta, get_feed_token, decode_feed_cursor, FEED_PAGE_SIZE, FEED_MAX_PAGE_SIZE
+from workout_challenge.conditional import ConditionalGetMixin, conditional_response, make_etag
 
 from celery import current_app
 import json
+import datetime
+import time
 
-class CompetitionViewSet(viewsets.ModelViewSet):
+
+def _members_prefetch():
+    """ members ordered like the user_info of the serializers - only the fields shown there """
+    return Prefetch('user', queryset=CustomUser.objects.only('id', 'username').order_by('username'))
+
+
+class CompetitionDataVersionMixin(ConditionalGetMixin):
+    """ ETag / Last-Modified from the versions of all competitions the user owns, participates in or has a team in """
+
+    def get_data_version(self):
+        user = self.request.user
+        competition_ids = Competition.objects.filter(Q(owner=user) | Q(user=user) | Q(team__user=user)).values_list('pk', flat=True).distinct()
+        return get_competitions_data_version(competition_ids)
+
+
+class CompetitionViewSet(CompetitionDataVersionMixin, viewsets.ModelViewSet):
     #queryset = Competition.objects.all()
     serializer_class = CompetitionSerializer
 
     permission_classes = [IsOwnerOrReadOnly]
+    ordering = ('-end_date', '-start_date', '-id')  # of the pages - see BoundedCursorPagination
 
     def get_queryset(self):
         # return all competitions the user is owner of or a participant of
         #time.sleep(3)  # throttle for testing
-        return Competition.objects.filter(Q(owner=self.request.user) | Q(user=self.request.user)).distinct().order_by('-end_date', '-start_date', '-id')
+        return Competition.objects.filter(Q(owner=self.request.user) | Q(user=self.request.user)).distinct().prefetch_related(_members_prefetch()).order_by('-end_date', '-start_date', '-id')
 
     def perform_create(self, serializer):
         # when creating a new competition, set the owner to the request user
         serializer.save(owner=self.request.user)
 
 
-class TeamViewSet(viewsets.ModelViewSet):
+class TeamViewSet(CompetitionDataVersionMixin, viewsets.ModelViewSet):
     #queryset = Team.objects.all()
     serializer_class = TeamSerializer
 
     permission_classes = [IsOwnerOrReadOnly]
+    ordering = ('name', 'id')
 
     def get_queryset(self):
         # return all teams the user is a member of and all teams of competitions the user participates in
         #time.sleep(3)  # throttle for testing
-        return Team.objects.filter(Q(user=self.request.user) | Q(competition__user=self.request.user)).distinct().order_by('name')
+        is_my_team = Exists(Team.user.through.objects.filter(team=OuterRef('pk'), customuser=self.request.user))
+        return Team.objects.filter(Q(user=self.request.user) | Q(competition__user=self.request.user)).distinct().annotate(is_my_team=is_my_team).prefetch_related(_members_prefetch()).order_by('name')
 
     def perform_create(self, serializer):
 
@@ -65,11 +95,12 @@ class TeamViewSet(viewsets.ModelViewSet):
         serializer.save()
 
 
-class ActivityGoalViewSet(viewsets.ModelViewSet):
+class ActivityGoalViewSet(CompetitionDataVersionMixin, viewsets.ModelViewSet):
     #queryset = ActivityGoal.objects.all()
     serializer_class = ActivityGoalSerializer
 
     permission_classes = [IsOwnerOrReadOnly]
+    ordering = ('name', 'id')
 
     def get_queryset(self):
         # return all competition categories the user is owner of or a participant of
@@ -86,16 +117,21 @@ class ActivityGoalViewSet(viewsets.ModelViewSet):
         serializer.save()
 
 
-class PointsViewSet(viewsets.ModelViewSet):
+class PointsViewSet(CompetitionDataVersionMixin, viewsets.ModelViewSet):
     #queryset = Points.objects.all()
     serializer_class = PointsSerializer
 
     permission_classes = [IsOwnerOrReadOnly]
+    ordering = ('-workout_start_datetime', '-workout_id', '-id')  # newest workouts first like the feed - annotated, the cursor only reads fields of the rows
 
     def get_queryset(self):
         # return all points the user is owner of, a participant of, or of his/her own workouts
         #time.sleep(3)  # throttle for testing
-        return Points.objects.filter(Q(goal__competition__owner=self.request.user) | Q(goal__competition__user=self.request.user) | Q(workout__user=self.request.user)).distinct().order_by('-workout__start_datetime', '-workout__duration', '-workout', '-workout__user')
+        # the goals of the competitions are few - two indexed IN lookups on the points instead of joining all three paths plus DISTINCT
+        goal_ids = list(ActivityGoal.objects.filter(Q(competition__owner=self.request.user) | Q(competition__user=self.request.user)).values_list('pk', flat=True).distinct())
+        own_workouts = Workout.objects.filter(user=self.request.user).values('pk')
+        # walked along the workout_start_idx of the workouts and the points_workout_id_idx of their points
+        return Points.objects.filter(Q(goal__in=goal_ids) | Q(workout__in=own_workouts)).annotate(workout_start_datetime=F('workout__start_datetime')).order_by(*self.ordering)
 
 
 class StatsPermissions(BasePermission):
@@ -200,11 +236,74 @@ class CeleryQueryView(APIView):
 class CompetitionStatsQueryView(APIView):
     permission_classes = [StatsPermissions]
 
-    @method_decorator(cache_page(30))  # cache for 30 seconds
     def get(self, request, competition):
-        response_obj = get_competition_stats(competition)
-        self.check_object_permissions(request, response_obj)
-        return Response(response_obj)
+        # check the membership before computing anything - the cached stats are shared by all members
+        self.check_object_permissions(request, competition)
+
+        # unchanged stats are answered with a 304 before running any stats query - they also change at midnight
+        version, last_modified = get_competitions_data_version([competition])
+        today = timezone.localdate()
+        last_modified = max(last_modified, timezone.make_aware(datetime.datetime.combine(today, datetime.time.min)).timestamp())
+        etag = make_etag('stats', competition, version, today.isoformat())
+
+        def build_response():
+            response_obj, stale = get_cached_competition_stats(competition, with_stale=True)
+            if isinstance(response_obj, Response):
+                return response_obj
+            response = Response(response_obj)
+            response.stale = stale  # the previous version while the new one is computed - must not carry the new ETag
+            return response
+        return conditional_response(request, etag, last_modified, build_response)
+
+
+class LeaderboardQueryView(APIView):
+    """ API view to get the top of a leaderboard and the entries around the user - without the full stats payload. """
+    permission_classes = [StatsPermissions]
+
+    MAX_TOP = 100
+    MAX_AROUND = 25
+
+    def get(self, request, competition):
+        self.check_object_permissions(request, competition)
+
+        board = request.query_params.get('board', 'all')
+        if board not in LEADERBOARD_BOARDS:
+            return Response({"detail": f"Unknown board - use one of {', '.join(LEADERBOARD_BOARDS)}."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            top = min(max(int(request.query_params.get('top', 10)), 0), self.MAX_TOP)
+            around = min(max(int(request.query_params.get('around', 2)), 0), self.MAX_AROUND)
+        except ValueError:
+            return Response({"detail": "top and around have to be numbers."}, status=status.HTTP_400_BAD_REQUEST)
+
+        version, last_modified = get_competitions_data_version([competition])
+        today = timezone.localdate()
+        if board == '7d':
+            # the 7d board moves on every monday
+            last_modified = max(last_modified, timezone.make_aware(datetime.datetime.combine(today - datetime.timedelta(days=today.weekday()), datetime.time.min)).timestamp())
+        etag = make_etag('leaderboard', competition, version, today.isoformat() if board == '7d' else '', request.user.pk, request.get_full_path())
+
+        def build_response():
+            if board == 'team':
+                member = request.user.my_teams.filter(competition=competition).values_list('pk', flat=True).first()
+            else:
+                member = request.user.pk
+            leaderboard = get_leaderboard(competition, board=board, member=member, top=top, around=around)
+
+            # only look up the names of the entries returned
+            entries = leaderboard['top'] + leaderboard['around'] + ([leaderboard['me']] if leaderboard['me'] is not None else [])
+            ids = {i['id'] for i in entries}
+            if board == 'team':
+                info = {i['id']: i for i in Team.objects.filter(pk__in=ids).values('id', 'name')}
+            else:
+                info = {i['id']: i for i in CustomUser.objects.filter(pk__in=ids).values('id', 'username', 'strava_allow_follow', 'strava_athlete_id')}
+                for value in info.values():
+                    if value.pop('strava_allow_follow') is False:
+                        value['strava_athlete_id'] = None
+            for entry in entries:
+                entry.update(info.get(entry['id'], {}))
+                entry['points'] = None if entry['points'] is None else round(entry['points'], 2)
+            return Response(leaderboard)
+        return conditional_response(request, etag, last_modified, build_response)
 
 
 class FeedPermissions(BasePermission):
@@ -222,7 +321,7 @@ class FeedPermissions(BasePermission):
 
 
 class FeedQueryView(APIView):
-    """ API view to get the activity/point feed for a competition. """
+    """ API view to get the activity/point feed for a competition - paginated with ?page_size=...&cursor=..., changes only with ?since=<token> """
     permission_classes = [FeedPermissions]
 
     def get(self, request, competition):
@@ -232,16 +331,131 @@ class FeedQueryView(APIView):
         competition_obj = Competition.objects.filter(id=competition)
         self.check_object_permissions(request, competition_obj)
 
-        all_points = Points.objects.filter(Q(award__competition__id=competition) | Q(goal__competition_id=competition)).order_by('-workout__start_datetime', '-workout__steps', '-workout__duration', '-workout', '-workout__user')
+        version, last_modified = get_competitions_data_version([competition])
+
+        # changes since the token of an earlier response
+        if 'since' in request.query_params:
+            try:
+                since = int(request.query_params['since'])
+            except ValueError:
+                return Response({"detail": "Invalid since token."}, status=status.HTTP_400_BAD_REQUEST)
+            etag = make_etag('feed', competition, version, get_feed_token(), request.get_full_path())
+            return conditional_response(request, etag, last_modified, lambda: Response(get_feed_delta(competition, since)))
+
+        etag = make_etag('feed', competition, version, request.get_full_path())
+
+        # without cursor / page_size the whole feed is returned as a list - the change token comes as header
+        if 'cursor' not in request.query_params and 'page_size' not in request.query_params:
+            def build_feed_response():
+                feed = get_cached_competition_feed(competition)
+                response = Response(feed['results'], headers={'X-Feed-Token': str(feed['token'])})
+                response.stale = feed['stale']
+                return response
+            return conditional_response(request, etag, last_modified, build_feed_response)
+
+        cursor = request.query_params.get('cursor') or None
+        try:
+            page_size = min(max(int(request.query_params.get('page_size', FEED_PAGE_SIZE)), 1), FEED_MAX_PAGE_SIZE)
+            if cursor is not None:
+                decode_feed_cursor(cursor)
+        except ValueError:
+            return Response({"detail": "Invalid cursor or page_size."}, status=status.HTTP_400_BAD_REQUEST)
+
+        def build_response():
+            page = get_cached_competition_feed_page(competition, cursor=cursor, page_size=page_size)
+            next_url = None if page['next_cursor'] is None else replace_query_param(request.build_absolute_uri(), 'cursor', page['next_cursor'])
+            return Response({'next': next_url, 'token': page['token'], 'results': page['results']})
+        return conditional_response(request, etag, last_modified, build_response)
+
+
+
+class CompetitionEventsToken(Token):
+    """ short-lived token for the event stream of one competition - EventSource can't set headers, so it goes in the
+    query string (and with it in access logs) instead of the access token """
+    token_type = 'competition_events'
+    lifetime = datetime.timedelta(seconds=60)  # only checked when the stream is opened
+
+    @classmethod
+    def for_competition(cls, user, competition):
+        token = cls.for_user(user)
+        token['competition'] = competition
+        return token
+
+
+class CompetitionEventsTokenAuthentication(JWTAuthentication):
+    """ JWT from the Authorization header or a CompetitionEventsToken of the competition in the ?token=... parameter """
+
+    def authenticate(self, request):
+        result = super().authenticate(request)
+        if result is None and request.query_params.get('token'):
+            try:
+                validated_token = CompetitionEventsToken(request.query_params['token'])
+            except TokenError as e:
+                raise InvalidToken(e.args[0])
+            if validated_token.get('competition') != request.parser_context['kwargs'].get('competition'):
+                raise InvalidToken('Token is not valid for this competition')
+            return self.get_user(validated_token), validated_token
+        return result
+
+
+class CompetitionEventsTokenView(APIView):
+    """ API post view issuing the ?token=... for the event stream of a competition - valid for a minute, for this competition only """
+    permission_classes = [FeedPermissions]
+
+    def post(self, request, competition):
+        competition_obj = Competition.objects.filter(id=competition)
+        self.check_object_permissions(request, competition_obj)
+        return Response({'token': str(CompetitionEventsToken.for_competition(request.user, competition)), 'expires_in': int(CompetitionEventsToken.lifetime.total_seconds())})
+
+
+class EventStreamRenderer(JSONRenderer):
+    """ accepts text/event-stream requests - the events are streamed as is, errors are rendered as JSON """
+    media_type = 'text/event-stream'
+    format = 'event-stream'
 
-        grouped_points = {i['workout']: i for i in all_points.values('workout__user', 'workout__user__username', 'workout__user__strava_allow_follow', 'workout', 'workout__sport_type', 'workout__start_datetime', 'workout__duration', 'workout__steps', 'workout__strava_id', 'award').annotate(points_capped=Sum('points_capped'), points_raw=Sum('points_raw')).order_by('-workout__start_datetime', '-workout__duration', '-workout', '-workout__user')}
 
-        for i in all_points.values('workout', 'id', 'goal', 'goal__name', 'award', 'award__name', 'points_capped', 'points_raw'):
-            if 'details' not in grouped_points[i['workout']]:
-                grouped_points[i['workout']]['details'] = []
-            grouped_points[i['workout']]['details'].append(i)
+class CompetitionEventsView(APIView):
+    """ API view streaming the events of a competition as server-sent events - leaderboard rank changes and feed changes
 
-        return Response(list(grouped_points.values()))
+    Events are small diffs: 'leaderboard' {board, reset, changes: [{id, points, rank, previous_points, previous_rank}]} and
+    'feed' {reset, changed, deleted} like the ?since= delta of the feed. With reset the client has to reload. The stream
+    ends after STREAM_SECONDS - the client reconnects with a new CompetitionEventsToken and should then catch up with the
+    ?since= feed delta.
+    """
+    authentication_classes = [CompetitionEventsTokenAuthentication]
+    permission_classes = [FeedPermissions]
+    renderer_classes = [JSONRenderer, EventStreamRenderer]
+
+    HEARTBEAT_SECONDS = 15  # comment lines keep proxies from closing the idle connection
+    STREAM_SECONDS = 60 * 5
+    RETRY_MILLISECONDS = 5_000
+
+    def get(self, request, competition):
+        competition_obj = Competition.objects.filter(id=competition)
+        self.check_object_permissions(request, competition_obj)
+
+        # changes after the token are in the ?since= delta - also those made before the subscription
+        token = get_feed_token()
+        if not connection.in_atomic_block:
+            # the stream doesn't need the database - don't keep a connection per listening client
+            connection.close()
+
+        def stream():
+            subscription = get_event_channel().subscribe(competition_channel(competition))
+            try:
+                yield f'retry: {self.RETRY_MILLISECONDS}\n\n'
+                yield format_event('ready', {'token': token})
+                end = time.monotonic() + self.STREAM_SECONDS
+                while time.monotonic() < end:
+                    message = subscription.get(timeout=min(self.HEARTBEAT_SECONDS, max(0, end - time.monotonic())))
+                    yield ': ping\n\n' if message is None else message
+            finally:
+                subscription.close()
+
+        response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'  # nginx must pass every event on at once
+        return response
 
 
 
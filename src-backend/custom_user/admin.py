@@ -21,5 +21,7 @@ class RecalcRequestAdmin(admin.ModelAdmin):
         "user",
         "goal",
         "start_datetime",
+        "end_datetime",
         "done",
+        "updated_datetime",
     ]
\ No newline at end of file
@@ -9,7 +9,7 @@ from django.db.models import Sum, Count, Q
 from django.db.models.functions import TruncDate, TruncDay
 
 from .multipurpose import send_email
-from competition.stats import get_competition_stats
+from competition.stats import get_cached_competition_stats
 
 
 @app.task()
@@ -164,12 +164,12 @@ def leaderboard_email(user_pk):
     competition_7d_data = []
 
     for competition in user_obj.my_competitions.filter(start_date__lte=datetime.date.today(), end_date__gte=datetime.date.today()).order_by('-start_date'):
-        competition_all_stats = get_competition_stats(competition.pk)
+        competition_all_stats = get_cached_competition_stats(competition.pk)
         competition_all_data.append({
             'competition': competition_all_stats['competition'],
             'leaderboard': competition_all_stats['leaderboard'],
         })
-        competition_7d_stats = get_competition_stats(competition.pk, last_seven_days=True)
+        competition_7d_stats = get_cached_competition_stats(competition.pk, last_seven_days=True)
         competition_7d_data.append({
             'competition': competition_7d_stats['competition'],
             'leaderboard': competition_7d_stats['leaderboard'],
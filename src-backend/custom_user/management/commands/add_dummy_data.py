@@ -1,26 +1,73 @@
 from django.core.management import BaseCommand
-import datetime, random
-from datetime import timedelta
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+import datetime, random, time
 
-from competition.models import Competition, ActivityGoal, Team, Award, Points
+from competition.models import Competition, ActivityGoal, Team, Award
 from workouts.models import Workout
 from custom_user.models import CustomUser
+from workout_challenge.synthetic_data import GOAL_TEMPLATES, synthetic_workouts, bulk_create_lazily, materialize_points
 
 
 class Command(BaseCommand):
     """Add additional test data"""
 
     # Show this when the user types help
-    help = "Adds test data"
+    help = (
+        "Adds test data - three admin users and two competitions plus as many dummy users (dummy<n>@dummy.local / password) "
+        "and competitions as asked for, with realistic workouts. With --bulk everything is inserted with bulk_create without "
+        "the save() triggers and scored once at the end - e.g. --users 5000 --competitions 50 --workouts-per-user 200 --bulk "
+        "for a million workouts."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=0, help="Dummy users on top of the admin users - each joins one competition and one of its teams")
+        parser.add_argument("--competitions", type=int, default=0, help="Dummy competitions on top of the test competitions")
+        parser.add_argument("--teams", type=int, default=4, help="Teams per dummy competition")
+        parser.add_argument("--workouts-per-user", type=int, default=60, help="Average number of workouts per user")
+        parser.add_argument("--days", type=int, default=180, help="The workouts are spread over this many past days")
+        parser.add_argument("--seed", type=int, default=None, help="Seed of the random data - the same seed gives the same data")
+        parser.add_argument("--bulk", action="store_true", help="Insert with bulk_create without the save() triggers and materialize and recalc all points once at the end")
+
+    def _create(self, model, obj_lst):
+        """ bulk_create without the save() triggers - or save() one by one with all of them """
+        if self.bulk:
+            return model.objects.bulk_create(obj_lst, batch_size=5_000)
+        for obj in obj_lst:
+            obj.save()
+        return obj_lst
+
+    def _join(self, membership_lst):
+        """ add the (user, competition, team or None) memberships - through the m2m tables without the m2m_changed triggers in bulk """
+        if self.bulk:
+            competition_memberships = {(user.pk, competition.pk) for user, competition, _ in membership_lst}
+            CustomUser.my_competitions.through.objects.bulk_create([CustomUser.my_competitions.through(customuser_id=user_id, competition_id=competition_id) for user_id, competition_id in competition_memberships], batch_size=5_000)
+            CustomUser.my_teams.through.objects.bulk_create([CustomUser.my_teams.through(customuser_id=user.pk, team_id=team.pk) for user, _, team in membership_lst if team is not None], batch_size=5_000)
+            return
+        for user, competition, team in membership_lst:
+            user.my_competitions.add(competition)
+            if team is not None:
+                user.my_teams.add(team)
 
     def handle(self, *args, **options):
         """Actual Commandline executed function when manage.py command is called"""
+        # one transaction - a commit per statement is what makes inserting slow, the triggers run on commit anyway
+        with transaction.atomic():
+            self._add_dummy_data(options)
+
+    def _add_dummy_data(self, options):
+        self.bulk = options["bulk"]
+        rnd = random.Random(options["seed"])
+        start_time = time.monotonic()
+        today = datetime.date.today()
+
         test_users = [
             {
                 "email": "user1@admin.local",
                 "password": "password",
                 "first_name": "Charlotte",
                 "last_name": "Doe",
+                "username": "Charlotte D.",
                 "is_superuser": True,
                 "is_staff": True,
                 "strava_athlete_id": 123456789,
@@ -30,6 +77,7 @@ class Command(BaseCommand):
                 "password": "password",
                 "first_name": "Tom",
                 "last_name": "Smith-Bloggs",
+                "username": "Tom S.B.",
                 "is_superuser": True,
                 "is_staff": True,
             },
@@ -38,28 +86,36 @@ class Command(BaseCommand):
                 "password": "password",
                 "first_name": "User",
                 "last_name": "von der Leyen",
+                "username": "User v.d.L.",
                 "is_superuser": False,
                 "is_staff": False,
             },
         ]
 
-        user_obj_dict = {}
-        for user_i in test_users:
-            user_obj = CustomUser.objects.create_user(**user_i)
-            user_obj.set_password(user_i["password"])
-            user_obj.save()
-
-            user_obj_dict[user_i["email"]] = user_obj
+        test_users += [
+            {
+                "email": f"dummy{idx}@dummy.local",
+                "password": "password",
+                "first_name": "Dummy",
+                "last_name": str(idx),
+                "username": f"Dummy {idx}",
+            }
+            for idx in range(options["users"])
+        ]
 
+        # hashing is slow on purpose - hash each password once for all users
+        password_hash = {i: make_password(i) for i in {user_i["password"] for user_i in test_users}}
+        user_lst = self._create(CustomUser, [CustomUser(**{**user_i, "password": password_hash[user_i["password"]]}) for user_i in test_users])
+        user_obj_dict = {user_obj.email: user_obj for user_obj in user_lst}
 
 
         test_competitions = [
             {
-                "owner": CustomUser.objects.get(email="user1@admin.local"),
+                "owner": user_obj_dict["user1@admin.local"],
                 "name": "WHO Competition",
                 "join_code": "WHOComp",
-                "start_date": "2025-05-01",
-                "end_date": "2025-12-31",
+                "start_date": datetime.date(2025, 5, 1),
+                "end_date": datetime.date(2025, 12, 31),
                 "has_teams": True,
                 "teams": [
                     {
@@ -113,11 +169,11 @@ class Command(BaseCommand):
                 ]
             },
             {
-                "owner": CustomUser.objects.get(email="user2@admin.local"),
+                "owner": user_obj_dict["user2@admin.local"],
                 "name": "100k 1k Competition",
                 "join_code": "100k1k",
-                "start_date": "2025-01-01",
-                "end_date": "2025-12-31",
+                "start_date": datetime.date(2025, 1, 1),
+                "end_date": datetime.date(2025, 12, 31),
                 "teams": [
                     {
                         "name": "Team 1",
@@ -153,80 +209,54 @@ class Command(BaseCommand):
             }
         ]
 
+        test_competitions += [
+            {
+                "owner": user_obj_dict["user1@admin.local"],
+                "name": f"Dummy Competition {idx}",
+                "join_code": f"DUMMY{idx}".ljust(10, "X"),
+                "start_date": today - datetime.timedelta(days=options["days"]),
+                "end_date": today + datetime.timedelta(days=30),
+                "has_teams": options["teams"] > 0,
+                "teams": [{"name": f"Team {team_idx + 1}"} for team_idx in range(options["teams"])],
+                "goals": [GOAL_TEMPLATES[(idx + goal_idx) % len(GOAL_TEMPLATES)] for goal_idx in range(3)],
+            }
+            for idx in range(options["competitions"])
+        ]
 
-        for competitions_i in test_competitions:
-            goals = competitions_i.pop("goals", [])
-            awards = competitions_i.pop("awards", [])
-            teams = competitions_i.pop("teams", [])
-            competitions_obj = Competition(**competitions_i)
-            competitions_obj.save()
-
-            for goal_i in goals:
-                goal_obj = ActivityGoal(competition=competitions_obj, **goal_i)
-                goal_obj.save()
-
-            for award_i in awards:
-                award_obj = Award(competition=competitions_obj, **award_i)
-                award_obj.save()
-
-            for team_i in teams:
-                team_i_name = team_i.pop("name")
-                team_i_members = team_i.pop("members", [])
-                team_obj = Team(competition=competitions_obj, name=team_i_name)
-                team_obj.save()
-                for user_i in team_i_members:
-                    user_i_obj = CustomUser.objects.get(email=user_i)
-                    user_i_obj.my_teams.add(team_obj)
-                    user_i_obj.my_competitions.add(competitions_obj)
-                    user_i_obj.save()
-
-
-        test_workouts = []
-        today = datetime.datetime.now()
-        curr_datetime = today - datetime.timedelta(days=30*6)  # 6 months ago
-        while curr_datetime < today:
-            today_entries = random.randint(0, len(test_users))
-            user_entries = random.sample(test_users, k=today_entries)
-            for user_i in user_entries:
-                duration_i = random.randint(15, 75)
-                sport_i = random.sample(['Run', 'Tennis', 'WeightTraining', 'Workout'], k=1)[0]
-
-                workout_i = {
-                        'user': user_i['email'],
-                        'sport_type': sport_i,
-                        'start_datetime': curr_datetime,
-                        'duration': timedelta(minutes=duration_i),
-                        'intensity_category': random.sample([1, 2, 3, 4], k=1)[0],
-                        'kcal': random.uniform(0.6, 1.3) * 10 * duration_i,
-                        'distance': duration_i / random.uniform(5, 8) if sport_i == 'Run' else None,
-                        'strava_id': random.randint(0, 999999999) if random.sample([True, False], k=1)[0] else None,
-                }
-
-                #points_i = []
-                #user_i_obj = CustomUser.objects.get(email=user_i['email'])
-                #for competitions_i in user_i_obj.my_competitions.all():
-                #    if (curr_datetime.date() >= competitions_i.start_date) & (curr_datetime.date() <= competitions_i.end_date):
-                #        for goal_i in competitions_i.activitygoal_set.all():
-                #            points = duration_i * random.uniform(0.75, 2.5) / 25
-                #            points_i.append({
-                #                "goal": goal_i,
-                #                "points_raw": points,
-                #                "points_capped": points,
-                #            })
-
-                test_workouts.append({**workout_i}) #, 'points': points_i})
-                curr_datetime += timedelta(minutes=random.uniform(2, 4) * 60 * 24)
-
-
-        for workout_i in test_workouts:
-            #points = workout_i.pop("points", [])
-            user_email = workout_i.pop("user", None)
-            user = CustomUser.objects.get(email=user_email)
-            workout_obj = Workout(user=user, **workout_i)
-            workout_obj.save()
-
-            #for point_i in points:
-            #    point_obj = Points(workout=workout_obj, **point_i)
-            #    point_obj.save()
+        goal_lst, award_lst, team_lst, membership_lst = [], [], [], []
+        competition_lst = [Competition(**{k: v for k, v in competitions_i.items() if k not in ["goals", "awards", "teams"]}) for competitions_i in test_competitions]
+        for competitions_obj in competition_lst:
+            competitions_obj.join_code = competitions_obj.join_code.upper()  # like save() does
+        competition_lst = self._create(Competition, competition_lst)
+        for competitions_i, competitions_obj in zip(test_competitions, competition_lst):
+            goal_lst += [ActivityGoal(competition=competitions_obj, **goal_i) for goal_i in competitions_i.get("goals", [])]
+            award_lst += [Award(competition=competitions_obj, **award_i) for award_i in competitions_i.get("awards", [])]
+            membership_lst.append((competitions_obj.owner, competitions_obj, None))  # save() adds the owner - bulk_create doesn't
+            for team_i in competitions_i.get("teams", []):
+                team_obj = Team(competition=competitions_obj, name=team_i["name"])
+                team_lst.append(team_obj)
+                membership_lst += [(user_obj_dict[user_i], competitions_obj, team_obj) for user_i in team_i.get("members", [])]
+        self._create(ActivityGoal, goal_lst)
+        self._create(Award, award_lst)
+        self._create(Team, team_lst)
 
+        # the dummy users join the dummy competitions (or the test competitions if there are none) and their teams round robin
+        competition_teams = {competitions_obj.pk: [i for i in team_lst if i.competition_id == competitions_obj.pk] for competitions_obj in competition_lst}
+        dummy_competition_lst = competition_lst[-options["competitions"]:] if options["competitions"] > 0 else competition_lst
+        for idx, user_obj in enumerate(user_lst[len(user_lst) - options["users"]:]):
+            competitions_obj = dummy_competition_lst[idx % len(dummy_competition_lst)]
+            teams = competition_teams[competitions_obj.pk]
+            membership_lst.append((user_obj, competitions_obj, teams[idx // len(dummy_competition_lst) % len(teams)] if len(teams) > 0 else None))
+        self._join(membership_lst)
+        self.stdout.write(f"{len(user_lst)} users / {len(competition_lst)} competitions / {len(goal_lst)} goals / {len(team_lst)} teams created")
 
+        workout_lst = synthetic_workouts(rnd, user_lst, options["workouts_per_user"], today - datetime.timedelta(days=options["days"]), today)
+        if self.bulk:
+            workout_count = bulk_create_lazily(Workout, workout_lst)
+            self.stdout.write(f"{workout_count} workouts created - scoring them...")
+            points_count = materialize_points(competition_lst)
+            self.stdout.write(f"{points_count} points created")
+        else:
+            workout_count = len(self._create(Workout, list(workout_lst)))
+            self.stdout.write(f"{workout_count} workouts created")
+        self.stdout.write(self.style.SUCCESS(f"Test data added in {time.monotonic() - start_time:.1f}s"))
@@ -0,0 +1,69 @@
+import time, statistics
+
+from django.core.management import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from competition.models import Competition
+from competition.views import CompetitionStatsQueryView, FeedQueryView, CompetitionViewSet, TeamViewSet, ActivityGoalViewSet, PointsViewSet
+from workouts.views import WorkoutViewSet
+
+
+class Command(BaseCommand):
+    """Benchmark full vs. conditional (If-None-Match) requests of the polled endpoints"""
+
+    # Show this when the user types help
+    help = "Times each endpoint for a member of the competition - once as full GET and once revalidated with the ETag of the previous response (304 if unchanged)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--competition", type=int, default=None, help="Competition to benchmark - default the one with the most members")
+        parser.add_argument("--repeat", type=int, default=20, help="Requests per endpoint and mode")
+
+    def _endpoints(self, competition):
+        return [
+            ('stats', f'/api/stats/{competition.pk}/', CompetitionStatsQueryView.as_view(), {'competition': competition.pk}),
+            ('feed', f'/api/feed/{competition.pk}/', FeedQueryView.as_view(), {'competition': competition.pk}),
+            ('competitions', '/api/competition/', CompetitionViewSet.as_view({'get': 'list'}), {}),
+            ('teams', '/api/team/', TeamViewSet.as_view({'get': 'list'}), {}),
+            ('goals', '/api/goal/', ActivityGoalViewSet.as_view({'get': 'list'}), {}),
+            ('points', '/api/point/', PointsViewSet.as_view({'get': 'list'}), {}),
+            ('workouts', '/api/workout/', WorkoutViewSet.as_view({'get': 'list'}), {}),
+        ]
+
+    def _request(self, user, view, path, kwargs, headers):
+        request = APIRequestFactory().get(path, **headers)
+        force_authenticate(request, user=user)
+        with CaptureQueriesContext(connection) as queries:
+            start_time = time.perf_counter()
+            response = view(request, **kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+            elapsed = time.perf_counter() - start_time
+        return response, elapsed, len(queries)
+
+    def handle(self, *args, **options):
+        """Actual Commandline executed function when manage.py command is called"""
+        competition_lst = Competition.objects.all()
+        if options["competition"] is not None:
+            competition_lst = competition_lst.filter(pk=options["competition"])
+        competition = max(competition_lst, key=lambda i: i.user.count(), default=None)
+        if competition is None:
+            self.stderr.write(self.style.ERROR("No competition to benchmark - create some with add_dummy_data"))
+            return
+        user = competition.user.first() or competition.owner
+
+        self.stdout.write(f"Competition {competition.pk} ({competition.name}) as user {user.pk}, {options['repeat']} requests each")
+        for name, path, view, kwargs in self._endpoints(competition):
+            response, _, _ = self._request(user, view, path, kwargs, {})  # warm up the caches
+            etag = response.get('ETag')
+
+            for mode, headers in [('full', {}), ('conditional', {'HTTP_IF_NONE_MATCH': etag} if etag else {})]:
+                timings = []
+                for _ in range(options["repeat"]):
+                    response, elapsed, query_count = self._request(user, view, path, kwargs, headers)
+                    timings.append(elapsed)
+                self.stdout.write(
+                    f"  {name:<13} {mode:<12} status={response.status_code} {len(getattr(response, 'content', b'')):>9,} bytes "
+                    f"{query_count:>3} queries  median {statistics.median(timings) * 1000:8.2f}ms"
+                )
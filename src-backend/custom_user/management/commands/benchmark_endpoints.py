@@ -0,0 +1,188 @@
+import time, datetime, json, statistics, tracemalloc
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction, reset_queries
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from workout_challenge.celery import app
+from workout_challenge.synthetic_data import create_synthetic_dataset, DATASET_SIZES
+from competition.leaderboard import get_leaderboard_store
+
+BASELINE_FILE = Path(settings.BASE_DIR) / 'benchmarks' / 'endpoint_baselines.json'
+METRICS = ['queries', 'sql_ms', 'wall_ms', 'peak_kb']
+
+# routes not benchmarked - they call external services or run arbitrary tasks
+SKIPPED_ROUTES = ['strava/link/', 'strava/unlink/', 'strava/sync/', 'password-reset/request/', 'password-reset/confirm/', 'celery/ (POST)']
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    """Benchmark every API route on synthetic datasets and compare the results against the committed baselines"""
+
+    # Show this when the user types help
+    help = (
+        "Creates a synthetic dataset per size inside a transaction that is rolled back, requests every route and records the query count, "
+        "SQL time, wall time and peak memory. Fails if a metric regressed against the baseline - queries have to match exactly, the others "
+        "may grow by --tolerance. Runs on SQLite with the local memory cache and eager celery, no Redis needed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", nargs="+", default=['small', 'medium'], choices=list(DATASET_SIZES), help="Dataset sizes to benchmark")
+        parser.add_argument("--repeat", type=int, default=5, help="Timed requests per endpoint - the median is recorded")
+        parser.add_argument("--metrics", nargs="+", default=METRICS, choices=METRICS, help="Metrics to compare against the baseline")
+        parser.add_argument("--tolerance", type=float, default=2.0, help="Allowed factor for the time and memory metrics")
+        parser.add_argument("--baseline", default=str(BASELINE_FILE), help="Baseline file")
+        parser.add_argument("--update-baseline", action="store_true", help="Write the results as new baseline instead of comparing")
+
+    def _endpoints(self, data):
+        """ (name, method, path, data) of every route with ids from the dataset """
+        competition, team, goal = data['competitions'][0], data['teams'][0] if data['teams'] else None, data['goals'][0]
+        workout = data['workouts'][0]
+        point = data['points'][0]
+        endpoints = [
+            ('competition list', 'get', '/api/competition/', None),
+            ('competition detail', 'get', f'/api/competition/{competition.pk}/', None),
+            ('goal list', 'get', '/api/goal/', None),
+            ('goal detail', 'get', f'/api/goal/{goal.pk}/', None),
+            ('workout list', 'get', '/api/workout/', None),
+            ('workout detail', 'get', f'/api/workout/{workout}/', None),
+            ('point list', 'get', '/api/point/', None),
+            ('point detail', 'get', f'/api/point/{point}/', None),
+            ('user list', 'get', '/api/user/', None),
+            ('user me', 'get', '/api/user/me/', None),
+            ('stats', 'get', f'/api/stats/{competition.pk}/', None),
+            ('feed', 'get', f'/api/feed/{competition.pk}/', None),
+            ('feed page', 'get', f'/api/feed/{competition.pk}/?page_size=50', None),
+            ('feed delta', 'get', f'/api/feed/{competition.pk}/?since=0', None),
+            ('leaderboard', 'get', f'/api/leaderboard/{competition.pk}/', None),
+            ('leaderboard team', 'get', f'/api/leaderboard/{competition.pk}/?board=team', None),
+            ('events', 'get', f'/api/events/{competition.pk}/', None),
+            ('join competition', 'post', f'/api/join/competition/{competition.join_code}/', None),
+            ('celery tasks', 'get', '/api/celery/tasks/', None),
+            ('token', 'post', '/api/token/', {'email': data['users'][0].email, 'password': 'benchmark'}),
+            ('workout bulk', 'post', '/api/workout/bulk/', [
+                {'sport_type': sport_type, 'start_datetime': (competition.start_date + datetime.timedelta(days=idx)).isoformat() + 'T07:00:00Z', 'duration': '00:45:00'}
+                for idx, sport_type in enumerate(['Run', 'Ride', 'Walk', 'Yoga', 'Swim'] * 4)
+            ]),
+        ]
+        if team is not None:
+            endpoints += [
+                ('team list', 'get', '/api/team/', None),
+                ('team detail', 'get', f'/api/team/{team.pk}/', None),
+                ('join team', 'post', f'/api/join/team/?team={team.pk}', None),
+            ]
+        return endpoints
+
+    def _request(self, client, method, path, data):
+        response = getattr(client, method)(path, data=data, format='json')
+        if response.streaming:
+            # the event stream never ends - read the first event
+            iterator = iter(response.streaming_content)
+            next(iterator)
+            next(iterator)
+            # close the closing wrapper of the test client, not the response - it keeps close_old_connections from
+            # closing the connection of the transaction that is rolled back
+            response._iterator.close()
+        return response
+
+    def _measure(self, client, method, path, data, repeat):
+        # query count, SQL time and peak memory of one cold request - the stats / feed caches are cleared
+        cache.clear()
+        reset_queries()  # the query log is capped - a full one captures nothing
+        tracemalloc.start()
+        with CaptureQueriesContext(connection) as queries:
+            response = self._request(client, method, path, data)
+        # read the captured queries now - the timed requests below reset the query log
+        captured_queries = queries.captured_queries
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if response.status_code >= 400:
+            raise CommandError(f"{method.upper()} {path} failed with {response.status_code}: {getattr(response, 'content', b'')[:200]}")
+
+        timings = []
+        for _ in range(repeat):
+            cache.clear()
+            start_time = time.perf_counter()
+            self._request(client, method, path, data)
+            timings.append(time.perf_counter() - start_time)
+        return {
+            'queries': len(captured_queries),
+            'sql_ms': round(sum(float(i['time']) for i in captured_queries) * 1000, 2),
+            'wall_ms': round(statistics.median(timings) * 1000, 2),
+            'peak_kb': round(peak / 1024, 1),
+        }
+
+    def _benchmark_size(self, size, repeat):
+        results = {}
+        try:
+            with transaction.atomic():
+                get_leaderboard_store().clear()  # the in-process store of the local memory cache
+                data = create_synthetic_dataset(**DATASET_SIZES[size], prefix=f'bench{size}', password='benchmark')
+                user = data['users'][0]
+                user.is_staff = True  # for the celery routes
+                user.save(update_fields=['is_staff'])
+                data['workouts'] = list(user.workout_set.order_by('pk').values_list('pk', flat=True)[:1])
+                data['points'] = list(data['goals'][0].points_set.order_by('pk').values_list('pk', flat=True)[:1])
+                client = APIClient()
+                client.force_authenticate(user)
+                for name, method, path, request_data in self._endpoints(data):
+                    results[name] = self._measure(client, method, path, request_data, repeat)
+                    self.stdout.write(f"  {size:<7} {name:<20} " + "  ".join(f"{key}={value}" for key, value in results[name].items()))
+                raise Rollback()
+        except Rollback:
+            pass
+        return results
+
+    def _regressions(self, results, baseline, metrics, tolerance):
+        regressions = []
+        for size, endpoints in results.items():
+            for name, result in endpoints.items():
+                expected = baseline.get(size, {}).get(name)
+                if expected is None:
+                    self.stdout.write(self.style.WARNING(f"No baseline for {size} / {name}"))
+                    continue
+                for metric in metrics:
+                    # queries are deterministic - times and memory depend on the machine, so they get a factor and some slack
+                    limit = expected[metric] if metric == 'queries' else expected[metric] * tolerance + {'sql_ms': 2, 'wall_ms': 5, 'peak_kb': 64}[metric]
+                    if result[metric] > limit:
+                        regressions.append(f"{size} / {name}: {metric} {result[metric]} > {limit:g} (baseline {expected[metric]})")
+        return regressions
+
+    def handle(self, *args, **options):
+        """Actual Commandline executed function when manage.py command is called"""
+        always_eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        try:
+            with override_settings(
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'benchmark'}},
+                PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+            ):
+                results = {size: self._benchmark_size(size, options["repeat"]) for size in options["sizes"]}
+        finally:
+            app.conf.task_always_eager = always_eager
+        self.stdout.write(f"Skipped routes: {', '.join(SKIPPED_ROUTES)}")
+
+        baseline_file = Path(options["baseline"])
+        if options["update_baseline"]:
+            baseline = json.loads(baseline_file.read_text()) if baseline_file.exists() else {}
+            baseline.update(results)
+            baseline_file.parent.mkdir(parents=True, exist_ok=True)
+            baseline_file.write_text(json.dumps(baseline, indent=2, sort_keys=True) + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Baseline written to {baseline_file}"))
+            return
+
+        if not baseline_file.exists():
+            raise CommandError(f"No baseline at {baseline_file} - create it with --update-baseline")
+        regressions = self._regressions(results, json.loads(baseline_file.read_text()), options["metrics"], options["tolerance"])
+        if len(regressions) > 0:
+            raise CommandError("Performance regressions:\n" + "\n".join(regressions))
+        self.stdout.write(self.style.SUCCESS("No regressions"))
@@ -0,0 +1,117 @@
+import time, datetime, statistics
+
+from django.apps import apps
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from workout_challenge.synthetic_data import create_synthetic_dataset, DATASET_SIZES
+from competition.feed import get_competition_feed, get_competition_feed_page
+from competition.rollup import refresh_daily_points
+from competition.stats import get_competition_stats
+from custom_user.point_recalc import _recalc_group
+
+# (app label, model, index name) of the composite indexes of the hot paths - dropped for the "before" run
+INDEXES = [
+    ('workouts', 'Workout', 'workout_start_idx'),
+    ('workouts', 'Workout', 'workout_user_sport_start_idx'),
+    ('competition', 'DailyPoints', 'daily_points_comp_day_user_idx'),
+]
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    """Benchmark the hot paths of the scoring, stats, feed and strava sync with and without their composite indexes"""
+
+    # Show this when the user types help
+    help = (
+        "Creates --datasets synthetic datasets inside a transaction that is rolled back, drops the composite indexes and times the recalc, "
+        "stats, feed, steps and strava lookups, then creates the indexes again and times them again. Prints the EXPLAIN plan of the slowest "
+        "query of each path before and after."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", default='large', choices=list(DATASET_SIZES), help="Size of each synthetic dataset")
+        parser.add_argument("--datasets", type=int, default=3, help="Number of datasets - the others make the tables bigger than one competition")
+        parser.add_argument("--repeat", type=int, default=5, help="Runs per path - the median is recorded")
+
+    def _paths(self, data):
+        """ (name, function) of every hot path on the last dataset """
+        Workout = apps.get_model('workouts', 'Workout')
+        competition, goal = data['competitions'][0], data['goals'][0]
+        user = competition.user.order_by('pk').last()
+        task_group = {'user': user.pk, 'goal': goal.pk, 'start_datetime': datetime.datetime.combine(competition.start_date, datetime.time.min, tzinfo=datetime.timezone.utc).isoformat(), 'end_datetime': None}
+        steps = Workout(user=user, sport_type='Steps', steps=8_000, start_datetime=timezone.now() - datetime.timedelta(days=3), duration=datetime.timedelta(0))
+        strava_ids = list(range(10_000_000, 10_000_200))  # a page of activities
+        return [
+            ('recalc stream', lambda: _recalc_group(task_group, goal)),
+            ('rollup', lambda: refresh_daily_points(competition)),
+            ('stats', lambda: get_competition_stats(competition.pk)),
+            ('feed', lambda: get_competition_feed(competition.pk)),
+            ('feed page', lambda: get_competition_feed_page(competition.pk)),
+            ('steps estimate', lambda: steps.estimate()),
+            ('strava lookup', lambda: set(Workout.objects.filter(strava_id__in=strava_ids).values_list('strava_id', flat=True))),
+        ]
+
+    def _explain(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute(f"{connection.ops.explain_query_prefix()} {sql}")
+            return "\n".join(f"    {row[-1]}" for row in cursor.fetchall())
+
+    def _run(self, paths, repeat, explain_sql=None):
+        """ median time, query count and EXPLAIN plan of the slowest query (or the given one) of every path """
+        results = {}
+        for name, function in paths:
+            function()  # warm up - e.g. the first recalc writes the points_capped the synthetic data doesn't have
+            with CaptureQueriesContext(connection) as queries:
+                function()
+            sql = max(queries.captured_queries, key=lambda i: float(i['time']))['sql'] if explain_sql is None else explain_sql[name]
+            timings = []
+            for _ in range(repeat):
+                start_time = time.perf_counter()
+                function()
+                timings.append(time.perf_counter() - start_time)
+            results[name] = {'ms': statistics.median(timings) * 1000, 'queries': len(queries), 'sql': sql, 'plan': self._explain(sql)}
+        return results
+
+    def _set_indexes(self, create):
+        """ drop or create the INDEXES as the migrations would """
+        schema_editor = connection.schema_editor()  # only for the SQL - not entered, SQLite doesn't allow that in a transaction
+        with connection.cursor() as cursor:
+            for app_label, model_name, index_name in INDEXES:
+                model = apps.get_model(app_label, model_name)
+                index = next(i for i in model._meta.indexes if i.name == index_name)
+                cursor.execute(str(index.create_sql(model, schema_editor)) if create else f"DROP INDEX {connection.ops.quote_name(index_name)}")
+            cursor.execute('ANALYZE')
+
+    def handle(self, *args, **options):
+        """Actual Commandline executed function when manage.py command is called"""
+        try:
+            with transaction.atomic():
+                self.stdout.write(f"Creating {options['datasets']} {options['size']} synthetic datasets...")
+                for idx in range(options["datasets"]):
+                    data = create_synthetic_dataset(**DATASET_SIZES[options["size"]], prefix=f'benchidx{idx}', seed=idx)
+                Workout, Points = apps.get_model('workouts', 'Workout'), apps.get_model('competition', 'Points')
+                self.stdout.write(f"{Workout.objects.count():,} workouts / {Points.objects.count():,} points")
+                paths = self._paths(data)
+
+                self._set_indexes(create=False)
+                before = self._run(paths, options["repeat"])
+                self._set_indexes(create=True)
+                after = self._run(paths, options["repeat"], explain_sql={name: result['sql'] for name, result in before.items()})
+                raise Rollback()
+        except Rollback:
+            pass
+
+        for name, _ in paths:
+            self.stdout.write(self.style.SUCCESS(f"{name}:"))
+            self.stdout.write(f"  before ({before[name]['queries']} queries):\n{before[name]['plan']}")
+            self.stdout.write(f"  after ({after[name]['queries']} queries):\n{after[name]['plan']}")
+        self.stdout.write(self.style.SUCCESS(f"Indexes: {', '.join(i[2] for i in INDEXES)}"))
+        self.stdout.write(f"  {'path':<16} {'before':>10} {'after':>10}")
+        for name, _ in paths:
+            self.stdout.write(f"  {name:<16} {before[name]['ms']:>8.2f}ms {after[name]['ms']:>8.2f}ms  ({before[name]['ms'] / max(after[name]['ms'], 0.001):.1f}x)")
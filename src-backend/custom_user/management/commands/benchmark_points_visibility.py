@@ -0,0 +1,109 @@
+import time, datetime, random, statistics
+
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory
+
+from competition.models import Competition, ActivityGoal, Points
+from competition.views import PointsViewSet
+from custom_user.models import CustomUser
+from workouts.models import Workout
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    """Benchmark the visibility query of the points list - the old OR-join plus DISTINCT vs. the indexed IN lookups"""
+
+    # Show this when the user types help
+    help = "Prints the EXPLAIN plan and the median time of the first page / count of both queries. With --synthetic a dataset of that many points is created inside a transaction and rolled back afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--synthetic", type=int, default=None, help="Create a synthetic dataset with this many points (e.g. 100000) - rolled back at the end")
+        parser.add_argument("--user", type=int, default=None, help="User to benchmark - default the member of the most competitions")
+        parser.add_argument("--repeat", type=int, default=10, help="Runs per query")
+
+    def _create_synthetic(self, point_count):
+        """ competitions of 10 members with 2 goals each, every workout scores in both goals """
+        rnd = random.Random(1)
+        user_count = max(10, point_count // (2 * 250))
+        workouts_per_user = point_count // (2 * user_count)
+        CustomUser.objects.bulk_create([CustomUser(email=f'benchmark{idx}@benchmark.local', username=f'benchmark{idx}') for idx in range(user_count)])
+        user_lst = list(CustomUser.objects.filter(email__endswith='@benchmark.local').order_by('pk'))
+
+        Competition.objects.bulk_create([Competition(owner=user_lst[idx], name=f'Benchmark {idx}', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 12, 31), join_code=f'BENCH{idx}') for idx in range(0, user_count, 10)])
+        competition_lst = list(Competition.objects.filter(name__startswith='Benchmark ').order_by('pk'))
+        ActivityGoal.objects.bulk_create([ActivityGoal(competition=competition, name=name, metric=metric, period='week', goal=100) for competition in competition_lst for name, metric in [('Move', 'kcal'), ('Exercise', 'min')]])
+        goals = {}
+        for goal in ActivityGoal.objects.filter(competition__in=competition_lst):
+            goals.setdefault(goal.competition_id, []).append(goal)
+        CustomUser.my_competitions.through.objects.bulk_create([CustomUser.my_competitions.through(customuser_id=user.pk, competition_id=competition_lst[idx // 10].pk) for idx, user in enumerate(user_lst)])
+
+        start_datetime = timezone.make_aware(datetime.datetime(2025, 1, 1, 7))
+        Workout.objects.bulk_create([
+            Workout(user=user, sport_type='Run', start_datetime=start_datetime + datetime.timedelta(hours=rnd.randint(0, 24 * 360)), duration=datetime.timedelta(minutes=rnd.randint(15, 90)))
+            for user in user_lst for _ in range(workouts_per_user)
+        ], batch_size=5_000)
+        user_goals = {user.pk: goals[competition_lst[idx // 10].pk] for idx, user in enumerate(user_lst)}
+        Points.objects.bulk_create([
+            Points(goal=goal, workout_id=workout_id, points_raw=10, points_capped=10)
+            for workout_id, user_id in Workout.objects.filter(user__in=user_lst).values_list('pk', 'user')
+            for goal in user_goals[user_id]
+        ], batch_size=5_000)
+        with connection.cursor() as cursor:
+            for model in [CustomUser, Competition, ActivityGoal, Workout, Points]:
+                cursor.execute(f'ANALYZE {model._meta.db_table}')
+        return user_lst[0]
+
+    def _old_queryset(self, user):
+        return Points.objects.filter(Q(goal__competition__owner=user) | Q(goal__competition__user=user) | Q(workout__user=user)).distinct().order_by('-workout__start_datetime', '-workout__duration', '-workout', '-workout__user')
+
+    def _new_queryset(self, user):
+        view = PointsViewSet()
+        view.request = APIRequestFactory().get('/api/point/')
+        view.request.user = user
+        return view.get_queryset()
+
+    def _time(self, function, repeat):
+        timings = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start_time)
+        return statistics.median(timings) * 1000
+
+    def _benchmark(self, user, repeat):
+        self.stdout.write(f"User {user.pk} - {Points.objects.count():,} points in total")
+        old_ids, new_ids = set(self._old_queryset(user).values_list('pk', flat=True)), set(self._new_queryset(user).values_list('pk', flat=True))
+        if old_ids != new_ids:
+            self.stderr.write(self.style.ERROR(f"The queries differ: {len(old_ids)} vs. {len(new_ids)} points"))
+
+        for name, get_queryset in [('old (OR join + DISTINCT)', self._old_queryset), ('new (indexed IN lookups)', self._new_queryset)]:
+            self.stdout.write(self.style.SUCCESS(f"{name}:"))
+            self.stdout.write(get_queryset(user)[:50].explain())
+            first_page = self._time(lambda: list(get_queryset(user)[:50]), repeat)
+            count = self._time(lambda: get_queryset(user).count(), repeat)
+            self.stdout.write(f"  {len(new_ids):,} visible points - first page median {first_page:.2f}ms, count median {count:.2f}ms")
+
+    def handle(self, *args, **options):
+        """Actual Commandline executed function when manage.py command is called"""
+        try:
+            with transaction.atomic():
+                if options["synthetic"] is not None:
+                    self.stdout.write(f"Creating {options['synthetic']:,} synthetic points...")
+                    user = self._create_synthetic(options["synthetic"])
+                elif options["user"] is not None:
+                    user = CustomUser.objects.get(pk=options["user"])
+                else:
+                    user = max(CustomUser.objects.all(), key=lambda i: i.my_competitions.count(), default=None)
+                if user is None:
+                    self.stderr.write(self.style.ERROR("No user to benchmark - create some with add_dummy_data or use --synthetic"))
+                    return
+                self._benchmark(user, options["repeat"])
+                raise Rollback()
+        except Rollback:
+            pass
@@ -0,0 +1,64 @@
+import time, datetime
+
+from celery import current_app
+from django.core.management import BaseCommand
+from django.conf import settings
+
+from competition.models import Competition, Points
+from custom_user.point_recalc import recalc_points, enqueue_recalc_many
+
+
+class Command(BaseCommand):
+    """Benchmark the point recalculation throughput of the running celery workers"""
+
+    # Show this when the user types help
+    help = "Marks every (user, goal) stream as dirty and times the sharded point recalculation. Run it once per worker --autoscale setting to compare the throughput."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shards", nargs="+", type=int, default=[1, settings.RECALC_SHARDS], help="Shard counts to benchmark")
+        parser.add_argument("--repeat", type=int, default=3, help="Runs per shard count")
+        parser.add_argument("--competition", type=int, default=None, help="Only recalculate this competition")
+        parser.add_argument("--reset", action="store_true", help="Clear points_capped before each run so every row is written")
+        parser.add_argument("--timeout", type=int, default=60 * 30, help="Seconds to wait for a run to finish")
+
+    def _mark_all_dirty(self, competition_id):
+        competition_lst = Competition.objects.prefetch_related('activitygoal_set', 'user')
+        if competition_id is not None:
+            competition_lst = competition_lst.filter(pk=competition_id)
+
+        request_lst = []
+        for competition in competition_lst:
+            start_datetime = datetime.datetime.combine(competition.start_date, datetime.time.min, tzinfo=datetime.timezone.utc)
+            for goal in competition.activitygoal_set.all():
+                for user in competition.user.all():
+                    request_lst.append((user, goal, start_datetime, None))
+        return enqueue_recalc_many(request_lst)
+
+    def handle(self, *args, **options):
+        """Actual Commandline executed function when manage.py command is called"""
+        results = []
+        for shard_count in options["shards"]:
+            for run in range(options["repeat"]):
+                if options["reset"]:
+                    points_lst = Points.objects.all()
+                    if options["competition"] is not None:
+                        points_lst = points_lst.filter(goal__competition=options["competition"])
+                    points_lst.update(points_capped=None)
+                streams = self._mark_all_dirty(options["competition"])
+
+                start_time = time.monotonic()
+                dispatch = recalc_points.delay(shard_count=shard_count).get(timeout=options["timeout"])
+                if not isinstance(dispatch, dict) or 'summary_task_id' not in dispatch:
+                    self.stderr.write(self.style.ERROR(f"Recalc was not dispatched: {dispatch}"))
+                    return
+                summary = current_app.AsyncResult(dispatch['summary_task_id']).get(timeout=options["timeout"])
+                elapsed = time.monotonic() - start_time
+
+                rows_per_second = summary['rows_scanned'] / elapsed if elapsed > 0 else 0
+                results.append((shard_count, run, streams, summary['rows_scanned'], summary['rows_changed'], elapsed, rows_per_second))
+                self.stdout.write(f"shards={shard_count} run={run + 1}: {streams} streams / {summary['rows_scanned']} rows scanned / {summary['rows_changed']} rows changed in {elapsed:.2f}s ({rows_per_second:,.0f} rows/s)")
+
+        self.stdout.write(self.style.SUCCESS("Best throughput per shard count:"))
+        for shard_count in options["shards"]:
+            best = max(i[6] for i in results if i[0] == shard_count)
+            self.stdout.write(f"  shards={shard_count}: {best:,.0f} rows/s")
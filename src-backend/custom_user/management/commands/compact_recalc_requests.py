@@ -0,0 +1,50 @@
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+
+from custom_user.models import RecalcRequest
+
+
+class Command(BaseCommand):
+    """Merge legacy recalc requests into one row per (user, goal)"""
+
+    # Show this when the user types help
+    help = "Merges duplicate recalc requests into one row per (user, goal) - run before migrate so the unique constraint can be added"
+
+    def handle(self, *args, **options):
+        """Actual Commandline executed function when manage.py command is called"""
+        table = RecalcRequest._meta.db_table
+        with connection.cursor() as cursor:
+            if table not in connection.introspection.table_names(cursor):
+                self.stdout.write("No recalc requests table yet - nothing to compact")
+                return
+            columns = [i.name for i in connection.introspection.get_table_description(cursor, table)]
+
+        # the table may still have an older schema than the model - only touch columns that exist
+        has_end_datetime = 'end_datetime' in columns
+        fields = ['pk', 'user', 'goal', 'start_datetime'] + (['end_datetime'] if has_end_datetime else [])
+
+        merged = {}
+        for request in RecalcRequest.objects.values(*fields).order_by('pk'):
+            key = (request['user'], request['goal'])
+            end_datetime = request.get('end_datetime')
+            if key not in merged:
+                merged[key] = {'keep': request['pk'], 'drop': [], 'start_datetime': request['start_datetime'], 'end_datetime': end_datetime}
+                continue
+            group = merged[key]
+            group['drop'].append(request['pk'])
+            group['start_datetime'] = min(group['start_datetime'], request['start_datetime'])
+            group['end_datetime'] = None if end_datetime is None or group['end_datetime'] is None else max(end_datetime, group['end_datetime'])
+
+        compacted = 0
+        with transaction.atomic():
+            for group in merged.values():
+                if len(group['drop']) == 0:
+                    continue
+                update = {'start_datetime': group['start_datetime']}
+                if has_end_datetime:
+                    update['end_datetime'] = group['end_datetime']
+                RecalcRequest.objects.filter(pk=group['keep']).update(**update)
+                RecalcRequest.objects.filter(pk__in=group['drop']).delete()
+                compacted += len(group['drop'])
+
+        self.stdout.write(self.style.SUCCESS(f"Compacted {compacted} recalc requests into {len(merged)} (user, goal) rows"))
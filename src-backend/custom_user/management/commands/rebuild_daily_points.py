@@ -0,0 +1,28 @@
+from django.core.management import BaseCommand
+
+from competition.models import Competition
+from competition.rollup import refresh_daily_points
+
+
+class Command(BaseCommand):
+    """Rebuild the daily points rollup of the competition stats"""
+
+    # Show this when the user types help
+    help = "Rebuilds the daily points rollup the competition stats are read from - run once after adding it or to repair it"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--competition", type=int, default=None, help="Only rebuild this competition")
+        parser.add_argument("--if-empty", action="store_true", help="Only rebuild competitions without any rollup rows yet")
+
+    def handle(self, *args, **options):
+        """Actual Commandline executed function when manage.py command is called"""
+        competition_lst = Competition.objects.all()
+        if options["competition"] is not None:
+            competition_lst = competition_lst.filter(pk=options["competition"])
+        if options["if_empty"]:
+            competition_lst = competition_lst.filter(dailypoints__isnull=True)
+
+        for competition in competition_lst.distinct():
+            rows = refresh_daily_points(competition)
+            self.stdout.write(f"{competition}: {rows} daily rows")
+        self.stdout.write(self.style.SUCCESS("Daily points rollup rebuilt"))
@@ -2,7 +2,8 @@ import requests
 import qrcode, datetime
 from decimal import Decimal
 
-from django.db import models
+from django.db import models, transaction
+from django.apps import apps
 from django.utils.translation import gettext_lazy as _
 
 from django.contrib.auth.base_user import BaseUserManager
@@ -14,6 +15,8 @@ from django.db.models.signals import m2m_changed
 from django.dispatch import receiver
 
 from competition.scorer import trigger_user_change
+from competition.stats import bump_competition_stats_version
+from competition.leaderboard import update_team_leaderboard
 from custom_user.emails.celery_emails import welcome_email
 
 # Create your models here.
@@ -180,6 +183,18 @@ def my_competitions_changed_handler(sender, instance, action, pk_set, **kwargs):
                     trigger_user_change(instance=user_obj, new=False, changes={'my_competitions': ([instance.pk], None)})
 
 
+@receiver(m2m_changed, sender=CustomUser.my_teams.through)
+def my_teams_changed_handler(sender, instance, action, pk_set, **kwargs):
+    if 'post' in action:
+        Team = apps.get_model('competition', 'Team')
+        if isinstance(instance, CustomUser):
+            # instance user obj / pk_set team ids - a clear has no pk_set, so refresh all competitions of the user
+            competition_ids = set(instance.my_competitions.values_list('pk', flat=True)) if pk_set is None else set(Team.objects.filter(pk__in=pk_set).values_list('competition', flat=True))
+        else:  # is instance of Team
+            competition_ids = {instance.competition_id}
+        bump_competition_stats_version(competition_ids)
+        transaction.on_commit(lambda: [update_team_leaderboard(i) for i in competition_ids])
+
 
 def get_strava_auth_url(user_id):
     """ Generate the initial auth url the user clicks, which will re-direct back to this page providing the code."""
@@ -204,12 +219,22 @@ def make_url_qr_code(url, path):
 
 
 class RecalcRequest(models.Model):
-    """ Recalc Request model to track which point caps need to be updated """
+    """ Recalc Request model to track which point caps need to be updated - one row per (user, goal) covering all pending changes """
 
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=False, blank=False)
     goal = models.ForeignKey('competition.ActivityGoal', on_delete=models.CASCADE, null=False, blank=False)
     start_datetime = models.DateTimeField(null=False, blank=False)
-    done = models.BooleanField(default=False, null=False, blank=False)
+    end_datetime = models.DateTimeField(null=True, blank=True)  # last affected workout - None means until the end of the competition
+    done = models.BooleanField(default=False, null=False, blank=False)  # claimed by a running recalc - set back to False by new changes
+    updated_datetime = models.DateTimeField(default=timezone.now, null=False, blank=False)  # last change or claim
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'goal'], name='unique_recalc_request_user_goal')
+        ]
+        indexes = [
+            models.Index(fields=['done'], name='recalc_request_done_idx'),
+        ]
 
     def __str__(self):
         return f'{self.goal} - {self.start_datetime}'
\ No newline at end of file
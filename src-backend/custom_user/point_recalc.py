@@ -1,57 +1,398 @@
-import datetime
+import time, datetime, random, itertools
+from decimal import Decimal
 
-from django.db.models import Min
+from celery import chord
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import Q, Case, When, Value, DateTimeField
+from django.db.models.functions import Least, Greatest
+from django.utils import timezone
 
 from django.core.cache import cache
-from workout_challenge.celery import app, is_task_already_executing
+from workout_challenge.celery import app
+from workout_challenge.single_flight import SingleFlightLock
+from competition.rollup import refresh_daily_points, local_date
+from competition.feed import record_feed_changes
 from django.apps import apps
 from django.contrib.auth import get_user_model
 
 
-def trigger_recalc_points():
-    last_recalc = cache.get('last_recalc_points', None)
+RECALC_DEBOUNCE_SECONDS = 10  # wait this long after the last trigger for more changes to come in
+RECALC_MAX_DELAY_SECONDS = 60  # ... but never longer than this after the first trigger
+RECALC_SCHEDULED_KEY = 'recalc_points_scheduled'  # first trigger of the pending run - set while a run is scheduled
+RECALC_LAST_TRIGGER_KEY = 'recalc_points_last_trigger'
+RECALC_CLAIM_EXPIRY = datetime.timedelta(hours=1)  # claimed requests of a crashed run are picked up again after this
+RECALC_ORPHAN_AFTER = datetime.timedelta(seconds=RECALC_MAX_DELAY_SECONDS * 5)  # pending requests whose scheduled run got lost
+
+
+def enqueue_recalc(user, goal, start_datetime, end_datetime=None):
+    """ durably queue a point recalc for the (user, goal) stream from start_datetime on - end_datetime None means until the end """
+    enqueue_recalc_many([(user, goal, start_datetime, end_datetime)])
+
+
+def enqueue_recalc_many(requests):
+    """ queue many (user, goal, start_datetime, end_datetime) recalcs - merged into one upserted row per (user, goal) """
+    merged = {}
+    for user, goal, start_datetime, end_datetime in requests:
+        key = (getattr(user, 'pk', user), getattr(goal, 'pk', goal))
+        start_datetime, end_datetime = _as_datetime(start_datetime), _as_datetime(end_datetime)
+        if key in merged:
+            merged_start, merged_end = merged[key]
+            start_datetime = min(start_datetime, merged_start)
+            end_datetime = None if end_datetime is None or merged_end is None else max(end_datetime, merged_end)
+        merged[key] = (start_datetime, end_datetime)
+
+    for (user_id, goal_id), (start_datetime, end_datetime) in merged.items():
+        _upsert_recalc_request(user_id, goal_id, start_datetime, end_datetime)
+    return len(merged)
+
 
-    if last_recalc is None or last_recalc < datetime.datetime.now() - datetime.timedelta(seconds=30):
-        cache.set('last_recalc_points', datetime.datetime.now(), 60 * 10)
-        eta = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=10)
-        recalc_points.apply_async(eta=eta)
+def _upsert_recalc_request(user_id, goal_id, start_datetime, end_datetime):
+    """ widen the pending range of the (user, goal) row or create it - a claimed row is handed back to the queue """
+    RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
+    now = timezone.now()
+    if end_datetime is None:
+        new_end_datetime = Value(None, output_field=DateTimeField())
     else:
-        print('Recalc points task skipped because it was triggered less than 30 seconds ago')
+        new_end_datetime = Case(When(end_datetime__isnull=True, then=Value(None, output_field=DateTimeField())), default=Greatest('end_datetime', Value(end_datetime)))
+
+    for _ in range(2):
+        # single UPDATE statement so concurrent triggers can't lose each other's range
+        if RecalcRequest.objects.filter(user_id=user_id, goal_id=goal_id).update(
+            start_datetime=Least('start_datetime', Value(start_datetime)), end_datetime=new_end_datetime, done=False, updated_datetime=now,
+        ) > 0:
+            return
+        try:
+            with transaction.atomic():
+                RecalcRequest.objects.create(user_id=user_id, goal_id=goal_id, start_datetime=start_datetime, end_datetime=end_datetime, updated_datetime=now)
+            return
+        except IntegrityError:
+            pass  # created concurrently - merge into it
+
+
+def _as_datetime(value):
+    """ competition start dates are plain dates - recalc from midnight UTC """
+    if value is None or isinstance(value, datetime.datetime) and timezone.is_aware(value):
+        return value
+    if isinstance(value, datetime.datetime):
+        return timezone.make_aware(value, datetime.timezone.utc)
+    return datetime.datetime.combine(value, datetime.time.min, tzinfo=datetime.timezone.utc)
 
 
-@app.task(bind=True, time_limit=60 * 30, max_retries=3)  # 30 min time limit
-def recalc_points(self):
-    if is_task_already_executing('recalc_points'):
-        print('Recalc points task skipped because it is already running')
-        return 'Skipped because it is already running.'
+def trigger_recalc_points():
+    """ schedule a recalc of all queued requests once the current transaction is committed """
+    transaction.on_commit(_schedule_recalc_points)
 
-    print('Recalculating points...')
 
-    ActivityGoal = apps.get_model('competition', 'ActivityGoal')
+def _schedule_recalc_points():
+    now = time.time()
+    cache.set(RECALC_LAST_TRIGGER_KEY, now, RECALC_MAX_DELAY_SECONDS * 10)
+    # only the first trigger schedules a run - later triggers are picked up by it as their requests are in the database
+    if cache.add(RECALC_SCHEDULED_KEY, now, RECALC_MAX_DELAY_SECONDS * 5):
+        recalc_points.apply_async(countdown=RECALC_DEBOUNCE_SECONDS)
+
+
+RECALC_WRITE_CHUNK_SIZE = 500  # rows per bulk UPDATE statement
+RECALC_READ_CHUNK_SIZE = 2_000  # rows per fetch when streaming a (user, goal) stream
+POINTS_CAPPED_QUANTIZE = Decimal('0.01')  # points_capped is stored with 2 decimal places
+
+
+def _points_capped_changed(stored, earned_points):
+    """ compare the stored points_capped with the newly earned points as they would be saved to the database """
+    if stored is None:
+        return True
+    return Decimal(stored).quantize(POINTS_CAPPED_QUANTIZE) != Decimal(earned_points).quantize(POINTS_CAPPED_QUANTIZE)
+
+
+def _week_start(start_datetime):
+    """ Monday 00:00 (UTC) of the ISO week of start_datetime - the Scorer's day/week memory is empty there """
+    start_date = start_datetime.astimezone(datetime.timezone.utc).date()
+    monday = start_date - datetime.timedelta(days=start_date.weekday())
+    return datetime.datetime.combine(monday, datetime.time.min, tzinfo=datetime.timezone.utc)
+
+
+def _iso_week(start_datetime):
+    """ (ISO year, ISO week) of start_datetime - the Scorer's week segment key """
+    return start_datetime.isocalendar()[:2]
+
+
+def _score_week(scorer, week_rows, batch=True):
+    """ score the (id, points_raw, start_datetime, points_capped) rows of one ISO week - the scorer memory resets on a new week """
+    if batch:
+        return scorer.calculate_points_batch(
+            points_raw=[i[1] for i in week_rows],
+            dates=[i[2].date() for i in week_rows],
+            weeks=[_iso_week(i[2]) for i in week_rows],
+        )
+    return [scorer.calculate_points_at(points_raw=i[1], start_datetime=i[2]) for i in week_rows]
+
+
+def _write_points_capped(changed_rows):
+    """ bulk update the (id, points_capped) rows - plain id-only instances, nothing is loaded for the write
+
+    Quantized here - SQLite would keep the unrounded value of the Scorer and the sums of the stats would drift from it.
+    """
     Points = apps.get_model('competition', 'Points')
-    RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
+    with transaction.atomic():
+        Points.objects.bulk_update([Points(id=pk, points_capped=Decimal(points_capped).quantize(POINTS_CAPPED_QUANTIZE)) for pk, points_capped in changed_rows], ['points_capped'], batch_size=RECALC_WRITE_CHUNK_SIZE)
 
-    all_tasks = RecalcRequest.objects.filter(done=False)
-    grouped_tasks = all_tasks.values('user', 'goal').annotate(start_datetime=Min('start_datetime'))
-    for task_group in grouped_tasks:
-        points_lst = Points.objects.filter(goal=task_group['goal'], workout__user=task_group['user'], workout__start_datetime__gte=task_group['start_datetime']).order_by('workout__start_datetime')
 
-        goal = ActivityGoal.objects.get(pk=task_group['goal'])
+def _recalc_group(task_group, goal, batch=True):
+    """ Re-score the points of one (user, goal) stream and write the changed points_capped.
 
-        scorer = Scorer()
-        scorer.set_goal(goal)
+    Streams plain (id, points_raw, start_datetime, points_capped, workout id) tuples in chunks, so memory stays flat no
+    matter how many points the stream has.
 
-        for points in points_lst:
-            earned_points = scorer.calculate_points(points)
-            setattr(points, 'points_capped', earned_points)
-            points.save()
+    Returns: tuple of rows scanned and rows changed
+    """
+    Points = apps.get_model('competition', 'Points')
 
-    all_tasks.delete()
-    print('All points recalculated.')
-    return [{k: str(v) for k, v in i.items()} for i in grouped_tasks]
+    start_datetime = datetime.datetime.fromisoformat(task_group['start_datetime'])
+    end_datetime = None if task_group['end_datetime'] is None else datetime.datetime.fromisoformat(task_group['end_datetime'])
+
+    # replay from the start of the first affected week, nothing before it can change
+    points_rows = (
+        Points.objects
+        .filter(goal=task_group['goal'], workout__user=task_group['user'], workout__start_datetime__gte=_week_start(start_datetime))
+        .order_by('workout__start_datetime', 'pk')
+        .values_list('id', 'points_raw', 'workout__start_datetime', 'points_capped', 'workout')
+        .iterator(chunk_size=RECALC_READ_CHUNK_SIZE)
+    )
+    # weeks after the last affected workout can only differ if the stored points are stale
+    last_dirty_week = None if end_datetime is None else _iso_week(end_datetime.astimezone(datetime.timezone.utc))
+
+    scorer = Scorer()
+    scorer.set_goal(goal)
+
+    rows_scanned = 0
+    rows_changed = 0
+    changed_rows = []
+    changed_workouts = set()
+    stopped_early = False
+    last_refreshed_datetime = end_datetime
+    with transaction.atomic():
+        for week, week_rows in itertools.groupby(points_rows, key=lambda row: _iso_week(row[2])):
+            week_rows = list(week_rows)
+            earned_points_lst = _score_week(scorer, week_rows, batch=batch)
+            rows_scanned += len(week_rows)
+
+            # only write the rows whose points_capped actually changed
+            week_changed = 0
+            for row, earned_points in zip(week_rows, earned_points_lst):
+                if _points_capped_changed(row[3], earned_points):
+                    changed_rows.append((row[0], earned_points))
+                    changed_workouts.add(row[4])
+                    week_changed += 1
+            rows_changed += week_changed
+            if len(changed_rows) >= RECALC_WRITE_CHUNK_SIZE:
+                _write_points_capped(changed_rows)
+                changed_rows = []
+
+            # a whole week past the affected range came out identical - all later weeks are unchanged as well
+            if last_dirty_week is not None and week > last_dirty_week and week_changed == 0:
+                stopped_early = True
+                break
+            last_refreshed_datetime = week_rows[-1][2] if last_refreshed_datetime is None else max(last_refreshed_datetime, week_rows[-1][2])
+
+        if len(changed_rows) > 0:
+            _write_points_capped(changed_rows)
+        record_feed_changes([(goal.competition_id, i) for i in changed_workouts])
+
+        # keep the daily rollup of the stats in line with the rewritten range - in the same transaction
+        refresh_daily_points(
+            goal.competition_id,
+            users=[task_group['user']],
+            start_date=local_date(_week_start(start_datetime)),
+            end_date=local_date(last_refreshed_datetime) if stopped_early and last_refreshed_datetime is not None else None,
+        )
+
+    return rows_scanned, rows_changed
+
+
+def _group_weight(task_group, now):
+    """ days of the recalc window of a (user, goal) group - the rows to scan grow with it """
+    start_datetime = datetime.datetime.fromisoformat(task_group['start_datetime'])
+    end_datetime = now if task_group['end_datetime'] is None else datetime.datetime.fromisoformat(task_group['end_datetime'])
+    return max((end_datetime - start_datetime).total_seconds() / 86_400, 1)
+
+
+def _split_into_shards(task_groups, shard_count):
+    """ split the (user, goal) groups into at most shard_count shards of similar work - weighted by the days of their
+    recalc windows, a user's goals stay together """
+    now = timezone.now()
+    user_groups = {}
+    for task_group in sorted(task_groups, key=lambda i: (i['user'], i['goal'])):
+        user_groups.setdefault(task_group['user'], []).append(task_group)
+    user_weights = {user: sum(_group_weight(i, now) for i in groups) for user, groups in user_groups.items()}
+
+    # heaviest users first, each onto the lightest shard so far
+    shards = [[] for _ in range(max(shard_count, 1))]
+    shard_weights = [0] * len(shards)
+    for user in sorted(user_groups, key=lambda i: (-user_weights[i], i)):
+        idx = shard_weights.index(min(shard_weights))
+        shards[idx] += user_groups[user]
+        shard_weights[idx] += user_weights[user]
+    return [i for i in shards if len(i) > 0]
 
 
+@app.task(bind=True, time_limit=60 * 30, max_retries=3)  # 30 min time limit
+def recalc_points(self, batch=True, shard_count=None):
+    first_trigger = cache.get(RECALC_SCHEDULED_KEY)
+    last_trigger = cache.get(RECALC_LAST_TRIGGER_KEY)
+    if first_trigger is not None and last_trigger is not None and not self.request.is_eager:
+        # triggers are still coming in (e.g. strava sync) - wait for the burst to end, but at most the max delay
+        wait = min(last_trigger + RECALC_DEBOUNCE_SECONDS, first_trigger + RECALC_MAX_DELAY_SECONDS) - time.time()
+        if wait > 1:
+            recalc_points.apply_async(kwargs={'batch': batch, 'shard_count': shard_count}, countdown=wait)
+            return f'Postponed by {wait:.0f}s - waiting for more changes'
+
+    # from here on new triggers schedule the next run - everything queued until now is handled by this one
+    cache.delete(RECALC_SCHEDULED_KEY)
+    with SingleFlightLock('custom_user.point_recalc.recalc_points', heartbeat=True) as acquired:
+        if not acquired:
+            print('Recalc points task is already running - rescheduling')
+            _schedule_recalc_points()
+            return 'Rescheduled because it is already running.'
+        return _dispatch_recalc(batch=batch, shard_count=shard_count)
+
+
+@app.task()
+def sweep_recalc_requests():
+    """ beat fallback - schedule a run for orphaned or stale requests only, the triggers schedule the regular runs
+
+    Orphaned: pending for longer than a scheduled run can take, i.e. its run got lost (e.g. worker restart).
+    Stale: claimed by a run that didn't finish within RECALC_CLAIM_EXPIRY.
+    """
+    RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
+    now = timezone.now()
+    if not RecalcRequest.objects.filter(
+        Q(done=False, updated_datetime__lt=now - RECALC_ORPHAN_AFTER) | Q(done=True, updated_datetime__lt=now - RECALC_CLAIM_EXPIRY)
+    ).exists():
+        return 'Nothing to sweep'
+    _schedule_recalc_points()
+    return 'Scheduled a recalc of orphaned or stale requests'
+
+
+def _dispatch_recalc(batch=True, shard_count=None):
+    RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
 
+    # claim the pending requests - a trigger during the run resets done so the request stays queued for the next run
+    now = timezone.now()
+    with transaction.atomic():
+        claimed_requests = list(
+            RecalcRequest.objects
+            .select_for_update()
+            .filter(Q(done=False) | Q(updated_datetime__lt=now - RECALC_CLAIM_EXPIRY))
+            .values('pk', 'user', 'goal', 'start_datetime', 'end_datetime')
+        )
+        RecalcRequest.objects.filter(pk__in=[i['pk'] for i in claimed_requests]).update(done=True, updated_datetime=now)
+
+    task_groups = [
+        {
+            'user': i['user'],
+            'goal': i['goal'],
+            'start_datetime': i['start_datetime'].isoformat(),
+            'end_datetime': None if i['end_datetime'] is None else i['end_datetime'].isoformat(),
+            'request': i['pk'],
+            'claimed': now.isoformat(),
+        }
+        for i in claimed_requests
+    ]
+    if len(task_groups) == 0:
+        return {'groups': 0, 'shards': 0}
+
+    # hand the (user, goal) streams out to the worker pool and summarize once all shards are done
+    shards = _split_into_shards(task_groups, settings.RECALC_SHARDS if shard_count is None else shard_count)
+    print(f'Recalculating points - {len(task_groups)} groups in {len(shards)} shards...')
+    result = chord(recalc_points_shard.s(shard, batch=batch) for shard in shards)(recalc_points_summary.s())
+    return {'groups': len(task_groups), 'shards': len(shards), 'summary_task_id': result.id}
+
+
+@app.task(bind=True, time_limit=60 * 30, max_retries=3)  # 30 min time limit
+def recalc_points_shard(self, task_groups, batch=True):
+    RecalcRequest = apps.get_model('custom_user', 'RecalcRequest')
+    ActivityGoal = apps.get_model('competition', 'ActivityGoal')
+    start_time = time.monotonic()
+
+    # load every goal of the shard once instead of once per (user, goal) group
+    goals = ActivityGoal.objects.in_bulk({i['goal'] for i in task_groups})
+
+    rows_scanned = 0
+    rows_changed = 0
+    done_groups = []
+    skipped_groups = []
+    for task_group in task_groups:
+        if task_group['goal'] not in goals:
+            continue  # goal deleted in the meantime - its points and requests are gone with it
+        # never score the same (user, goal) stream on two workers at once
+        with SingleFlightLock(f"recalc_points_{task_group['user']}_{task_group['goal']}", heartbeat=True) as acquired:
+            if not acquired:
+                skipped_groups.append(task_group)
+                continue
+            try:
+                group_rows_scanned, group_rows_changed = _recalc_group(task_group, goals[task_group['goal']], batch=batch)
+            except Exception:
+                RecalcRequest.objects.filter(pk=task_group['request']).update(done=False)
+                raise
+            # only remove the request if it wasn't changed (or claimed again) during the run - otherwise the next run picks it up
+            RecalcRequest.objects.filter(pk=task_group['request'], done=True, updated_datetime=datetime.datetime.fromisoformat(task_group['claimed'])).delete()
+        rows_scanned += group_rows_scanned
+        rows_changed += group_rows_changed
+        done_groups.append(task_group)
+
+    if len(skipped_groups) > 0:
+        print(f'Recalc points shard skipped {len(skipped_groups)} groups that are already being recalculated')
+        RecalcRequest.objects.filter(pk__in=[i['request'] for i in skipped_groups]).update(done=False)
+        trigger_recalc_points()
+
+    wall_time = round(time.monotonic() - start_time, 3)
+    print(f'Points shard recalculated - {len(done_groups)} groups / {rows_scanned} rows scanned / {rows_changed} rows changed / {wall_time}s')
+    return {
+        'groups': done_groups,
+        'skipped_groups': skipped_groups,
+        'rows_scanned': rows_scanned,
+        'rows_changed': rows_changed,
+        'wall_time': wall_time,
+    }
+
+
+@app.task()
+def recalc_points_summary(shard_results):
+    summary = {
+        'groups': [group for i in shard_results for group in i['groups']],
+        'skipped_groups': [group for i in shard_results for group in i['skipped_groups']],
+        'shards': len(shard_results),
+        'rows_scanned': sum(i['rows_scanned'] for i in shard_results),
+        'rows_changed': sum(i['rows_changed'] for i in shard_results),
+        'wall_time': max([i['wall_time'] for i in shard_results], default=0),
+    }
+    print(f"All points recalculated - {len(summary['groups'])} groups / {summary['rows_scanned']} rows scanned / {summary['rows_changed']} rows changed / {summary['wall_time']}s")
+    return summary
+
+
+def _segment_starts(keys):
+    """ flag each position where a new segment (day / week) starts - i.e. the key differs from the previous one """
+    return [idx == 0 or key != keys[idx - 1] for idx, key in enumerate(keys)]
+
+
+def _segmented_cumsum(values, starts):
+    """ running total of values that restarts at every segment start """
+    result = []
+    total = 0
+    for value, start in zip(values, starts):
+        total = value if start else total + value
+        result.append(total)
+    return result
+
+
+def _segment_ids(starts):
+    """ map each position to the index of the segment it belongs to """
+    result = []
+    segment = -1
+    for start in starts:
+        segment += 1 if start else 0
+        result.append(segment)
+    return result
 
 
 class Scorer:
@@ -73,20 +414,23 @@ class Scorer:
         self.cap_week = None if goal.max_per_week is None else goal.max_per_week / goal.goal * 100
 
     def calculate_points(self, points):
+        return self.calculate_points_at(points_raw=points.points_raw, start_datetime=points.workout.start_datetime)
+
+    def calculate_points_at(self, points_raw, start_datetime):
         # potentially reset the memory if new day / week
-        if points.workout.start_datetime.date() != self.memory_today:
-            self.memory_today = points.workout.start_datetime.date()
+        if start_datetime.date() != self.memory_today:
+            self.memory_today = start_datetime.date()
             self.memory_today_points_raw = 0
             self.memory_today_points_capped = 0
-        if points.workout.start_datetime.isocalendar()[1] != self.memory_this_week:
-            self.memory_this_week = points.workout.start_datetime.isocalendar()[1]
+        if start_datetime.isocalendar()[:2] != self.memory_this_week:
+            self.memory_this_week = start_datetime.isocalendar()[:2]
             self.memory_week_points_raw = 0
             self.memory_week_points_capped = 0
 
-        earned_points = points.points_raw
+        earned_points = points_raw
         self.memory_today_points_raw += earned_points
         self.memory_week_points_raw += earned_points
-        earned_points = points.points_raw
+        earned_points = points_raw
 
         # workout floor
         earned_points = max(earned_points - self.floor_workout, 0)
@@ -117,6 +461,61 @@ class Scorer:
         self.memory_week_points_capped += earned_points
         return earned_points
 
+    def calculate_points_batch(self, points_raw, dates, weeks):
+        """ Score an ordered (user, goal) stream in one pass - same result as calling calculate_points on each point.
+
+        The day / week caps only depend on running totals, so they are expressed as segmented cumulative sums
+        clamped at the cap instead of carrying the capped memory from point to point. Starts with an empty
+        day / week memory, i.e. like a fresh Scorer.
+
+        Args:
+            points_raw: raw points of the stream ordered by workout start_datetime
+            dates: workout date of each point (day segments)
+            weeks: ISO (year, week) of each point (week segments)
+        Returns: list of capped points in the same order
+        """
+        if len(points_raw) == 0:
+            return []
+
+        week_starts = _segment_starts(weeks)
+        day_starts = [day_start or week_start for day_start, week_start in zip(_segment_starts(dates), week_starts)]
+        day_raw = _segmented_cumsum(points_raw, day_starts)
+        week_raw = _segmented_cumsum(points_raw, week_starts)
+
+        # per workout floor/cap and the day/week floors only depend on the raw points of the stream
+        uncapped = []
+        for raw, raw_today, raw_week in zip(points_raw, day_raw, week_raw):
+            earned_points = max(raw - self.floor_workout, 0)
+            if self.cap_workout is not None:
+                earned_points = min(earned_points, self.cap_workout - self.floor_workout)
+            earned_points = min(earned_points, raw_today - self.floor_day, raw_week - self.floor_week)
+            uncapped.append(max(earned_points, 0))
+
+        cap_day = None if self.cap_day is None else max(self.cap_day - self.floor_day, 0)
+        cap_week = None if self.cap_week is None else max(self.cap_week - self.floor_week, 0)
+
+        # capped total of each day = min(day total, day cap, week cap left at the start of the day)
+        day_uncapped = _segmented_cumsum(uncapped, day_starts)
+        day_ids = _segment_ids(day_starts)
+        day_totals = [total for total, day_end in zip(day_uncapped, day_starts[1:] + [True]) if day_end]
+        day_totals = day_totals if cap_day is None else [min(total, cap_day) for total in day_totals]
+        week_of_day = [start for start, day_start in zip(week_starts, day_starts) if day_start]
+        week_running = _segmented_cumsum(day_totals, week_of_day)
+        week_running = week_running if cap_week is None else [min(total, cap_week) for total in week_running]
+        week_before_day = [0 if week_start else week_running[idx - 1] for idx, week_start in enumerate(week_of_day)]
+
+        earned_points_lst = []
+        previous_total = 0
+        for total, day_id, day_start in zip(day_uncapped, day_ids, day_starts):
+            if cap_day is not None:
+                total = min(total, cap_day)
+            if cap_week is not None:
+                total = min(total, cap_week - week_before_day[day_id])
+            previous_total = 0 if day_start else previous_total
+            earned_points_lst.append(total - previous_total)
+            previous_total = total
+        return earned_points_lst
+
 
 class DummyObject:
     def __init__(self, **kwargs):
@@ -168,10 +567,48 @@ def test_scorer():
 
         assert earned_points == expected_result, f'Expected {expected_result}, got {earned_points} for goal {goal_kwargs}'
 
+        batch_scorer = Scorer()
+        batch_scorer.set_goal(goal)
+        earned_points = sum(batch_scorer.calculate_points_batch(points, dates=[workout.start_datetime.date()] * len(points), weeks=[workout.start_datetime.isocalendar()[:2]] * len(points)))
+
+        assert earned_points == expected_result, f'Expected {expected_result}, got {earned_points} for goal {goal_kwargs} (batch)'
+
+
+def test_scorer_batch(rounds=500, seed=42):
+    """ randomized check that calculate_points_batch gives exactly the same points as calculate_points """
+    rnd = random.Random(seed)
+    limits = ['min_per_workout', 'max_per_workout', 'min_per_day', 'max_per_day', 'min_per_week', 'max_per_week']
+
+    for _ in range(rounds):
+        goal_target = Decimal(rnd.choice([30, 75, 100, 150, 600, 1_800]))
+        goal_kwargs = {i: Decimal(rnd.randint(0, 200)) * goal_target / 100 for i in limits if rnd.random() < 0.4}
+        goal = DummyObject(goal=goal_target, **goal_kwargs)
+
+        start_datetime = datetime.datetime.fromisoformat('2024-12-23T06:00:00')
+        points = []
+        for _ in range(rnd.randint(0, 60)):
+            start_datetime += datetime.timedelta(hours=rnd.choice([0, 1, 5, 20, 30, 80]))
+            points.append(DummyObject(points_raw=Decimal(rnd.randint(0, 15_000)) / 100, workout=DummyObject(start_datetime=start_datetime)))
+
+        scorer = Scorer()
+        scorer.set_goal(goal)
+        expected = [scorer.calculate_points(i) for i in points]
+
+        batch_scorer = Scorer()
+        batch_scorer.set_goal(goal)
+        result = batch_scorer.calculate_points_batch(
+            points_raw=[i.points_raw for i in points],
+            dates=[i.workout.start_datetime.date() for i in points],
+            weeks=[i.workout.start_datetime.isocalendar()[:2] for i in points],
+        )
+
+        assert result == expected, f'Expected {expected}, got {result} for goal {goal_kwargs}'
+
 
 
 
 
 if __name__ == '__main__':
     test_scorer()
+    test_scorer_batch()
 
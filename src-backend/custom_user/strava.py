@@ -8,7 +8,8 @@ from django.utils import timezone
 from rest_framework.response import Response
 from rest_framework import status
 from django.db import IntegrityError
-from workout_challenge.celery import app, is_task_already_executing
+from workout_challenge.celery import app
+from workout_challenge.single_flight import single_flight
 from django.db.models import Q
 
 from workouts.models import Workout
@@ -34,10 +35,8 @@ def _seconds_until_next_interval():
 
 
 @app.task(bind=True, time_limit=60 * 60 * 3, max_retries=10)  # 3 hour time limit
+@single_flight(skipped_result='Task already executing. Skipping.')
 def daily_strava_sync(self, refresh_all=False):
-    if is_task_already_executing('daily_strava_sync'):
-        return 'Task already executing. Skipping.'
-
     CustomUser = get_user_model()
     user_lst = CustomUser.objects.filter(
         strava_refresh_token__isnull=False,
@@ -69,13 +68,12 @@ def daily_strava_sync(self, refresh_all=False):
 
 
 @app.task(bind=True)
+@single_flight(key=['user__id'], skipped_result='Strava sync for this user is already running. Skipping.')
 def sync_strava(self, user__id, start_datetime=None):
     access_token = cache.get(f"strava_access_token_{user__id}")
     CustomUser = get_user_model()
     user = CustomUser.objects.get(id=user__id)
 
-    all_existing_strava_activities = set(Workout.objects.all().values_list('strava_id', flat=True))
-
     cnt_new_strava_activities = 0
     cnt_updated_strava_activities = 0
 
@@ -127,6 +125,9 @@ def sync_strava(self, user__id, start_datetime=None):
         response.raise_for_status()
         activities = response.json()
 
+        # only look up the activities of this page - unique index lookups instead of loading the strava ids of all workouts
+        existing_strava_activities = set(Workout.objects.filter(strava_id__in=[i.get('id') for i in activities]).values_list('strava_id', flat=True))
+
         for activity in activities:
             activity_id = activity.get('id')
 
@@ -140,7 +141,7 @@ def sync_strava(self, user__id, start_datetime=None):
             }
 
             # if existing workout - update activity details
-            if activity_id in all_existing_strava_activities:
+            if activity_id in existing_strava_activities:
                 workout = Workout.objects.get(strava_id=activity_id)
                 for key, value in props.items():
                     setattr(workout, key, value)
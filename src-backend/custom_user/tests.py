@@ -1,3 +1,268 @@
-from django.test import TestCase
+import datetime
+from decimal import Decimal
 
-# Create your tests here.
+from unittest import mock
+
+from django.db.models import F
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from competition.models import Competition, ActivityGoal, Points
+from workouts.models import Workout
+from custom_user.models import CustomUser, RecalcRequest
+from custom_user import point_recalc
+from custom_user.point_recalc import test_scorer, test_scorer_batch, Scorer, _recalc_group, POINTS_CAPPED_QUANTIZE, enqueue_recalc, enqueue_recalc_many
+
+
+class ScorerTests(SimpleTestCase):
+
+    def test_scorer(self):
+        test_scorer()
+
+    def test_scorer_batch(self):
+        test_scorer_batch()
+
+
+class RecalcGroupTests(TestCase):
+    """ the incremental recalc of a (user, goal) stream has to end up where a full replay of the Scorer does """
+
+    def setUp(self):
+        CustomUser.objects.bulk_create([CustomUser(email='recalc@example.com', username='recalc')])
+        self.user = CustomUser.objects.get(email='recalc@example.com')
+        competition = Competition(owner=self.user, name='Recalc', start_date=datetime.date(2024, 12, 16), end_date=datetime.date(2025, 1, 19))
+        competition.save()
+        # 40 points a day against a 60 / day and 150 / week cap - Thursday is capped to 30 and the rest of the week to 0
+        ActivityGoal.objects.bulk_create([ActivityGoal(competition=competition, name='Capped', metric='min', goal=100, max_per_day=60, max_per_week=150)])
+        self.goal = ActivityGoal.objects.get(competition=competition, name='Capped')
+
+        # one workout a day for the ISO weeks 2024-W51 to 2025-W03 - 2025-W01 runs from Mon 30 Dec to Sun 5 Jan
+        Workout.objects.bulk_create([
+            Workout(user=self.user, sport_type='Run', start_datetime=self._at(datetime.date(2024, 12, 16) + datetime.timedelta(days=idx)), duration=datetime.timedelta(minutes=30))
+            for idx in range(35)
+        ])
+        Points.objects.bulk_create([Points(goal=self.goal, workout=workout, points_raw=40, points_capped=40) for workout in Workout.objects.filter(user=self.user)])
+        self.assertEqual(self._recalc(datetime.date(2024, 12, 16)), (35, 4 * 5))
+        self.assertEqual(self._stored(), self._replay())
+
+    def _at(self, day, hour=12):
+        return datetime.datetime.combine(day, datetime.time(hour), tzinfo=datetime.timezone.utc)
+
+    def _recalc(self, start_date, end_date=None):
+        task_group = {'user': self.user.pk, 'goal': self.goal.pk, 'start_datetime': self._at(start_date).isoformat(), 'end_datetime': None if end_date is None else self._at(end_date).isoformat()}
+        return _recalc_group(task_group, self.goal)
+
+    def _points(self, day):
+        return Points.objects.get(goal=self.goal, workout__start_datetime__date=day)
+
+    def _edit(self, day, points_raw):
+        """ change the points_raw of the workout on day like trigger_workout_change does - points_capped starts out uncapped """
+        Points.objects.filter(pk=self._points(day).pk).update(points_raw=points_raw, points_capped=points_raw)
+
+    def _stored(self):
+        return {pk: Decimal(points_capped).quantize(POINTS_CAPPED_QUANTIZE) for pk, points_capped in Points.objects.filter(goal=self.goal).values_list('id', 'points_capped')}
+
+    def _replay(self):
+        """ points_capped of a full sequential replay of the stream """
+        scorer = Scorer()
+        scorer.set_goal(self.goal)
+        return {
+            pk: Decimal(scorer.calculate_points_at(points_raw=points_raw, start_datetime=start_datetime)).quantize(POINTS_CAPPED_QUANTIZE)
+            for pk, points_raw, start_datetime in Points.objects.filter(goal=self.goal).order_by('workout__start_datetime', 'pk').values_list('id', 'points_raw', 'workout__start_datetime')
+        }
+
+    def test_only_changed_rows_written(self):
+        before = self._stored()
+        self._edit(datetime.date(2024, 12, 23), 10)  # Monday of 2024-W52
+        edited = self._stored()
+        with mock.patch.object(point_recalc, '_write_points_capped', wraps=point_recalc._write_points_capped) as write_points_capped:
+            rows_scanned, rows_changed = self._recalc(datetime.date(2024, 12, 23), datetime.date(2024, 12, 23))
+
+        # 2024-W52 and the unchanged 2025-W01 after it are scanned - Thursday and Friday get the 30 points Monday no longer earns
+        self.assertEqual((rows_scanned, rows_changed), (14, 2))
+        written = {pk for call in write_points_capped.call_args_list for pk, _ in call.args[0]}
+        self.assertEqual(written, {self._points(datetime.date(2024, 12, 26)).pk, self._points(datetime.date(2024, 12, 27)).pk})
+        self.assertEqual(written, {pk for pk, points_capped in self._stored().items() if points_capped != edited[pk]})
+        self.assertEqual(self._points(datetime.date(2024, 12, 26)).points_capped, 40)
+        self.assertEqual(self._points(datetime.date(2024, 12, 27)).points_capped, 20)
+        self.assertEqual(self._stored(), self._replay())
+        self.assertNotEqual(self._stored(), before)
+
+        # nothing left to change - a second run scans the same rows and writes none
+        with mock.patch.object(point_recalc, '_write_points_capped') as write_points_capped:
+            self.assertEqual(self._recalc(datetime.date(2024, 12, 23), datetime.date(2024, 12, 23)), (14, 0))
+        write_points_capped.assert_not_called()
+
+    def test_restart_from_monday(self):
+        self._edit(datetime.date(2024, 12, 26), 0)  # Thursday of 2024-W52
+        # the replay restarts on Monday so the 120 points of Monday to Wednesday still count against the week cap of Friday
+        self.assertEqual(self._recalc(datetime.date(2024, 12, 26), datetime.date(2024, 12, 26)), (14, 1))
+        self.assertEqual(self._points(datetime.date(2024, 12, 27)).points_capped, 30)
+        self.assertEqual(self._stored(), self._replay())
+
+    def test_stop_after_clean_week(self):
+        self._edit(datetime.date(2024, 12, 23), 10)
+        # no end - every week from the start on is scanned
+        self.assertEqual(self._recalc(datetime.date(2024, 12, 23)), (28, 2))
+        self.assertEqual(self._stored(), self._replay())
+
+        # the first clean week past the affected range ends the scan - later weeks are taken as they are stored
+        Points.objects.filter(pk=self._points(datetime.date(2025, 1, 8)).pk).update(points_capped=0)
+        self.assertEqual(self._recalc(datetime.date(2024, 12, 23), datetime.date(2024, 12, 23)), (14, 0))
+        self.assertEqual(self._points(datetime.date(2025, 1, 8)).points_capped, 0)
+
+        # clean weeks inside the affected range don't stop it - 2025-W02 is fixed and the clean 2025-W03 ends the scan
+        self.assertEqual(self._recalc(datetime.date(2024, 12, 23), datetime.date(2025, 1, 8)), (28, 1))
+        self.assertEqual(self._stored(), self._replay())
+
+    def test_moved_to_earlier_week(self):
+        # the Wednesday workout of 2025-W02 is moved to Tuesday evening of 2024-W52 - the range covers the old and new week
+        workout = self._points(datetime.date(2025, 1, 8)).workout
+        Workout.objects.filter(pk=workout.pk).update(start_datetime=self._at(datetime.date(2024, 12, 24), hour=18))
+        Points.objects.filter(workout=workout).update(points_capped=F('points_raw'))
+        self.assertEqual(self._recalc(datetime.date(2024, 12, 24), datetime.date(2025, 1, 8)), (8 + 7 + 6 + 7, 4))
+        self.assertEqual(Points.objects.get(workout=workout).points_capped, 20)  # day cap of the Tuesday
+        self.assertEqual(self._points(datetime.date(2024, 12, 26)).points_capped, 10)
+        self.assertEqual(self._points(datetime.date(2025, 1, 9)).points_capped, 40)
+        self.assertEqual(self._points(datetime.date(2025, 1, 10)).points_capped, 30)
+        self.assertEqual(self._stored(), self._replay())
+
+    def test_week_across_new_year(self):
+        self.assertEqual(point_recalc._iso_week(self._at(datetime.date(2024, 12, 30))), (2025, 1))
+        self.assertEqual(point_recalc._iso_week(self._at(datetime.date(2025, 1, 5))), (2025, 1))
+        self.assertEqual(point_recalc._week_start(self._at(datetime.date(2025, 1, 3))), datetime.datetime(2024, 12, 30, tzinfo=datetime.timezone.utc))
+
+        # an edit on Monday 30 Dec frees up week cap for Thursday 2 and Friday 3 Jan - the same week, not a new one
+        self._edit(datetime.date(2024, 12, 30), 10)
+        self.assertEqual(self._recalc(datetime.date(2024, 12, 30), datetime.date(2024, 12, 30)), (14, 2))
+        self.assertEqual(self._points(datetime.date(2025, 1, 2)).points_capped, 40)
+        self.assertEqual(self._points(datetime.date(2025, 1, 3)).points_capped, 20)
+        self.assertEqual(self._stored(), self._replay())
+
+        # an edit on Friday 3 Jan replays from Monday 30 Dec
+        self._edit(datetime.date(2025, 1, 3), 0)
+        self.assertEqual(self._recalc(datetime.date(2025, 1, 3), datetime.date(2025, 1, 3)), (14, 1))
+        self.assertEqual(self._points(datetime.date(2025, 1, 4)).points_capped, 20)
+        self.assertEqual(self._stored(), self._replay())
+
+
+class RecalcQueueTests(TestCase):
+    """ the recalc queue keeps one request per (user, goal) covering every pending change """
+
+    def setUp(self):
+        CustomUser.objects.bulk_create([CustomUser(email='queue@example.com', username='queue')])
+        self.user = CustomUser.objects.get(email='queue@example.com')
+        competition = Competition(owner=self.user, name='Queue', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 31))
+        competition.save()
+        self.goal, self.other_goal = competition.activitygoal_set.order_by('pk')
+        RecalcRequest.objects.all().delete()
+
+    def _at(self, day):
+        return datetime.datetime(2025, 1, day, 12, tzinfo=datetime.timezone.utc)
+
+    def test_coalesce(self):
+        self.assertEqual(enqueue_recalc_many([
+            (self.user, self.goal, self._at(10), self._at(12)),
+            (self.user, self.goal, self._at(5), self._at(6)),
+            (self.user.pk, self.goal.pk, self._at(8), self._at(20)),
+            (self.user, self.other_goal, self._at(3), None),
+        ]), 2)
+        self.assertEqual(RecalcRequest.objects.count(), 2)
+        request = RecalcRequest.objects.get(user=self.user, goal=self.goal)
+        self.assertEqual((request.start_datetime, request.end_datetime, request.done), (self._at(5), self._at(20), False))
+        self.assertIsNone(RecalcRequest.objects.get(user=self.user, goal=self.other_goal).end_datetime)
+
+        # later triggers widen the window of the same row - Least / Greatest in the UPDATE, None (until the end) wins
+        RecalcRequest.objects.update(done=True)
+        enqueue_recalc(self.user, self.goal, self._at(2), self._at(4))
+        enqueue_recalc(self.user, self.goal, self._at(15), self._at(25))
+        request = RecalcRequest.objects.get(user=self.user, goal=self.goal)
+        self.assertEqual((request.start_datetime, request.end_datetime, request.done), (self._at(2), self._at(25), False))
+        enqueue_recalc(self.user, self.goal, self._at(22))
+        enqueue_recalc(self.user, self.goal, self._at(23), self._at(24))
+        request = RecalcRequest.objects.get(user=self.user, goal=self.goal)
+        self.assertEqual((request.start_datetime, request.end_datetime), (self._at(2), None))
+        self.assertEqual(RecalcRequest.objects.count(), 2)
+
+        # plain competition dates start at midnight UTC
+        enqueue_recalc(self.user, self.other_goal, datetime.date(2025, 1, 1))
+        self.assertEqual(RecalcRequest.objects.get(user=self.user, goal=self.other_goal).start_datetime, datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc))
+
+    def _dispatch(self):
+        """ claim the pending requests like a recalc run - returns the claimed task groups instead of running the shards """
+        with mock.patch.object(point_recalc, 'chord') as chord:
+            result = point_recalc._dispatch_recalc(shard_count=1)
+        if result['groups'] == 0:
+            return []
+        return [task_group for signature in chord.call_args.args[0] for task_group in signature.args[0]]
+
+    def test_reenqueue_during_run(self):
+        enqueue_recalc(self.user, self.goal, self._at(10), self._at(12))
+        task_groups = self._dispatch()
+        self.assertEqual(len(task_groups), 1)
+        request = RecalcRequest.objects.get()
+        self.assertTrue(request.done)
+        self.assertEqual(request.updated_datetime.isoformat(), task_groups[0]['claimed'])
+
+        # a workout changes while the shard runs - the request is handed back and survives the end of the shard
+        enqueue_recalc(self.user, self.goal, self._at(5), self._at(6))
+        point_recalc.recalc_points_shard(task_groups)
+        request = RecalcRequest.objects.get()
+        self.assertFalse(request.done)
+        self.assertEqual((request.start_datetime, request.end_datetime), (self._at(5), self._at(12)))
+
+        # the next run picks it up and removes it
+        task_groups = self._dispatch()
+        self.assertEqual(task_groups[0]['start_datetime'], self._at(5).isoformat())
+        point_recalc.recalc_points_shard(task_groups)
+        self.assertFalse(RecalcRequest.objects.exists())
+
+    def test_stale_claim(self):
+        enqueue_recalc(self.user, self.goal, self._at(10))
+        stale_task_groups = self._dispatch()
+        self.assertEqual(len(stale_task_groups), 1)
+        # claimed by a run that is still going - not claimed again
+        self.assertEqual(self._dispatch(), [])
+
+        # the run hung for over an hour - its claim has expired and the next run takes the request over
+        RecalcRequest.objects.update(updated_datetime=timezone.now() - point_recalc.RECALC_CLAIM_EXPIRY - datetime.timedelta(minutes=1))
+        task_groups = self._dispatch()
+        self.assertEqual([(i['user'], i['goal']) for i in task_groups], [(self.user.pk, self.goal.pk)])
+        self.assertTrue(RecalcRequest.objects.get().done)
+
+        # the old run finishing late doesn't remove the request of the new claim - only the run holding the claim does
+        point_recalc.recalc_points_shard(stale_task_groups)
+        self.assertTrue(RecalcRequest.objects.filter(done=True).exists())
+        point_recalc.recalc_points_shard(task_groups)
+        self.assertFalse(RecalcRequest.objects.exists())
+
+    def test_split_into_shards(self):
+        def task_group(user, goal, end_days=None):
+            return {'user': user, 'goal': goal, 'start_datetime': self._at(1).isoformat(), 'end_datetime': self._at(1 + end_days).isoformat() if end_days else None}
+        # user 1 has a long window, users 2 - 4 short ones - by count user 1 would share a shard
+        task_groups = [task_group(1, 1)] + [task_group(user, goal, 2) for user in [2, 3, 4] for goal in [1, 2]]
+        shards = point_recalc._split_into_shards(task_groups, 2)
+        self.assertEqual([[(i['user'], i['goal']) for i in shard] for shard in shards], [[(1, 1)], [(2, 1), (2, 2), (3, 1), (3, 2), (4, 1), (4, 2)]])
+        # never more shards than users - a user's goals stay together
+        shards = point_recalc._split_into_shards([task_group(2, goal, 2) for goal in [1, 2, 3]], 4)
+        self.assertEqual(len(shards), 1)
+
+    def test_sweep(self):
+        with mock.patch.object(point_recalc, '_schedule_recalc_points') as schedule:
+            # a fresh request has its scheduled run coming - the sweep leaves it alone
+            enqueue_recalc(self.user, self.goal, self._at(10))
+            self.assertEqual(point_recalc.sweep_recalc_requests(), 'Nothing to sweep')
+            schedule.assert_not_called()
+
+            # pending for longer than any scheduled run takes - its run got lost
+            RecalcRequest.objects.update(updated_datetime=timezone.now() - point_recalc.RECALC_ORPHAN_AFTER - datetime.timedelta(minutes=1))
+            point_recalc.sweep_recalc_requests()
+            schedule.assert_called_once()
+
+            # claimed by a running run - only swept once the claim has expired
+            schedule.reset_mock()
+            self._dispatch()
+            point_recalc.sweep_recalc_requests()
+            schedule.assert_not_called()
+            RecalcRequest.objects.update(updated_datetime=timezone.now() - point_recalc.RECALC_CLAIM_EXPIRY - datetime.timedelta(minutes=1))
+            point_recalc.sweep_recalc_requests()
+            schedule.assert_called_once()
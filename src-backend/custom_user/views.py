@@ -67,11 +67,12 @@ class CustomUserViewSet(viewsets.ModelViewSet):
     filterset_class = CustomUserFilter
 
     permission_classes = [UserPermissionClass]
+    ordering = ('username', 'id')
 
     def get_queryset(self):
         # return all competitions the user is owner of or a participant of
         #time.sleep(3)  # throttle for testing
-        return CustomUser.objects.filter(Q(pk=self.request.user.pk) | Q(my_competitions__in=self.request.user.my_competitions.all())).distinct().order_by('username', 'id')
+        return CustomUser.objects.filter(Q(pk=self.request.user.pk) | Q(my_competitions__in=self.request.user.my_competitions.all())).distinct().prefetch_related('my_competitions', 'my_teams').order_by('username', 'id')
 
     def get_object(self):
         lookup_value = self.kwargs.get(self.lookup_field)
@@ -26,10 +26,16 @@ app.conf.beat_schedule = {
         "schedule": crontab(minute="44", hour="4"),
         "args": (),
     },
-    # not needed - just fallback - do all pending point recalc tasks in the morning
+    # just fallback - pick up pending point recalc requests whose scheduled run got lost (e.g. worker restart)
     "point_recal": {
-        "task": "custom_user.point_recalc.recalc_points",
-        "schedule": crontab(minute="55", hour="5"),
+        "task": "custom_user.point_recalc.sweep_recalc_requests",
+        "schedule": crontab(minute="*/10"),
+        "args": (),
+    },
+    # every night drop the feed changes no client can still ask for
+    "prune_feed_changes": {
+        "task": "competition.feed.prune_feed_changes",
+        "schedule": crontab(minute="30", hour="3"),
         "args": (),
     },
     # every Monday morning ask people who didn't connect Strava to please log their workouts
@@ -58,20 +64,3 @@ app.conf.beat_schedule = {
     },
 }
 
-
-def is_task_already_executing(task_name: str) -> bool:
-    """Returns whether the task with given task_name is already being executed.
-
-    Args:
-        task_name: Name of the task to check if it is running currently.
-    Returns: A boolean indicating whether the task with the given task name is
-        running currently.
-    """
-    active_tasks = app.control.inspect().active()
-    task_count = 0
-    for worker, running_tasks in active_tasks.items():
-        for task in running_tasks:
-            if task["name"] == task_name:
-                task_count += 1
-
-    return task_count > 1
\ No newline at end of file
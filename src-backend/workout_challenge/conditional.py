@@ -0,0 +1,100 @@
+"""Conditional GET - ETag / Last-Modified from versioned data so clients can revalidate unchanged responses with a 304"""
+
+import time, hashlib
+
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+
+def _modified_key(key):
+    return f'{key}_modified'
+
+
+def get_data_versions(keys):
+    """ {key: (version, last modified timestamp)} of the versioned data - missing versions start from a fresh token
+
+    The version is a counter that changes with every bump_data_versions() call, the timestamp is the time of that call.
+    """
+    keys = list(keys)
+    values = cache.get_many(keys + [_modified_key(i) for i in keys])
+    missing = [i for i in keys if values.get(i) is None]
+    if len(missing) > 0:
+        # start from a fresh token so an evicted counter never brings back an old cache entry or ETag
+        now = time.time()
+        for key in missing:
+            cache.add(key, time.time_ns(), None)
+            cache.add(_modified_key(key), now, None)
+        values.update(cache.get_many(missing + [_modified_key(i) for i in missing]))
+    return {i: (values.get(i), values.get(_modified_key(i)) or time.time()) for i in keys}
+
+
+def bump_data_versions(keys):
+    """ mark the versioned data as changed """
+    now = time.time()
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, time.time_ns(), None)
+        cache.set(_modified_key(key), now, None)
+
+
+def make_etag(*parts):
+    """ strong ETag of everything the response depends on """
+    return quote_etag(hashlib.sha1('|'.join(str(i) for i in parts).encode()).hexdigest())
+
+
+def conditional_response(request, etag, last_modified, build_response):
+    """ 304 Not Modified if the client has the current version, else build_response() - both with the validators set
+
+    Args:
+        request: request with the If-None-Match / If-Modified-Since headers
+        etag: quoted ETag of the current version - see make_etag()
+        last_modified: timestamp of the last change
+        build_response: function without arguments creating the full response - a response with `stale = True` (an older
+            version served while the current one is computed) is sent without validators and not stored, so the next
+            request gets the current version instead of a 304
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=int(last_modified))
+    if response is None:
+        response = build_response()
+        if response.status_code != 200:
+            return response
+        if getattr(response, 'stale', False):
+            patch_cache_control(response, private=True, no_store=True)
+            patch_vary_headers(response, ['Authorization'])
+            return response
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    # responses depend on the logged-in user - browsers may keep them but have to revalidate every time
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Authorization'])
+    return response
+
+
+class ConditionalGetMixin:
+    """ ETag / Last-Modified support for the list and retrieve actions of DRF viewsets
+
+    Viewsets implement get_data_version() returning the (version, last modified timestamp) of everything their responses
+    can show - an unchanged version answers If-None-Match / If-Modified-Since requests with a 304 without touching the
+    queryset or the serializer.
+    """
+
+    def get_data_version(self):
+        """ (version, last modified timestamp) of the data shown - None to disable conditional requests """
+        return None
+
+    def _conditional(self, request, build_response):
+        data_version = self.get_data_version()
+        if data_version is None:
+            return build_response()
+        version, last_modified = data_version
+        etag = make_etag(self.__class__.__name__, request.user.pk, request.get_full_path(), version)
+        return conditional_response(request, etag, last_modified, build_response)
+
+    def list(self, request, *args, **kwargs):
+        return self._conditional(request, lambda: super(ConditionalGetMixin, self).list(request, *args, **kwargs))
+
+    def retrieve(self, request, *args, **kwargs):
+        return self._conditional(request, lambda: super(ConditionalGetMixin, self).retrieve(request, *args, **kwargs))
@@ -0,0 +1,25 @@
+"""Default pagination of the API lists - bounded pages with a cursor, so the cost of a page doesn't grow with the history"""
+
+from rest_framework.pagination import CursorPagination
+
+
+class BoundedCursorPagination(CursorPagination):
+    """ Cursor pagination with ?page_size=... up to max_page_size - staff can get the whole list with ?page_size=all
+
+    Viewsets set `ordering` to fields of their model ending with a unique one (e.g. id), best backed by an index
+    starting with the fields they filter on.
+    """
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+    ordering = '-id'
+    unpaginated_value = 'all'
+
+    def get_ordering(self, request, queryset, view):
+        ordering = getattr(view, 'ordering', None) or self.ordering
+        return (ordering,) if isinstance(ordering, str) else tuple(ordering)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if request.query_params.get(self.page_size_query_param) == self.unpaginated_value and request.user.is_staff:
+            return None
+        return super().paginate_queryset(queryset, request, view)
@@ -163,6 +163,7 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
+    'DEFAULT_PAGINATION_CLASS': 'workout_challenge.pagination.BoundedCursorPagination',
 }
 
 SIMPLE_JWT = {
@@ -190,6 +191,7 @@ USE_TZ = True
 # Celery
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
+RECALC_SHARDS = int(os.environ.get("RECALC_SHARDS", 4))  # point recalc shards handed out to the celery workers in parallel
 
 CACHES = {
     'default': ({
@@ -209,6 +211,8 @@ CACHES = {
     })
 }
 
+TEST_RUNNER = 'workout_challenge.test_runner.LocalCacheTestRunner'  # tests use the LocMemCache even without DEBUG
+
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/4.2/howto/static-files/
@@ -0,0 +1,170 @@
+"""Single-flight locks - make sure only one worker/process runs a piece of work at a time"""
+
+import time, uuid, inspect, functools, threading
+
+from django.core.cache import cache
+
+
+class SingleFlightLock:
+    """Non-blocking lock shared by all workers via the Django cache.
+
+    Uses the atomic Redis lock of django-redis if the cache supports it and falls back to cache.add otherwise - i.e. the
+    in-memory LocMemCache when running locally / in tests. The lock expires after `timeout` seconds so a crashed worker
+    can't block the work forever. With `heartbeat=True` a background thread renews the lock while it is held, which
+    allows short timeouts for long-running work.
+
+    Usage:
+        with SingleFlightLock('recalc_points') as acquired:
+            if acquired:
+                ...
+    """
+
+    def __init__(self, name, timeout=60, heartbeat=False):
+        self.key = f"single_flight_{name}"
+        self.timeout = timeout
+        self.heartbeat = heartbeat
+        self.token = uuid.uuid4().hex
+        self._redis_lock = cache.lock(self.key, timeout=timeout, blocking=False, thread_local=False) if hasattr(cache, 'lock') else None
+        self._stop_heartbeat = threading.Event()
+        self._heartbeat_thread = None
+        self.acquired = False
+
+    def acquire(self):
+        """ try to get the lock - returns immediately whether it was acquired """
+        if self._redis_lock is not None:
+            self.acquired = bool(self._redis_lock.acquire(blocking=False))
+        else:
+            self.acquired = cache.add(self.key, self.token, self.timeout)
+
+        if self.acquired and self.heartbeat:
+            self._stop_heartbeat.clear()
+            self._heartbeat_thread = threading.Thread(target=self._renew_until_released, name=f"{self.key}_heartbeat", daemon=True)
+            self._heartbeat_thread.start()
+        return self.acquired
+
+    def extend(self):
+        """ reset the time-to-live of a held lock - returns whether the lock is still ours """
+        if self._redis_lock is not None:
+            try:
+                return bool(self._redis_lock.extend(self.timeout, replace_ttl=True))
+            except Exception:
+                return False
+        if cache.get(self.key) != self.token:
+            return False
+        return cache.touch(self.key, self.timeout)
+
+    def release(self):
+        """ release the lock if it is (still) held by us """
+        self._stop_heartbeat.set()
+        if self._heartbeat_thread is not None:
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+        if not self.acquired:
+            return
+        self.acquired = False
+        if self._redis_lock is not None:
+            try:
+                self._redis_lock.release()
+            except Exception:
+                pass  # expired and/or taken over by someone else
+        elif cache.get(self.key) == self.token:
+            cache.delete(self.key)
+
+    def _renew_until_released(self):
+        interval = self.timeout / 3
+        while not self._stop_heartbeat.wait(interval):
+            if not self.extend():
+                print(f"Single-flight lock {self.key} was lost")
+                return
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+def single_flight(key=None, timeout=60, skipped_result='Skipped because it is already running.'):
+    """Decorator for celery tasks (or any function) - skip the call if the same work is already running somewhere.
+
+    Place it below the @app.task decorator. The lock is held with heartbeat renewal for as long as the task runs.
+
+    Args:
+        key: None to allow only one run of the task at a time, a list of argument names to allow one run per combination
+            of these arguments, or a callable returning the key for the given task arguments.
+        timeout: Seconds after which the lock of a crashed worker expires.
+        skipped_result: Returned instead of running the task if it is already running.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        task_name = f"{func.__module__}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if key is None:
+                lock_name = task_name
+            elif callable(key):
+                lock_name = f"{task_name}_{key(*args, **kwargs)}"
+            else:
+                arguments = signature.bind(*args, **kwargs)
+                arguments.apply_defaults()
+                lock_name = task_name + "".join(f"_{i}={arguments.arguments.get(i)}" for i in key)
+
+            with SingleFlightLock(lock_name, timeout=timeout, heartbeat=True) as acquired:
+                if not acquired:
+                    print(f"Task {lock_name} skipped because it is already running")
+                    return skipped_result
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_or_compute_single_flight(cache_key, compute, timeout, stale_key=None, lock_timeout=60, wait_timeout=10, poll_interval=0.05, cacheable=None):
+    """Read `cache_key` from the cache and compute it on a miss - with only one computation per key at a time.
+
+    The first request computes the value and stores it, all concurrent requests for the same key wait for that result
+    instead of running the same expensive query. With `stale_key` the last computed value (of any older key) is kept as
+    well and returned to the waiting requests right away while the new one is computed (stale-while-revalidate). If the
+    computing worker dies or takes longer than `wait_timeout` seconds the waiting requests compute the value themselves.
+
+    Args:
+        cache_key: Key of the up-to-date value.
+        compute: Function without arguments returning the value.
+        timeout: Seconds the computed value is cached for.
+        stale_key: Key to keep the latest computed value under - None to always wait for the up-to-date value.
+        lock_timeout: Seconds after which the lock of a crashed worker expires.
+        wait_timeout: Seconds to wait for the computing worker before computing the value ourselves.
+        poll_interval: Seconds between checks whether the computing worker is done.
+        cacheable: Function returning whether a computed value may be cached - None to cache everything but None.
+    """
+    value = cache.get(cache_key)
+    if value is not None:
+        return value
+
+    def compute_and_store():
+        value = compute()
+        if value is not None and (cacheable is None or cacheable(value)):
+            cache.set(cache_key, value, timeout)
+            if stale_key is not None:
+                cache.set(stale_key, value, timeout)
+        return value
+
+    with SingleFlightLock(cache_key, timeout=lock_timeout, heartbeat=True) as acquired:
+        if acquired:
+            # the previous holder may have finished between our cache miss and taking the lock
+            value = cache.get(cache_key)
+            return compute_and_store() if value is None else value
+
+    if stale_key is not None:
+        value = cache.get(stale_key)
+        if value is not None:
+            return value
+
+    deadline = time.monotonic() + wait_timeout
+    while time.monotonic() < deadline:
+        time.sleep(poll_interval)
+        value = cache.get(cache_key)
+        if value is not None:
+            return value
+    print(f"Single-flight computation of {cache_key} didn't finish within {wait_timeout}s - computing it again")
+    return compute_and_store()
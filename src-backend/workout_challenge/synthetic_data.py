@@ -0,0 +1,206 @@
+"""Synthetic datasets - users, competitions with goals and teams, workouts and their points - for benchmarks and load tests"""
+
+import datetime, random, itertools
+from decimal import Decimal
+
+from django.apps import apps
+from django.contrib.auth.hashers import make_password
+from django.utils import timezone
+
+from workouts.models import SPORT_MET
+
+DATASET_SIZES = {
+    'small': {'users': 10, 'competitions': 2, 'goals': 2, 'teams': 2, 'workouts_per_user': 20},
+    'medium': {'users': 50, 'competitions': 4, 'goals': 3, 'teams': 4, 'workouts_per_user': 60},
+    'large': {'users': 200, 'competitions': 8, 'goals': 3, 'teams': 8, 'workouts_per_user': 120},
+}
+
+GOAL_TEMPLATES = [
+    {'name': 'Move', 'metric': 'kcal', 'period': 'week', 'goal': 600, 'max_per_day': 1_200},
+    {'name': 'Exercise', 'metric': 'min', 'period': 'day', 'goal': 30, 'max_per_day': 60},
+    {'name': 'Distance', 'metric': 'km', 'period': 'competition', 'goal': 1_000},
+    {'name': 'Workouts', 'metric': 'num', 'period': 'week', 'goal': 3, 'max_per_day': 2},
+]
+
+# share of the logged workouts per sport - runs, rides and walks dominate like in the strava imports
+SPORT_WEIGHTS = {
+    'Run': 24, 'Ride': 14, 'Walk': 14, 'WeightTraining': 10, 'Workout': 7, 'Swim': 5, 'Yoga': 5, 'VirtualRide': 4,
+    'HighIntensityIntervalTraining': 4, 'Hike': 3, 'TrailRun': 3, 'Tennis': 2, 'Pilates': 2, 'Soccer': 2, 'Rowing': 1,
+}
+# (shortest, longest, most common) duration in minutes and the average speed in km/h - None for sports without distance
+SPORT_PROFILES = {
+    'Run': (20, 90, 35, 10), 'TrailRun': (30, 150, 60, 8), 'Ride': (30, 240, 75, 24), 'VirtualRide': (20, 90, 45, 28),
+    'Walk': (15, 120, 40, 5), 'Hike': (60, 360, 150, 4), 'Swim': (20, 75, 40, 2.5), 'Rowing': (30, 90, 50, 10),
+    'WeightTraining': (30, 90, 55, None), 'Workout': (15, 75, 40, None), 'Yoga': (30, 90, 60, None), 'Pilates': (30, 60, 50, None),
+    'HighIntensityIntervalTraining': (15, 45, 30, None), 'Tennis': (45, 120, 75, None), 'Soccer': (60, 110, 90, None),
+}
+INTENSITY_WEIGHTS = {1: 25, 2: 45, 3: 22, 4: 8}
+# before work, lunch break and after work
+START_HOUR_WEIGHTS = {6: 8, 7: 12, 8: 6, 10: 4, 12: 9, 13: 4, 15: 4, 17: 14, 18: 18, 19: 13, 20: 6, 21: 2}
+
+
+def _weighted_choice(rnd, weights):
+    return rnd.choices(list(weights), weights=list(weights.values()))[0]
+
+
+def synthetic_workouts(rnd, user_lst, workouts_per_user, start_date, end_date):
+    """ Unsaved workouts of the users between start_date and end_date - generated lazily, so millions fit in memory.
+
+    Sport, intensity, duration and time of day follow typical distributions, kcal and distance are estimated like
+    Workout.save() does. How active a user is varies between half and one and a half times workouts_per_user.
+    """
+    Workout = apps.get_model('workouts', 'Workout')
+    days = max((end_date - start_date).days, 0) + 1
+    for user in user_lst:
+        for _ in range(round(workouts_per_user * rnd.uniform(0.5, 1.5))):
+            sport_type = _weighted_choice(rnd, SPORT_WEIGHTS)
+            shortest, longest, common, speed = SPORT_PROFILES[sport_type]
+            intensity_category = _weighted_choice(rnd, INTENSITY_WEIGHTS)
+            duration = datetime.timedelta(minutes=round(rnd.triangular(shortest, longest, common)))
+            hours = duration.total_seconds() / (60 * 60)
+            start_datetime = timezone.make_aware(datetime.datetime.combine(
+                start_date + datetime.timedelta(days=rnd.randrange(days)),
+                datetime.time(_weighted_choice(rnd, START_HOUR_WEIGHTS), rnd.randrange(60)),
+            ))
+            yield Workout(
+                user=user,
+                sport_type=sport_type,
+                start_datetime=start_datetime,
+                duration=duration,
+                intensity_category=intensity_category,
+                kcal=Decimal(SPORT_MET[sport_type][intensity_category] * 75 * hours * rnd.uniform(0.85, 1.15)).quantize(Decimal('0.01')),
+                distance=None if speed is None else Decimal(speed * (0.85 + 0.1 * intensity_category) * hours).quantize(Decimal('0.01')),
+            )
+
+
+def bulk_create_lazily(model, objs, batch_size=5_000):
+    """ bulk_create the objects of an iterator batch by batch instead of building one huge list - returns the count """
+    created = 0
+    objs = iter(objs)
+    while batch := list(itertools.islice(objs, batch_size)):
+        model.objects.bulk_create(batch, batch_size=batch_size)
+        created += len(batch)
+    return created
+
+
+def materialize_points(competition_lst):
+    """ Create the capped points of every workout of the members in every goal of the competitions (or ids) in one pass.
+
+    For workouts inserted with bulk_create, i.e. without the save() triggers. Each (user, goal) stream is scored in
+    memory like the point recalc does it, so the points are inserted final - no recalc requests, no second write.
+    Rebuilds the daily rollup once per competition and resets the feeds.
+
+    Returns: number of created points entries
+    """
+    Competition = apps.get_model('competition', 'Competition')
+    Points = apps.get_model('competition', 'Points')
+    Workout = apps.get_model('workouts', 'Workout')
+    CustomUser = apps.get_model('custom_user', 'CustomUser')
+    from competition.scorer import _calculate_points_raw, POINTS_BULK_CREATE_BATCH_SIZE
+    from competition.rollup import refresh_daily_points
+    from competition.feed import record_feed_reset
+    from custom_user.point_recalc import Scorer, _score_week, _iso_week, RECALC_READ_CHUNK_SIZE, POINTS_CAPPED_QUANTIZE
+
+    competition_lst = list(Competition.objects.filter(pk__in=[getattr(i, 'pk', i) for i in competition_lst]).order_by('pk'))
+    created = 0
+    for competition in competition_lst:
+        goal_lst = list(competition.activitygoal_set.all())
+        user_dict = CustomUser.objects.filter(my_competitions=competition).only('scaling_kcal', 'scaling_distance').in_bulk()
+        workout_rows = (
+            Workout.objects
+            .filter(start_datetime__gte=competition.start_date, start_datetime__lte=competition.end_date + datetime.timedelta(days=1), user__in=list(user_dict))
+            .order_by('user', 'start_datetime', 'id')
+            .values_list('id', 'user', 'sport_type', 'start_datetime', 'duration', 'kcal', 'distance', named=True)
+            .iterator(chunk_size=RECALC_READ_CHUNK_SIZE)
+        )
+
+        points_lst = []
+        for user_id, user_workout_lst in itertools.groupby(workout_rows, key=lambda i: i.user):
+            user_workout_lst = list(user_workout_lst)
+            for goal in goal_lst:
+                scorer = Scorer()
+                scorer.set_goal(goal)
+                # steps only count for goals with count_steps_as_walks - like in _create_points_bulk
+                goal_workout_lst = [i for i in user_workout_lst if goal.count_steps_as_walks or i.sport_type != 'Steps']
+                for _, week_workout_lst in itertools.groupby(goal_workout_lst, key=lambda i: _iso_week(i.start_datetime)):
+                    # (id, points_raw, start_datetime, points_capped) rows like the recalc reads them - points_raw as stored
+                    week_rows = [(i.id, _calculate_points_raw(goal=goal, workout=i, user=user_dict[user_id]), i.start_datetime, None) for i in week_workout_lst]
+                    for row, earned_points in zip(week_rows, _score_week(scorer, week_rows)):
+                        points_lst.append(Points(goal_id=goal.pk, workout_id=row[0], points_raw=row[1], points_capped=Decimal(earned_points).quantize(POINTS_CAPPED_QUANTIZE)))
+            if len(points_lst) >= POINTS_BULK_CREATE_BATCH_SIZE:
+                Points.objects.bulk_create(points_lst, batch_size=POINTS_BULK_CREATE_BATCH_SIZE)
+                created += len(points_lst)
+                points_lst = []
+        Points.objects.bulk_create(points_lst, batch_size=POINTS_BULK_CREATE_BATCH_SIZE)
+        created += len(points_lst)
+        refresh_daily_points(competition)
+
+    record_feed_reset([competition.pk for competition in competition_lst])
+    return created
+
+
+def create_synthetic_dataset(users=10, competitions=2, goals=2, teams=2, workouts_per_user=20, prefix='synthetic', password=None, seed=1):
+    """ Bulk-create a dataset - without the save() hooks, i.e. no recalc, welcome emails or MET estimation.
+
+    The first user owns all competitions and is a member of all of them, the others are a member of one competition
+    each (round robin) and of one of its teams. Every workout scores in every goal of the competitions of its user.
+
+    Args:
+        users: number of users
+        competitions: number of competitions - running from 60 days ago until 30 days from now
+        goals: goals per competition
+        teams: teams per competition
+        workouts_per_user: workouts per user within the last 60 days
+        prefix: of the emails, names and join codes - has to be unique in the database
+        password: password of the first user - None for an unusable one
+        seed: of the random workouts
+    Returns: dict with the created users, competitions, goals and teams
+    """
+    CustomUser = apps.get_model('custom_user', 'CustomUser')
+    Competition = apps.get_model('competition', 'Competition')
+    ActivityGoal = apps.get_model('competition', 'ActivityGoal')
+    Team = apps.get_model('competition', 'Team')
+    Points = apps.get_model('competition', 'Points')
+    Workout = apps.get_model('workouts', 'Workout')
+    from competition.rollup import refresh_daily_points
+
+    rnd = random.Random(seed)
+    today = timezone.localdate()
+
+    CustomUser.objects.bulk_create([CustomUser(email=f'{prefix}{idx}@synthetic.local', username=f'{prefix} {idx}', first_name=prefix, password=make_password(password if idx == 0 else None)) for idx in range(users)])
+    user_lst = list(CustomUser.objects.filter(email__startswith=prefix, email__endswith='@synthetic.local').order_by('pk'))
+
+    Competition.objects.bulk_create([Competition(owner=user_lst[0], name=f'{prefix} {idx}', join_code=f'{prefix}{idx}'.upper().ljust(10, 'X'), start_date=today - datetime.timedelta(days=60), end_date=today + datetime.timedelta(days=30), has_teams=teams > 0) for idx in range(competitions)])
+    competition_lst = list(Competition.objects.filter(owner=user_lst[0], name__startswith=f'{prefix} ').order_by('pk'))
+
+    ActivityGoal.objects.bulk_create([ActivityGoal(competition=competition, **GOAL_TEMPLATES[idx % len(GOAL_TEMPLATES)]) for competition in competition_lst for idx in range(goals)])
+    Team.objects.bulk_create([Team(competition=competition, name=f'Team {idx}') for competition in competition_lst for idx in range(teams)])
+    goal_lst = list(ActivityGoal.objects.filter(competition__in=competition_lst).order_by('pk'))
+    team_lst = list(Team.objects.filter(competition__in=competition_lst).order_by('pk'))
+
+    # memberships through the m2m tables - no m2m_changed signals
+    user_competitions = {user.pk: competition_lst if idx == 0 else [competition_lst[idx % len(competition_lst)]] for idx, user in enumerate(user_lst)}
+    CustomUser.my_competitions.through.objects.bulk_create([CustomUser.my_competitions.through(customuser_id=user_id, competition_id=competition.pk) for user_id, competition_lst_i in user_competitions.items() for competition in competition_lst_i])
+    if teams > 0:
+        CustomUser.my_teams.through.objects.bulk_create([
+            CustomUser.my_teams.through(customuser_id=user.pk, team_id=[i for i in team_lst if i.competition_id == competition.pk][idx % teams].pk)
+            for idx, user in enumerate(user_lst) for competition in user_competitions[user.pk]
+        ])
+
+    bulk_create_lazily(Workout, synthetic_workouts(rnd, user_lst, workouts_per_user, today - datetime.timedelta(days=60), today - datetime.timedelta(days=1)))
+
+    competition_goals = {}
+    for goal in goal_lst:
+        competition_goals.setdefault(goal.competition_id, []).append(goal)
+    point_lst = []
+    for workout_id, user_id in Workout.objects.filter(user__in=user_lst).values_list('pk', 'user'):
+        for competition in user_competitions[user_id]:
+            for goal in competition_goals.get(competition.pk, []):
+                points = Decimal(rnd.randint(0, 10_000)) / 100
+                point_lst.append(Points(goal=goal, workout_id=workout_id, points_raw=points, points_capped=points))
+    Points.objects.bulk_create(point_lst, batch_size=5_000)
+
+    for competition in competition_lst:
+        refresh_daily_points(competition)
+
+    return {'users': user_lst, 'competitions': competition_lst, 'goals': goal_lst, 'teams': team_lst}
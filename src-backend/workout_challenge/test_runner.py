@@ -0,0 +1,19 @@
+"""Test runner - the tests run against the in-process cache, leaderboard store and event channel, no Redis server needed"""
+
+from django.test import override_settings
+from django.test.runner import DiscoverRunner
+
+LOCAL_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+class LocalCacheTestRunner(DiscoverRunner):
+    """ DiscoverRunner with the LocMemCache of the DEBUG settings - tests of the Redis paths override CACHES again """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._local_caches = override_settings(CACHES=LOCAL_CACHES)
+        self._local_caches.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._local_caches.disable()
+        super().teardown_test_environment(**kwargs)
@@ -0,0 +1,199 @@
+import time, threading
+
+from unittest import mock, skipUnless
+
+import redis
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from custom_user import strava
+from workout_challenge.single_flight import SingleFlightLock, single_flight, get_or_compute_single_flight
+
+
+class SingleFlightLockTests(SimpleTestCase):
+    """ the cache.add fallback of the lock - the LocMemCache of the tests has no atomic Redis lock """
+
+    def test_mutual_exclusion(self):
+        lock, other = SingleFlightLock('test_exclusion'), SingleFlightLock('test_exclusion')
+        self.assertIsNone(lock._redis_lock)
+        self.assertTrue(lock.acquire())
+        self.assertFalse(other.acquire())
+        self.assertTrue(SingleFlightLock('test_exclusion_other').acquire())
+        lock.release()
+        self.assertTrue(other.acquire())
+        other.release()
+
+        # many workers trying at once - exactly one gets the lock
+        barrier = threading.Barrier(8)
+        results = []
+        def worker():
+            lock = SingleFlightLock('test_exclusion_race')
+            barrier.wait()
+            results.append(lock.acquire())
+        thread_lst = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in thread_lst:
+            thread.start()
+        for thread in thread_lst:
+            thread.join()
+        self.assertEqual(sorted(results), [False] * 7 + [True])
+
+    def test_release_checks_token(self):
+        lock = SingleFlightLock('test_token', timeout=60)
+        self.assertTrue(lock.acquire())
+        # the lock expired and someone else took it over - neither extending nor releasing may touch their lock
+        cache.delete(lock.key)
+        other = SingleFlightLock('test_token', timeout=60)
+        self.assertTrue(other.acquire())
+        self.assertFalse(lock.extend())
+        lock.release()
+        self.assertEqual(cache.get(other.key), other.token)
+        self.assertFalse(SingleFlightLock('test_token').acquire())
+        other.release()
+        self.assertIsNone(cache.get(other.key))
+
+    def test_heartbeat(self):
+        with SingleFlightLock('test_heartbeat', timeout=0.5, heartbeat=True) as acquired:
+            self.assertTrue(acquired)
+            time.sleep(1.5)  # three times the timeout - renewed every timeout / 3
+            self.assertFalse(SingleFlightLock('test_heartbeat').acquire())
+        self.assertIsNone(cache.get('single_flight_test_heartbeat'))
+
+        # without the heartbeat the lock of a hanging worker expires
+        lock = SingleFlightLock('test_no_heartbeat', timeout=0.5)
+        self.assertTrue(lock.acquire())
+        time.sleep(1)
+        self.assertTrue(SingleFlightLock('test_no_heartbeat').acquire())
+
+    def test_decorator(self):
+        calls = []
+        @single_flight(skipped_result='skipped')
+        def task(depth=0):
+            calls.append(depth)
+            return task(depth=1) if depth == 0 else 'done'
+        self.assertEqual(task(), 'skipped')  # the nested call runs while the outer one holds the lock
+        self.assertEqual(calls, [0])
+        self.assertEqual(task(depth=1), 'done')
+
+        # one strava sync per user - a second sync of the same user is skipped, other users aren't blocked
+        with SingleFlightLock('custom_user.strava.sync_strava_user__id=1') as acquired:
+            self.assertTrue(acquired)
+            with mock.patch.object(strava, 'get_user_model') as get_user_model:
+                self.assertEqual(strava.sync_strava(user__id=1), 'Strava sync for this user is already running. Skipping.')
+                get_user_model.assert_not_called()
+            with mock.patch.object(strava, 'get_user_model', side_effect=RuntimeError('sync started')):
+                with self.assertRaisesMessage(RuntimeError, 'sync started'):
+                    strava.sync_strava(user__id=2)
+        self.assertIsNone(cache.get('single_flight_custom_user.strava.sync_strava_user__id=2'))
+
+
+REDIS_LOCATION = 'redis://localhost:6379/15'
+
+
+def redis_available():
+    try:
+        return redis.Redis.from_url(REDIS_LOCATION, socket_connect_timeout=0.5).ping()
+    except redis.RedisError:
+        return False
+
+
+@skipUnless(redis_available(), 'needs a Redis server')
+@override_settings(CACHES={'default': {'BACKEND': 'django_redis.cache.RedisCache', 'LOCATION': REDIS_LOCATION}})
+class RedisSingleFlightLockTests(SimpleTestCase):
+    """ the atomic Redis lock of django-redis - the lock of the production settings """
+
+    def test_mutual_exclusion(self):
+        lock, other = SingleFlightLock('test_redis_exclusion'), SingleFlightLock('test_redis_exclusion')
+        self.assertIsNotNone(lock._redis_lock)
+        self.assertTrue(lock.acquire())
+        self.assertFalse(other.acquire())
+        self.assertTrue(lock.extend())
+        lock.release()
+        self.assertTrue(other.acquire())
+        other.release()
+
+    def test_expired(self):
+        lock = SingleFlightLock('test_redis_expired', timeout=0.5)
+        self.assertTrue(lock.acquire())
+        time.sleep(1)
+        other = SingleFlightLock('test_redis_expired', timeout=60)
+        self.assertTrue(other.acquire())
+        # the expired lock can neither extend nor release the lock of the new holder
+        self.assertFalse(lock.extend())
+        lock.release()
+        self.assertFalse(SingleFlightLock('test_redis_expired').acquire())
+        other.release()
+        lock = SingleFlightLock('test_redis_expired')
+        self.assertTrue(lock.acquire())
+        lock.release()
+
+    def test_heartbeat(self):
+        with SingleFlightLock('test_redis_heartbeat', timeout=0.5, heartbeat=True) as acquired:
+            self.assertTrue(acquired)
+            time.sleep(1.5)
+            self.assertFalse(SingleFlightLock('test_redis_heartbeat').acquire())
+        lock = SingleFlightLock('test_redis_heartbeat')
+        self.assertTrue(lock.acquire())
+        lock.release()
+
+
+class GetOrComputeSingleFlightTests(SimpleTestCase):
+    """ one computation per key - the other callers get the stale value or wait for it """
+
+    def test_compute_once(self):
+        calls = []
+        def compute():
+            calls.append(1)
+            time.sleep(0.3)
+            return {'value': 1}
+        barrier = threading.Barrier(5)
+        results = []
+        def worker():
+            barrier.wait()
+            results.append(get_or_compute_single_flight('test_once', compute, timeout=60))
+        thread_lst = [threading.Thread(target=worker) for _ in range(5)]
+        for thread in thread_lst:
+            thread.start()
+        for thread in thread_lst:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{'value': 1}] * 5)
+
+    def test_stale_while_locked(self):
+        compute = mock.Mock(return_value='new')
+        cache.set('test_stale_old', 'old', 60)
+        with SingleFlightLock('test_stale') as acquired:
+            self.assertTrue(acquired)
+            self.assertEqual(get_or_compute_single_flight('test_stale', compute, timeout=60, stale_key='test_stale_old'), 'old')
+        compute.assert_not_called()
+        self.assertEqual(get_or_compute_single_flight('test_stale', compute, timeout=60, stale_key='test_stale_old'), 'new')
+        self.assertEqual(cache.get('test_stale_old'), 'new')
+
+    def test_wait_while_locked(self):
+        compute = mock.Mock(return_value='computed')
+        with SingleFlightLock('test_wait') as acquired:
+            self.assertTrue(acquired)
+            # the lock holder stores its result while the second caller waits
+            timer = threading.Timer(0.2, lambda: cache.set('test_wait', 'stored', 60))
+            timer.start()
+            self.assertEqual(get_or_compute_single_flight('test_wait', compute, timeout=60, wait_timeout=5), 'stored')
+            timer.join()
+            compute.assert_not_called()
+
+        # the lock holder never finishes - computed after wait_timeout
+        with SingleFlightLock('test_wait_hung') as acquired:
+            self.assertTrue(acquired)
+            self.assertEqual(get_or_compute_single_flight('test_wait_hung', compute, timeout=60, wait_timeout=0.2), 'computed')
+        compute.assert_called_once()
+
+    def test_not_cacheable(self):
+        compute = mock.Mock(return_value={'stats': None})
+        for _ in range(2):
+            self.assertEqual(get_or_compute_single_flight('test_uncacheable', compute, timeout=60, stale_key='test_uncacheable_stale', cacheable=lambda i: i['stats'] is not None), {'stats': None})
+        self.assertEqual(compute.call_count, 2)
+        self.assertIsNone(cache.get('test_uncacheable'))
+        self.assertIsNone(cache.get('test_uncacheable_stale'))
+
+        compute = mock.Mock(return_value=None)
+        self.assertIsNone(get_or_compute_single_flight('test_none', compute, timeout=60))
+        self.assertFalse('test_none' in cache)
@@ -21,8 +21,8 @@ from rest_framework_simplejwt.views import (
     TokenRefreshView,
 )
 from rest_framework.routers import DefaultRouter
-from competition.views import CompetitionViewSet, TeamViewSet, ActivityGoalViewSet, PointsViewSet, CompetitionStatsQueryView, FeedQueryView, JoinCompetitionView, JoinTeamView, CeleryQueryView
-from workouts.views import WorkoutViewSet
+from competition.views import CompetitionViewSet, TeamViewSet, ActivityGoalViewSet, PointsViewSet, CompetitionStatsQueryView, FeedQueryView, LeaderboardQueryView, CompetitionEventsView, CompetitionEventsTokenView, JoinCompetitionView, JoinTeamView, CeleryQueryView
+from workouts.views import WorkoutViewSet, WorkoutBulkView
 from custom_user.views import CustomUserViewSet, LinkStravaView, UnlinkStravaView, SyncStravaView, PasswordResetView, PasswordResetConfirmView
 
 router = DefaultRouter()
@@ -35,9 +35,13 @@ router.register(r'user', CustomUserViewSet, basename='cutomuser')
 
 urlpatterns = [
     path('api/', include([
+        path('workout/bulk/', WorkoutBulkView.as_view(), name='workout-bulk'),  # before the router's workout/<pk>/
         path('', include(router.urls)),
         path('stats/<int:competition>/', CompetitionStatsQueryView.as_view(), name='competition-stats'),
         path('feed/<int:competition>/', FeedQueryView.as_view(), name='competition-feed'),
+        path('leaderboard/<int:competition>/', LeaderboardQueryView.as_view(), name='competition-leaderboard'),
+        path('events/<int:competition>/', CompetitionEventsView.as_view(), name='competition-events'),
+        path('events/<int:competition>/token/', CompetitionEventsTokenView.as_view(), name='competition-events-token'),
         path('join/competition/<str:join_code>/', JoinCompetitionView.as_view(), name='join-competition'),
         path('join/team/', JoinTeamView.as_view(), name='join-team'),
         path('strava/link/<str:code>/', LinkStravaView.as_view(), name='strava-link'),
@@ -3,11 +3,12 @@ from decimal import Decimal
 
 from django.utils import timezone
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Sum
+from django.db.models.functions import TruncDate
 
 from custom_user.models import CustomUser
-from competition.scorer import trigger_workout_change, trigger_workout_delete
+from competition.scorer import trigger_workout_change, trigger_workout_delete, trigger_workouts_bulk_create
 
 # Create your models here.
 
@@ -155,6 +156,13 @@ class Workout(models.Model):
     strava_id = models.BigIntegerField(unique=True, null=True)
     strava_intensity_avg_watts = models.DecimalField(null=True, max_digits=7, decimal_places=2)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', '-start_datetime', '-id'], name='workout_user_start_idx'),
+            models.Index(fields=['-start_datetime', '-id'], name='workout_start_idx'),  # feed pages - walked newest first until the page is full
+            models.Index(fields=['user', 'sport_type', 'start_datetime'], name='workout_user_sport_start_idx'),  # walks / runs on the day of daily steps
+        ]
+
     @property
     def duration_seconds(self):
         return self.duration.seconds
@@ -182,17 +190,31 @@ class Workout(models.Model):
             if v != current.get(k)
         }
 
-    def save(self, *args, **kwargs):
-        """ trigger recalculation of points_capped if workout changes """
-        is_create = self.pk is None
-        scaling_kcal = float((1 if kwargs.get('user', None) is None else kwargs.get('user').scaling_kcal) if self.user is None else self.user.scaling_kcal)
-        scaling_distance = float((1 if kwargs.get('user', None) is None else kwargs.get('user').scaling_distance) if self.user is None else self.user.scaling_distance)
+    def estimate(self, user=None, recorded_walks=None, recorded_runs=None):
+        """ fill in what wasn't recorded from the MET values - daily steps become the distance / kcal of a walk
+
+        Args:
+            user: user whose scaling factors to use if the workout has none yet
+            recorded_walks: total duration of the walks on the day of a steps workout - queried if None
+            recorded_runs: total duration of the runs on the day of a steps workout - queried if None
+        """
+        scaling_kcal = float((1 if user is None else user.scaling_kcal) if self.user is None else self.user.scaling_kcal)
+        scaling_distance = float((1 if user is None else user.scaling_distance) if self.user is None else self.user.scaling_distance)
         if self.sport_type == "Steps":
             self.intensity_category = 1
 
             # Subtract the steps from walks and runs from the daily total steps to not double count
-            recorded_walks = Workout.objects.filter(user=self.user, start_datetime__date=self.start_datetime, sport_type='Walk').aggregate(duration=Sum('duration'))['duration']
-            recorded_runs = Workout.objects.filter(user=self.user, start_datetime__date=self.start_datetime, sport_type='Run').aggregate(duration=Sum('duration'))['duration']
+            # local day as datetime range instead of __date - the database can't use an index on the converted date
+            day = timezone.localtime(self.start_datetime).date()
+            day_workouts = Workout.objects.filter(
+                user=self.user,
+                start_datetime__gte=timezone.make_aware(datetime.datetime.combine(day, datetime.time.min)),
+                start_datetime__lt=timezone.make_aware(datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time.min)),
+            )
+            if recorded_walks is None:
+                recorded_walks = day_workouts.filter(sport_type='Walk').aggregate(duration=Sum('duration'))['duration']
+            if recorded_runs is None:
+                recorded_runs = day_workouts.filter(sport_type='Run').aggregate(duration=Sum('duration'))['duration']
             recorded_steps_walks = 0 if recorded_walks is None else 6_000 / (60 * 60) * recorded_walks.seconds
             recorded_steps_runs = 0 if recorded_runs is None else 10_000 / (60 * 60) * recorded_runs.seconds
             self.distance = 0.82 * scaling_distance * max(self.steps - recorded_steps_walks - recorded_steps_runs, 0) / 1000
@@ -204,19 +226,24 @@ class Workout(models.Model):
             server_time = datetime.datetime.combine(self.start_datetime.date(), datetime.time(23, 59, 0))
             self.start_datetime = timezone.make_aware(server_time).astimezone(datetime.timezone.utc)
 
+        # default intensity 2 - before the estimates below look it up
+        if self.intensity_category is None or self.intensity_category == "":
+            self.intensity_category = 2
+
         if self.sport_type in ["Ride", "EBikeRide", "GravelRide", "Handcycle", "Velomobile", "VirtualRide", "MountainBikeRide", "EMountainBikeRide", "Run", "TrailRun", "VirtualRun", "Walk"]:
             # estimate distance using database MET values
             if self.distance is None or self.distance == "":
                 self.distance = SPORT_MET.get(self.sport_type, SPORT_MET['Workout'])[self.intensity_category] * (self.duration.seconds / (60 * 60)) * scaling_distance # default human 1000m scaled up/down by scaler
 
-        # default intensity 2
-        if self.intensity_category is None or self.intensity_category == "":
-            self.intensity_category = 2
-
         # estimate kcal using database MET values
         if self.kcal is None or self.kcal == "":
             self.kcal = SPORT_MET.get(self.sport_type, SPORT_MET['Workout'])[self.intensity_category] * 75 * (self.duration.seconds / (60 * 60)) * scaling_kcal # default human 75kg scaled up/down by scaler
 
+    def save(self, *args, **kwargs):
+        """ trigger recalculation of points_capped if workout changes """
+        is_create = self.pk is None
+        self.estimate(user=kwargs.get('user', None))
+
         super().save(*args, **kwargs)
         changed = self.get_changed_fields()
         trigger_workout_change(
@@ -256,4 +283,43 @@ class Workout(models.Model):
                     setattr(steps, 'distance', None)
                     setattr(steps, 'kcal', None)
                     setattr(steps, 'duration', datetime.timedelta(seconds=0))
-                    steps.save()
\ No newline at end of file
+                    steps.save()
+
+
+@transaction.atomic
+def bulk_create_workouts(user, workout_lst):
+    """ Create many new workouts of the user with one INSERT - estimated like in save(), points and recalc in bulk.
+
+    The steps of a day are counted against the walks and runs recorded or created on that day, and steps already
+    recorded on the days of new walks and runs are estimated again - like save() does it one by one.
+
+    Returns: the created workouts
+    """
+    workout_lst = list(workout_lst)
+    for workout in workout_lst:
+        workout.user = user
+
+    # walk / run durations of the days with steps - one query instead of two per steps workout
+    steps_days = {timezone.localtime(i.start_datetime).date() for i in workout_lst if i.sport_type == 'Steps'}
+    day_durations = {
+        (i['day'], i['sport_type']): i['duration']
+        for i in Workout.objects.filter(user=user, sport_type__in=['Walk', 'Run'], start_datetime__date__in=steps_days).annotate(day=TruncDate('start_datetime')).values('day', 'sport_type').annotate(duration=Sum('duration')).order_by()
+    }
+    for workout in workout_lst:
+        if workout.sport_type in ['Walk', 'Run']:
+            key = (timezone.localtime(workout.start_datetime).date(), workout.sport_type)
+            day_durations[key] = day_durations.get(key, datetime.timedelta(0)) + workout.duration
+    for workout in workout_lst:
+        day = timezone.localtime(workout.start_datetime).date()
+        workout.estimate(recorded_walks=day_durations.get((day, 'Walk'), datetime.timedelta(0)), recorded_runs=day_durations.get((day, 'Run'), datetime.timedelta(0)))
+
+    workout_lst = Workout.objects.bulk_create(workout_lst, batch_size=1_000)
+    trigger_workouts_bulk_create(user, workout_lst)
+
+    # if new workouts are runs or walks and steps were recorded on the same day, update steps to avoid double counting
+    run_walk_days = {timezone.localtime(i.start_datetime).date() for i in workout_lst if i.sport_type in ['Run', 'Walk']}
+    for steps in Workout.objects.filter(user=user, start_datetime__date__in=run_walk_days, sport_type='Steps').exclude(pk__in=[i.pk for i in workout_lst]):
+        setattr(steps, 'distance', None)
+        setattr(steps, 'kcal', None)
+        steps.save()
+    return workout_lst
@@ -0,0 +1,21 @@
+# parsers.py
+import csv, io
+from rest_framework.parsers import BaseParser
+from rest_framework.exceptions import ParseError
+
+
+def read_csv(stream):
+    """ rows of a CSV file with a header line as dicts - empty cells are left out, i.e. count as not recorded """
+    try:
+        text = stream.read().decode('utf-8-sig')  # spreadsheet exports often start with a byte order mark
+    except UnicodeDecodeError:
+        raise ParseError('CSV file has to be UTF-8 encoded')
+    return [{k.strip(): v.strip() for k, v in row.items() if k is not None and v is not None and v.strip() != ''} for row in csv.DictReader(io.StringIO(text))]
+
+
+class CSVParser(BaseParser):
+    """ text/csv request bodies - a list of dicts like a JSON list """
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return read_csv(stream)
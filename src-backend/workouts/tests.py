@@ -1,3 +1,100 @@
+import datetime
+
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from custom_user.models import CustomUser, RecalcRequest
+from competition.models import Competition, Points
+from workouts.models import Workout
+
+
+class PaginationTests(TestCase):
+    """ the lists come in bounded pages - staff can opt out with ?page_size=all """
+
+    def test_workout_pages(self):
+        CustomUser.objects.bulk_create([CustomUser(email='pages@example.com', username='pages')])
+        user = CustomUser.objects.get(email='pages@example.com')
+        start_datetime = timezone.make_aware(datetime.datetime(2025, 1, 1, 8))
+        # some workouts at the same time - the cursor has to keep them apart
+        Workout.objects.bulk_create([Workout(user=user, sport_type='Run', start_datetime=start_datetime + datetime.timedelta(days=idx // 2), duration=datetime.timedelta(minutes=30)) for idx in range(7)])
+        expected = list(Workout.objects.filter(user=user).order_by('-start_datetime', '-id').values_list('pk', flat=True))
+        client = APIClient()
+        client.force_authenticate(user)
+
+        ids = []
+        url = '/api/workout/?page_size=3'
+        while url is not None:
+            page = client.get(url).json()
+            self.assertLessEqual(len(page['results']), 3)
+            ids += [i['id'] for i in page['results']]
+            url = page['next']
+        self.assertEqual(ids, expected)
+
+        self.assertEqual(len(client.get('/api/workout/?page_size=1000').json()['results']), 7)
+        self.assertIn('results', client.get('/api/workout/?page_size=all').json())
+
+        user.is_staff = True
+        user.save()
+        self.assertEqual([i['id'] for i in client.get('/api/workout/?page_size=all').json()], expected)
+
+
+class BulkCreateTests(TestCase):
+    """ many workouts in one request - all or nothing, estimated like single ones, one recalc request per goal """
+
+    def setUp(self):
+        CustomUser.objects.bulk_create([CustomUser(email=f'bulk{idx}@example.com', username=f'bulk{idx}') for idx in range(2)])
+        self.user, self.other_user = CustomUser.objects.filter(email__startswith='bulk').order_by('pk')
+        self.competition = Competition(owner=self.user, name='Bulk', start_date=datetime.date(2025, 1, 1), end_date=datetime.date(2025, 1, 31))
+        self.competition.save()  # with its two default goals
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_json(self):
+        row_lst = [{'sport_type': 'Run', 'start_datetime': f'2025-01-{day:02d}T07:00:00Z', 'duration': '00:40:00', 'intensity_category': 3} for day in range(2, 7)]
+        row_lst.append({'sport_type': 'Walk', 'start_datetime': '2025-02-10T07:00:00Z', 'duration': '01:00:00'})  # after the competition
+        row_lst.append({'sport_type': 'Steps', 'start_datetime': '2025-01-02T12:00:00Z', 'duration': '00:00:00', 'steps': 10_000})
+        response = self.client.post('/api/workout/bulk/', row_lst, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['created'], 7)
+        self.assertEqual([i['row'] for i in response.json()['results']], list(range(1, 8)))
+        self.assertEqual(Points.objects.filter(workout__user=self.user).count(), 6 * 2)
+        self.assertEqual(RecalcRequest.objects.filter(user=self.user).count(), 2)
+
+        # the steps of the 40 min run on the same day (10k per hour) aren't counted twice
+        steps = Workout.objects.get(user=self.user, sport_type='Steps')
+        self.assertAlmostEqual(float(steps.distance), 0.82 * (10_000 - 10_000 * 40 / 60) / 1000, places=2)
+
+        # the same estimates as a single workout
+        single = Workout(user=self.other_user, sport_type='Run', start_datetime=timezone.make_aware(datetime.datetime(2025, 1, 2, 7)), duration=datetime.timedelta(minutes=40), intensity_category=3)
+        single.save()
+        single.refresh_from_db()
+        bulk = Workout.objects.get(pk=response.json()['results'][0]['id'])
+        self.assertEqual((bulk.kcal, bulk.distance), (single.kcal, single.distance))
+
+    def test_invalid_row(self):
+        row_lst = [
+            {'sport_type': 'Run', 'start_datetime': '2025-01-02T07:00:00Z', 'duration': '00:40:00'},
+            {'sport_type': 'Steps', 'start_datetime': '2025-01-02T07:00:00Z', 'duration': '00:00:00'},  # steps missing
+        ]
+        response = self.client.post('/api/workout/bulk/', row_lst, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([bool(i['errors']) for i in response.json()['results']], [False, True])
+        self.assertFalse(Workout.objects.filter(user=self.user).exists())
+
+    def test_csv(self):
+        csv_file = SimpleUploadedFile('workouts.csv', (
+            'sport_type,start_datetime,duration,intensity_category,kcal,distance\n'
+            'Ride,2025-01-03T17:30:00Z,01:30:00,2,,42.5\n'
+            'Yoga,2025-01-04T08:00:00Z,00:45:00,,,\n'
+        ).encode('utf-8-sig'), content_type='text/csv')
+        response = self.client.post('/api/workout/bulk/', {'file': csv_file}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+        ride, yoga = Workout.objects.filter(user=self.user).order_by('start_datetime')
+        self.assertEqual(float(ride.distance), 42.5)
+        self.assertIsNotNone(ride.kcal)
+        self.assertEqual(yoga.intensity_category, 2)  # the default
 
-# Create your tests here.
+        response = self.client.post('/api/workout/bulk/', 'sport_type,start_datetime,duration\nWalk,2025-01-05T12:00:00Z,00:30:00\n', content_type='text/csv')
+        self.assertEqual(response.status_code, 201)
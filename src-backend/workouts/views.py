@@ -1,16 +1,22 @@
 import time
 from django.db.models import Q
-from rest_framework import viewsets
+from rest_framework import viewsets, status
+from rest_framework.views import APIView
+from rest_framework.response import Response
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.parsers import JSONParser, MultiPartParser
 from django_filters.rest_framework import DjangoFilterBackend
 
 from custom_user.views import IsOwnerOrReadOnly
-from .models import Workout
-from competition.scorer import trigger_workout_change
+from .models import Workout, bulk_create_workouts
+from competition.scorer import trigger_workout_change, workouts_version_key
+from workout_challenge.conditional import ConditionalGetMixin, get_data_versions
 from .serializers import WorkoutSerializer
 from .filters import WorkoutFilter
+from .parsers import CSVParser, read_csv
 
 
-class WorkoutViewSet(viewsets.ModelViewSet):
+class WorkoutViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     #queryset = Competition.objects.all()
     serializer_class = WorkoutSerializer
 
@@ -18,11 +24,50 @@ class WorkoutViewSet(viewsets.ModelViewSet):
     filterset_class = WorkoutFilter
 
     permission_classes = [IsOwnerOrReadOnly]
+    ordering = ('-start_datetime', '-id')  # of the pages - backed by the workout_user_start_idx index
 
     def get_queryset(self):
         # return all workouts from the user himself/herself
         #time.sleep(3)  # throttle for testing
         return Workout.objects.select_related('user').filter(user__id=self.request.user.id).order_by('-start_datetime', '-duration', '-id') # | Q(points__goal__competition__user=self.request.user)).distinct().order_by('-start_datetime', '-duration', '-id')
 
+    def get_data_version(self):
+        return get_data_versions([workouts_version_key(self.request.user.id)])[workouts_version_key(self.request.user.id)]
+
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
+
+
+class WorkoutBulkView(APIView):
+    """ API post view to log many workouts at once - e.g. to backfill weeks of workouts or to import a spreadsheet.
+
+    Takes a JSON list of workouts, a CSV body (text/csv) or a CSV upload in the `file` field, with the WorkoutSerializer
+    fields as columns. All rows are validated first - if one is invalid nothing is created. Returns the id or the
+    errors of every row.
+    """
+    permission_classes = [IsAuthenticated]
+    parser_classes = [JSONParser, CSVParser, MultiPartParser]
+
+    MAX_ROWS = 1_000
+
+    def post(self, request):
+        row_lst = read_csv(request.FILES['file']) if 'file' in request.FILES else request.data
+        if not isinstance(row_lst, list):
+            return Response({'detail': 'Send a list of workouts or a CSV file.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(row_lst) > self.MAX_ROWS:
+            return Response({'detail': f'At most {self.MAX_ROWS} workouts at once.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = WorkoutSerializer(data=row_lst, many=True)
+        if not serializer.is_valid():
+            # a list with an entry per row - or only the invalid rows by index
+            error_dict = serializer.errors if isinstance(serializer.errors, dict) else dict(enumerate(serializer.errors))
+            return Response({
+                'created': 0,
+                'results': [{'row': idx + 1, 'id': None, 'errors': error_dict.get(idx, {})} for idx in range(len(row_lst))],
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        workout_lst = bulk_create_workouts(request.user, [Workout(**i) for i in serializer.validated_data])
+        return Response({
+            'created': len(workout_lst),
+            'results': [{'row': idx + 1, 'id': workout.pk, 'errors': {}} for idx, workout in enumerate(workout_lst)],
+        }, status=status.HTTP_201_CREATED)
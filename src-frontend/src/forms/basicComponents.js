@@ -15,6 +15,7 @@ import {
     DoorOpen,
     Scale,
     UserRoundPen,
+    ChevronsDown,
 } from "lucide-react";
 import {BeatLoader} from "react-spinners";
 import { isMobile } from "react-device-detect";
@@ -509,6 +510,19 @@ export function RefreshButton({
                           IconObject={RefreshCw} isLoading={isLoading} additionalClasses={additionalClasses}/>
 }
 
+export function LoadMoreButton({
+                                   onClick,
+                                   icon = true,
+                                   label = "Load More",
+                                   highlighted = false,
+                                   larger = false,
+                                   isLoading = false,
+                                   additionalClasses = "",
+                               }) {
+    return <GenericButton onClick={onClick} icon={icon} label={label} highlighted={highlighted} larger={larger}
+                          IconObject={ChevronsDown} isLoading={isLoading} additionalClasses={additionalClasses}/>
+}
+
 export function SyncStravaButton({
                                      onClick,
                                      icon = true,
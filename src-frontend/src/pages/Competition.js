@@ -25,6 +25,7 @@ import {useGetUserByIdQuery} from "../utils/reducers/usersSlice";
 import _ from "lodash";
 import {SectionLoader} from "../utils/loaders";
 import {useGetFeedByIdQuery} from "../utils/reducers/feedSlice";
+import {useCompetitionEvents} from "../utils/competitionEvents";
 import CompetitionForm from "../forms/competitionForm";
 import JoinTeamForm from "../forms/joinTeamForm";
 import ActivityGoalsForm from "../forms/activityGoalsForm";
@@ -835,6 +836,9 @@ export default function Competition() {
         pollingInterval: 90000, // 90 seconds
     });
 
+    // pushed feed / leaderboard changes - the polling above only catches up if the stream is down
+    useCompetitionEvents(id);
+
     const isOwner = (user !== undefined) && (user?.id === competition?.owner);
 
     const [teamId, setTeamId] = useState(undefined);
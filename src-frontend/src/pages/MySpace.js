@@ -1,5 +1,5 @@
 import './Dashboard.css';
-import React, {useEffect, useState} from "react";
+import React, {useEffect, useMemo, useState} from "react";
 import {
     Check,
     CheckCheck,
@@ -8,7 +8,7 @@ import {
     Timer,
     Ruler,
 } from 'lucide-react';
-import {useGetWorkoutsQuery, workoutsApi} from "../utils/reducers/workoutsSlice";
+import {useGetWorkoutsInfiniteQuery, workoutsApi} from "../utils/reducers/workoutsSlice";
 import WorkoutForm, {workoutTypes} from "../forms/workoutForm";
 import _ from 'lodash';
 import {useGetUserByIdQuery, usersApi} from "../utils/reducers/usersSlice";
@@ -22,7 +22,7 @@ import JoinCompetitionForm from "../forms/joinCompetitionForm";
 import {HowToScreen, LinkStravaScreen} from "./HowTo";
 import {
     AddButton, EditButton, FairGoalsButton,
-    JoinButton,
+    JoinButton, LoadMoreButton,
     ModifyGoalsButton,
     SettingsButton, StravaButton,
     SyncStravaButton
@@ -109,7 +109,7 @@ function WelcomeBox({user, workouts, setLinkStrava}) {
 }
 
 
-function WorkoutsBox({workouts, user, setLinkStrava}) {
+function WorkoutsBox({workouts, user, setLinkStrava, hasOlderWorkouts, fetchOlderWorkouts, olderWorkoutsIsFetching}) {
 
     const [showEditWorkoutModal, setShowEditWorkoutModal] = useState(false);
     const stravaLinked = user?.strava_athlete_id !== null;
@@ -194,6 +194,12 @@ function WorkoutsBox({workouts, user, setLinkStrava}) {
                 </tbody>
             </table>
 
+            {(hasOlderWorkouts) && (
+                <div className="flex justify-center">
+                    <LoadMoreButton label={"Load Older Workouts"} isLoading={olderWorkoutsIsFetching} onClick={() => fetchOlderWorkouts()}/>
+                </div>
+            )}
+
             {(showEditWorkoutModal) && (
                 <WorkoutForm setModalState={setShowEditWorkoutModal} id={showEditWorkoutModal} scaling_distance={parseFloat(user?.scaling_distance || "1.0")}/>
             )}
@@ -301,6 +307,24 @@ function CompetitionsBox({user, competitions, setJoinCompetition}) {
 }
 
 
+const STATS_DAYS = 42; // the 30 day stats and the calendar of the last 5 weeks plus this week
+
+/**
+ * Whether the stats need workouts older than the loaded pages - the last STATS_DAYS days and a week streak that may go
+ * on before the oldest loaded workout. Anything older is only loaded with "load more".
+ */
+function needsOlderWorkouts(workouts) {
+    const oldest = _.last(workouts);
+    if (oldest === undefined) {
+        return false;
+    }
+    if (oldest.start_datetime_fmt.days_ago < STATS_DAYS) {
+        return true;
+    }
+    const activeWeeks = new Set(_.filter(workouts, item => item.sport_type !== 'Steps').map(item => item.start_datetime_fmt.weeksAgo));
+    return _.range(1, oldest.start_datetime_fmt.weeksAgo + 1).every(week => activeWeeks.has(week));
+}
+
 function getLast5WeeksRange() {
     let cnt = 35;
     const today = new Date();
@@ -659,14 +683,25 @@ export default function MySpace() {
     } = useGetUserByIdQuery('me');
 
     const {
-        data: workouts,
+        data: workoutPages,
         error: workoutsError,
         isLoading: workoutsIsLoading,
         refetch: refetchWorkouts,
         isFetching: workoutsIsFetching,
-    } = useGetWorkoutsQuery(undefined, {
+        fetchNextPage: fetchOlderWorkouts,
+        hasNextPage: hasOlderWorkouts,
+        isFetchingNextPage: olderWorkoutsIsFetching,
+    } = useGetWorkoutsInfiniteQuery(undefined, {
         pollingInterval: 10800000, // 3 hours
     });
+    const workouts = useMemo(() => workoutPages?.pages.flatMap(page => page.results), [workoutPages]);
+
+    // load the pages of newest workouts the stats need - older ones on request only
+    useEffect(() => {
+        if (workouts !== undefined && hasOlderWorkouts && !olderWorkoutsIsFetching && needsOlderWorkouts(workouts)) {
+            fetchOlderWorkouts();
+        }
+    }, [workouts, hasOlderWorkouts, olderWorkoutsIsFetching]);
 
     const {
         data: competitions,
@@ -766,7 +801,9 @@ export default function MySpace() {
                                 <ErrorBoxSection
                                     errorMsg={workoutsError?.status + ' / ' + (workoutsError?.error || workoutsError?.message || workoutsError?.data?.detail)}/>
                             ) : (
-                                <WorkoutsBox workouts={workouts} user={user} setLinkStrava={setLinkStrava}/>
+                                <WorkoutsBox workouts={workouts} user={user} setLinkStrava={setLinkStrava}
+                                             hasOlderWorkouts={hasOlderWorkouts} fetchOlderWorkouts={fetchOlderWorkouts}
+                                             olderWorkoutsIsFetching={olderWorkoutsIsFetching}/>
                             )
                         }
 
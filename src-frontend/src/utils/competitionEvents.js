@@ -0,0 +1,68 @@
+import {useEffect} from 'react';
+import {useDispatch} from 'react-redux';
+import {feedApi, formatFeedEntry} from './reducers/feedSlice';
+import {statsApi} from './reducers/statsSlice';
+
+/**
+ * Subscribes to the server-sent events of a competition and applies them to the cached feed / stats
+ * - feed events carry the changed entries and the ids of the removed workouts, so the feed is patched in place
+ * - leaderboard events only carry rank changes, so the stats are revalidated (304 if nothing else changed)
+ * @param {number|string} id - competition id
+ */
+export function useCompetitionEvents(id) {
+    const dispatch = useDispatch();
+
+    useEffect(() => {
+        if (!id || typeof EventSource === 'undefined') return undefined;
+        let source;
+        let retryTimeout;
+        let closed = false;
+
+        async function connect() {
+            // EventSource can't set the Authorization header - a short-lived token of this competition goes in the query
+            let token;
+            try {
+                token = (await dispatch(feedApi.endpoints.getEventsToken.initiate(id)).unwrap()).token;
+            } catch {
+                if (!closed) retryTimeout = setTimeout(connect, 10000);
+                return;
+            }
+            if (closed) return;
+            source = new EventSource((process.env.REACT_APP_BACKEND_URL || '') + `/api/events/${id}/?token=${token}`);
+
+            source.addEventListener('feed', (event) => {
+                const data = JSON.parse(event.data);
+                if (data.reset) {
+                    dispatch(feedApi.util.invalidateTags([{type: 'Feed', id}]));
+                } else {
+                    dispatch(feedApi.util.updateQueryData('getFeedById', id, (feed) => {
+                        const replaced = new Set([...data.deleted, ...data.changed.map(entry => entry.workout)]);
+                        return [...feed.filter(entry => !replaced.has(entry.workout)), ...data.changed.map(formatFeedEntry)]
+                            .sort((a, b) => (b.workout__start_datetime || '').localeCompare(a.workout__start_datetime || '') || b.workout - a.workout);
+                    }));
+                }
+                dispatch(statsApi.util.invalidateTags([{type: 'Stats', id}]));
+            });
+
+            source.addEventListener('leaderboard', () => {
+                dispatch(statsApi.util.invalidateTags([{type: 'Stats', id}]));
+            });
+
+            source.onerror = () => {
+                // the token is only valid for a minute - instead of letting EventSource reconnect with it when the
+                // stream ends, reconnect with a new one (after 10s if the stream was rejected for good)
+                if (closed) return;
+                const rejected = source.readyState === EventSource.CLOSED;
+                source.close();
+                retryTimeout = setTimeout(connect, rejected ? 10000 : 1000);
+            };
+        }
+
+        connect();
+        return () => {
+            closed = true;
+            clearTimeout(retryTimeout);
+            source?.close();
+        };
+    }, [id, dispatch]);
+}
@@ -117,4 +117,45 @@ export const baseQueryWithReauth = async (args, api, extraOptions) => {
     }
 
     return result;
-};
\ No newline at end of file
+};
+
+const isPaginated = (data) => data !== null && typeof data === 'object' && Array.isArray(data.results) && 'next' in data && 'previous' in data;
+
+/**
+ * Path of a next / previous link of a paginated list relative to the api base url (the links are absolute and carry the cursor)
+ */
+export const apiPath = (link) => link.slice(link.indexOf('/api/') + '/api/'.length);
+
+/**
+ * Options of an infinite query over a paginated list endpoint - the page param is the next link, null for the first page
+ */
+export const cursorPageOptions = {
+    initialPageParam: null,
+    getNextPageParam: (lastPage) => lastPage.next ?? undefined,
+};
+
+/**
+ * baseQueryWithReauth for the small paginated list endpoints (competitions, goals, teams, users) - follows the next links
+ * and returns all results as one list.
+ *
+ * Temporary compatibility step until their pages load lazily like the workouts and points (infinite queries with
+ * cursorPageOptions) - don't use it for lists that grow with the workout history.
+ */
+export const baseQueryWithReauthAllPages = async (args, api, extraOptions) => {
+    let result = await baseQueryWithReauth(args, api, extraOptions);
+    if (result.error || !isPaginated(result.data)) {
+        return result;
+    }
+
+    let results = result.data.results;
+    let next = result.data.next;
+    while (next) {
+        const page = await baseQueryWithReauth({url: apiPath(next), method: 'GET'}, api, extraOptions);
+        if (page.error) {
+            return page;
+        }
+        results = results.concat(page.data.results);
+        next = page.data.next;
+    }
+    return {...result, data: results};
+};
@@ -1,9 +1,9 @@
 import {createApi} from '@reduxjs/toolkit/query/react';
-import {baseQueryWithReauth} from './baseQueryWithReauth';
+import {baseQueryWithReauthAllPages} from './baseQueryWithReauth';
 
 export const competitionsApi = createApi({
     reducerPath: 'competitionsApi',
-    baseQuery: baseQueryWithReauth,
+    baseQuery: baseQueryWithReauthAllPages,
     tagTypes: ['Competition'],
     keepUnusedDataFor: 60 * 60 * 12, // 12 hours cache (default is 60s)
     refetchOnMountOrArgChange: 60 * 60 * 3, // Refetch if older than 3 hours
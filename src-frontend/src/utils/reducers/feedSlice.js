@@ -2,6 +2,14 @@ import {createApi} from '@reduxjs/toolkit/query/react';
 import {baseQueryWithReauth} from './baseQueryWithReauth';
 import {convertToLocalTimezone, dateFormatter} from "./workoutsSlice";
 
+export const formatFeedEntry = (activity) => {
+    return {
+        ...activity,
+        workout__start_datetime_fmt: dateFormatter(activity.workout__start_datetime, activity.workout__sport_type === 'Steps'), // format datetime
+        workout__start_datetime: convertToLocalTimezone(activity.workout__start_datetime, activity.workout__sport_type === 'Steps'), // convert to local timezone
+    };
+};
+
 export const feedApi = createApi({
     reducerPath: 'feedApi',
     baseQuery: baseQueryWithReauth,
@@ -15,16 +23,17 @@ export const feedApi = createApi({
             }),
             transformResponse: (response) => {
                 // Convert timezone for all activites in the response
-                return response.map(activity => {
-                    return {
-                        ...activity,
-                        workout__start_datetime_fmt: dateFormatter(activity.workout__start_datetime, activity.workout__sport_type === 'Steps'), // format datetime
-                        workout__start_datetime: convertToLocalTimezone(activity.workout__start_datetime, activity.workout__sport_type === 'Steps'), // convert to local timezone
-                    };
-                });
+                return response.map(formatFeedEntry);
             },
             providesTags: (result, error, id) => [{type: 'Feed', id}],
         }),
+        getEventsToken: builder.mutation({
+            // short-lived token of the event stream of one competition - not the access token
+            query: (id) => ({
+                url: `events/${id}/token/`,
+                method: 'POST',
+            }),
+        }),
     }),
 });
 
@@ -1,9 +1,9 @@
 import {createApi} from '@reduxjs/toolkit/query/react';
-import {baseQueryWithReauth} from './baseQueryWithReauth';
+import {baseQueryWithReauthAllPages} from './baseQueryWithReauth';
 
 export const goalsApi = createApi({
     reducerPath: 'goalsApi',
-    baseQuery: baseQueryWithReauth,
+    baseQuery: baseQueryWithReauthAllPages,
     tagTypes: ['Goal'],
     keepUnusedDataFor: 60 * 60 * 12, // 12 hours cache (default is 60)
     refetchOnMountOrArgChange: 60 * 60 * 3, // Refetch if older than 3 hours
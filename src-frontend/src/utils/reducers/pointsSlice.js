@@ -1,5 +1,5 @@
 import {createApi} from '@reduxjs/toolkit/query/react';
-import {baseQueryWithReauth} from './baseQueryWithReauth';
+import {apiPath, baseQueryWithReauth, cursorPageOptions} from './baseQueryWithReauth';
 
 export const pointsApi = createApi({
     reducerPath: 'pointsApi',
@@ -8,13 +8,18 @@ export const pointsApi = createApi({
     keepUnusedDataFor: 60 * 60 * 3, // 3 hours cache (default is 60)
     refetchOnMountOrArgChange: 60 * 15, // Refetch if older than 15 minutes
     endpoints: (builder) => ({
-        getPoints: builder.query({
-            query: (params = {}) => ({
-                url: `point/`, //?${new URLSearchParams(params).toString()}
+        getPoints: builder.infiniteQuery({
+            // one page of the newest points at a time - fetchNextPage() loads the next older one
+            infiniteQueryOptions: cursorPageOptions,
+            query: ({queryArg, pageParam}) => (pageParam) ? ({
+                url: apiPath(pageParam),
                 method: 'GET',
-                params: params,
+            }) : ({
+                url: `point/`,
+                method: 'GET',
+                params: queryArg || {},
             }),
-            providesTags: (result = []) => result.length ? [...result.map(({id}) => ({ type: 'Point', id })), { type: 'Point' }] : [{ type: 'Point' }],
+            providesTags: (result) => result ? [...result.pages.flatMap(page => page.results.map(({id}) => ({ type: 'Point', id }))), { type: 'Point' }] : [{ type: 'Point' }],
         }),
         getPointById: builder.query({
             query: (id) => ({
@@ -27,6 +32,6 @@ export const pointsApi = createApi({
 });
 
 export const {
-    useGetPointsQuery,
+    useGetPointsInfiniteQuery,
     useGetPointByIdQuery,
 } = pointsApi;
\ No newline at end of file
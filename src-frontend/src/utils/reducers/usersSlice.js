@@ -1,10 +1,10 @@
 import {createApi} from '@reduxjs/toolkit/query/react';
-import {baseQueryWithReauth} from './baseQueryWithReauth';
+import {baseQueryWithReauthAllPages} from './baseQueryWithReauth';
 import {convertToLocalTimezone, dateFormatter} from "./workoutsSlice";
 
 export const usersApi = createApi({
     reducerPath: 'usersApi',
-    baseQuery: baseQueryWithReauth,
+    baseQuery: baseQueryWithReauthAllPages,
     tagTypes: ['User'],
     keepUnusedDataFor: 60 * 60 * 12, // 12 hours cache (default is 60s)
     refetchOnMountOrArgChange: 60 * 60 * 3, // Refetch if older than 3 hours
@@ -1,5 +1,5 @@
 import {createApi} from '@reduxjs/toolkit/query/react';
-import {baseQueryWithReauth} from './baseQueryWithReauth';
+import {apiPath, baseQueryWithReauth, cursorPageOptions} from './baseQueryWithReauth';
 
 
 /**
@@ -100,23 +100,30 @@ export const workoutsApi = createApi({
     keepUnusedDataFor: 60 * 60 * 12, // 12 hours cache (default is 60)
     refetchOnMountOrArgChange: 60 * 60, // Refetch if older than 1 hour
     endpoints: (builder) => ({
-        getWorkouts: builder.query({
-            query: (params = {}) => ({
-                url: `workout/`, //?${new URLSearchParams(params).toString()}
+        getWorkouts: builder.infiniteQuery({
+            // one page of the newest workouts at a time - fetchNextPage() loads the next older one
+            infiniteQueryOptions: cursorPageOptions,
+            query: ({queryArg, pageParam}) => (pageParam) ? ({
+                url: apiPath(pageParam),
                 method: 'GET',
-                params: params,
+            }) : ({
+                url: `workout/`,
+                method: 'GET',
+                params: queryArg || {},
             }),
             transformResponse: (response) => {
-                return response.map(workout => {
-                    return {
-                        ...workout,
-                        start_datetime_fmt: dateFormatter(workout.start_datetime, workout.sport_type === 'Steps'), // format datetime
-                        start_datetime: convertToLocalTimezone(workout.start_datetime, workout.sport_type === 'Steps'), // convert to local timezone
-                    };
-                });
+                return {
+                    ...response,
+                    results: response.results.map(workout => {
+                        return {
+                            ...workout,
+                            start_datetime_fmt: dateFormatter(workout.start_datetime, workout.sport_type === 'Steps'), // format datetime
+                            start_datetime: convertToLocalTimezone(workout.start_datetime, workout.sport_type === 'Steps'), // convert to local timezone
+                        };
+                    }),
+                };
             },
-            // providesTags: (result = []) => result.map(({id}) => ({type: 'Workout', id})),
-            providesTags: (result = []) => result.length ? [...result.map(({id}) => ({ type: 'Workout', id })), { type: 'Workout' }] : [{ type: 'Workout' }],
+            providesTags: (result) => result ? [...result.pages.flatMap(page => page.results.map(({id}) => ({ type: 'Workout', id }))), { type: 'Workout' }] : [{ type: 'Workout' }],
         }),
         getWorkoutById: builder.query({
             query: (id) => ({
@@ -168,7 +175,7 @@ export const workoutsApi = createApi({
 });
 
 export const {
-    useGetWorkoutsQuery,
+    useGetWorkoutsInfiniteQuery,
     useGetWorkoutByIdQuery,
     useAddWorkoutMutation,
     useUpdateWorkoutMutation,